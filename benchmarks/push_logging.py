@@ -0,0 +1,100 @@
+"""
+Benchmarks the logging overhead of pushing a replication log.
+
+Compares the old behaviour (the full replication event formatted into an INFO record)
+with the payload summary that push_replication_log logs now, with logging enabled
+(INFO) and disabled (WARNING). Only serialization and logging are measured, the task
+kick itself is left out since it is dominated by the network.
+
+Usage:
+    PYTHONPATH=. python benchmarks/push_logging.py [--objects 5000] [--iterations 50]
+"""
+
+import argparse
+import io
+import json
+import logging
+import time
+import uuid
+
+from fractal_database_matrix.payloads import PayloadSummary
+
+logger = logging.getLogger("benchmarks.push_logging")
+
+
+def make_fixture(objects: int) -> dict:
+    return {
+        "payload": [
+            {
+                "model": "fractal_database.device" if i % 10 else "fractal_database.database",
+                "pk": str(uuid.uuid4()),
+                "fields": {
+                    "name": f"object-{i}",
+                    "object_version": i,
+                    "metadata": {"room_id": f"!{uuid.uuid4().hex}:localhost"},
+                },
+            }
+            for i in range(objects)
+        ]
+    }
+
+
+def push_eager(fixture: dict) -> None:
+    replication_event = json.dumps(fixture)
+    logger.info(
+        "Target %s is pushing fixture(s): %s to room %s on homeserver %s"
+        % ("channel", replication_event, "!room:localhost", "http://localhost:8008")
+    )
+
+
+def push_summary(fixture: dict) -> None:
+    replication_event = json.dumps(fixture)
+    logger.info(
+        "Target %s is pushing %s to room %s on homeserver %s",
+        "channel",
+        PayloadSummary(replication_event, fixture),
+        "!room:localhost",
+        "http://localhost:8008",
+    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Replication event pushed to room %s: %s", "!room:localhost", replication_event
+        )
+
+
+def bench(func, fixture: dict, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(fixture)
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--objects", type=int, default=5000)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    fixture = make_fixture(args.objects)
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    baseline = bench(lambda fixture: json.dumps(fixture), fixture, args.iterations)
+    print(f"{args.objects} objects, {args.iterations} iterations (ms per push)")
+    print(f"  serialization only:            {baseline:8.3f}")
+    for level in (logging.INFO, logging.WARNING):
+        logger.setLevel(level)
+        for name, func in (("full body", push_eager), ("summary", push_summary)):
+            stream.seek(0)
+            stream.truncate()
+            elapsed = bench(func, fixture, args.iterations)
+            print(
+                f"  {name:9} logging {logging.getLevelName(level):7}: {elapsed:8.3f}"
+                f" (+{elapsed - baseline:.3f}, {stream.tell() // args.iterations} bytes logged)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Parallel application of replicated fixtures.
+
+Objects in a fixture only depend on each other through foreign keys, and through
+earlier versions of the same object. ``partition_fixture`` splits a fixture into
+partitions that share neither, keeping each partition in the sender's order (which
+already follows FK order). Partitions are then loaded concurrently by a bounded pool
+of worker threads, each of which holds at most one database connection.
+"""
+
+import json
+import logging
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Hashable, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def referenced_values(fields: Dict[str, Any]) -> Iterable[Hashable]:
+    for value in fields.values():
+        if isinstance(value, list):
+            # many to many fields and natural keys
+            for item in value:
+                if isinstance(item, (str, int)):
+                    yield item
+        elif isinstance(value, (str, int)) and not isinstance(value, bool):
+            yield value
+
+
+def partition_fixture(objects: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """
+    Splits serialized objects into independent partitions.
+
+    Two objects end up in the same partition if they have the same (model, pk) or if
+    one references the other's pk from one of its fields. Since pks are UUIDs, a
+    field value that happens to equal another object's pk is a reference; a false
+    match only merges two partitions, it can't reorder objects.
+    """
+    parent = list(range(len(objects)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(a: int, b: int) -> None:
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    first_by_key: Dict[Any, int] = {}
+    first_by_pk: Dict[Hashable, int] = {}
+    for i, item in enumerate(objects):
+        key = (item.get("model"), item.get("pk"))
+        if key in first_by_key:
+            union(first_by_key[key], i)
+        else:
+            first_by_key[key] = i
+        pk = item.get("pk")
+        if isinstance(pk, (str, int)):
+            first_by_pk.setdefault(pk, i)
+
+    for i, item in enumerate(objects):
+        for value in referenced_values(item.get("fields", {})):
+            j = first_by_pk.get(value)
+            if j is not None:
+                union(i, j)
+
+    partitions: Dict[int, List[Dict[str, Any]]] = {}
+    for i, item in enumerate(objects):
+        partitions.setdefault(find(i), []).append(item)
+    return list(partitions.values())
+
+
+def apply_workers() -> int:
+    """
+    Number of partitions loaded at once. Defaults to 1 on SQLite, since it only allows a
+    single writer, and to the number of CPUs (up to 4) otherwise.
+    """
+    from django.conf import settings
+    from django.db import connection
+
+    workers = getattr(settings, "FRACTAL_REPLICATION_APPLY_WORKERS", None) or os.environ.get(
+        "FRACTAL_REPLICATION_APPLY_WORKERS"
+    )
+    if workers:
+        return max(int(workers), 1)
+    if connection.vendor == "sqlite":
+        return 1
+    return min(os.cpu_count() or 1, 4)
+
+
+def load_partition(objects: List[Dict[str, Any]]) -> int:
+    """
+    Loads a partition with ``loaddata``, in its own transaction. Going through the command
+    (rather than saving deserialized objects) keeps the signal handlers that are disabled
+    while loading fixtures from replicating received objects again.
+    """
+    from django.core.management import call_command
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(objects, f)
+    try:
+        call_command("loaddata", f.name, verbosity=0)
+    finally:
+        os.unlink(f.name)
+    return len(objects)
+
+
+def _load_partitions(partitions: List[List[Dict[str, Any]]]) -> int:
+    from django.db import connection
+
+    try:
+        return sum(load_partition(partition) for partition in partitions)
+    finally:
+        # worker threads don't outlive the pool, don't leak their connections
+        connection.close()
+
+
+def _balance(partitions: List[List[Dict[str, Any]]], bins: int) -> List[List[List[Any]]]:
+    # largest partitions first, each to the least loaded worker
+    loads = [0] * bins
+    balanced: List[List[List[Dict[str, Any]]]] = [[] for _ in range(bins)]
+    for partition in sorted(partitions, key=len, reverse=True):
+        i = loads.index(min(loads))
+        balanced[i].append(partition)
+        loads[i] += len(partition)
+    return balanced
+
+
+def apply_fixture(objects: List[Dict[str, Any]], workers: Optional[int] = None) -> int:
+    """
+    Loads a fixture by applying its independent partitions concurrently. Partitions
+    are spread over the workers up front so that each worker uses a single connection.
+
+    Returns:
+        The number of objects loaded.
+    """
+    partitions = partition_fixture(objects)
+    workers = min(workers or apply_workers(), len(partitions)) or 1
+    logger.info(
+        "Applying %d object(s) in %d partition(s) with %d worker(s)",
+        len(objects),
+        len(partitions),
+        workers,
+    )
+    if workers == 1:
+        return sum(load_partition(partition) for partition in partitions)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fractal-apply") as pool:
+        return sum(pool.map(_load_partitions, _balance(partitions, workers)))
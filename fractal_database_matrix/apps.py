@@ -1,4 +1,8 @@
+import atexit
+import os
+
 from django.apps import AppConfig
+from django.conf import settings
 from django.db import models
 
 
@@ -8,6 +12,21 @@ class FractalDatabaseMatrixConfig(AppConfig):
 
     def ready(self) -> None:
         import fractal_database_matrix.signals
+        from fractal_database_matrix import metrics
+
+        if getattr(settings, "FRACTAL_MATRIX_METRICS", False):
+            metrics.enable()
+        metrics_file = getattr(settings, "FRACTAL_MATRIX_METRICS_FILE", None) or os.environ.get(
+            "FRACTAL_MATRIX_METRICS_FILE"
+        )
+        if metrics.enabled() and metrics_file:
+            atexit.register(metrics.dump, metrics_file)
+
+        from fractal_database_matrix import tracing
+
+        trace_mode = tracing._configured_mode(getattr(settings, "FRACTAL_MATRIX_TRACING", None))
+        if trace_mode and not tracing.enabled():
+            tracing.enable(trace_mode, getattr(settings, "FRACTAL_MATRIX_TRACE_FILE", None))
         from fractal_database.models import Database
         from fractal_database_matrix.signals import (
             create_matrix_replication_target_for_new_database,
@@ -1,17 +1,59 @@
 import asyncio
 import itertools
 import logging
-from typing import Any, AsyncGenerator, List
+import os
+import time
+from typing import Any, AsyncGenerator, List, Optional, Tuple
 
+from aiohttp import ClientConnectionError
+from taskiq_matrix import matrix_broker
 from taskiq_matrix.matrix_broker import MatrixBroker
-from taskiq_matrix.matrix_queue import Task
+from taskiq_matrix.matrix_queue import MatrixQueue, Task
+from taskiq_matrix.matrix_result_backend import MatrixResultBackend
 
-from .queue import ReplicationQueue
+from ..circuit import Backoff, get_circuit_breaker
+from ..client import FractalMatrixClient
+from ..endpoints import EndpointSelector, get_endpoint_selector
+from ..exceptions import CircuitOpenError
+from ..filters import compile_filter
+from .queue import PRIORITY_REPLICATION_QUEUE, LaneScheduler, ReplicationQueue
+from .sync import DEFAULT_PAGE_BYTES, DEFAULT_PAGE_SIZE, SyncEngine
 
 logger = logging.getLogger(__file__)
 
+# MatrixBroker.kick sends every task with a fresh client of its own, have it create clients
+# whose requests go through the homeserver's rate limiter and circuit breaker
+matrix_broker.FractalAsyncClient = FractalMatrixClient
+
+# seconds between two looks for new shard rooms
+SHARD_REFRESH_INTERVAL = float(os.environ.get("FRACTAL_REPLICATION_SHARD_REFRESH_INTERVAL", 60))
+
+# local URL of the worker's homeserver, probed alongside MATRIX_HOMESERVER_URL
+HOMESERVER_LOCAL_URL = os.environ.get("MATRIX_HOMESERVER_LOCAL_URL")
+
 
 class FractalMatrixBroker(MatrixBroker):
+    # number of priority lane tasks handed out before a held bulk task gets a turn
+    PRIORITY_BUDGET = 8
+    # queues that are synced together, by broker attribute
+    SYNCED_QUEUES = (
+        "device_queue",
+        "broadcast_queue",
+        "mutex_queue",
+        "replication_queue",
+        "replication_priority_queue",
+    )
+
+    _shards_refreshed = 0.0
+
+    # the homeserver endpoint the broker's clients currently talk to, homeserver_url
+    # until one is selected (see select_endpoint)
+    endpoint_url: Optional[str] = None
+
+    @property
+    def synced_queues(self) -> Tuple[str, ...]:
+        return (*self.SYNCED_QUEUES, *getattr(self, "shard_queues", ()))
+
     def _init_queues(self):
         """
         FIXME: Get all Database primary targets and instantiate a
@@ -19,62 +61,247 @@ class FractalMatrixBroker(MatrixBroker):
         """
         super()._init_queues()
 
+        # devices can opt into only applying a subset of what is replicated to them
+        replication_filter = compile_filter(os.environ.get("FRACTAL_REPLICATION_FILTER"))
+        parallel_apply = os.environ.get("FRACTAL_REPLICATION_PARALLEL_APPLY", "").lower() in (
+            "1",
+            "true",
+            "yes",
+        )
         if not hasattr(self, "replication_queue"):
-            self.replication_queue = ReplicationQueue(self.homeserver_url, self.access_token)
+            self.replication_queue = ReplicationQueue(
+                self.homeserver_url,
+                self.access_token,
+                replication_filter=replication_filter,
+                parallel_apply=parallel_apply,
+            )
+        if not hasattr(self, "replication_priority_queue"):
+            self.replication_priority_queue = ReplicationQueue(
+                self.homeserver_url,
+                self.access_token,
+                replication_filter=replication_filter,
+                name=PRIORITY_REPLICATION_QUEUE,
+                parallel_apply=parallel_apply,
+            )
+
+        # the other shard rooms of a sharded replication channel (the device room is the
+        # first shard) are found at startup (see refresh_shard_queues), they can also be
+        # listed up front
+        if not hasattr(self, "shard_queues"):
+            self.shard_queues: List[str] = []
+        shard_rooms = os.environ.get("FRACTAL_REPLICATION_SHARD_ROOMS", "")
+        for room_id in shard_rooms.split(","):
+            if room_id.strip():
+                self._add_shard_queue(room_id.strip())
+
+        for name in self.synced_queues:
+            self._use_matrix_client(getattr(self, name))
+
+        # one /sync for all queues instead of one per queue
+        if not hasattr(self, "sync_engine"):
+            self.sync_engine = SyncEngine(
+                FractalMatrixClient(self.endpoint_url or self.homeserver_url, self.access_token),
+                {name: getattr(self, name) for name in self.synced_queues},
+                # a device doesn't replicate what it sent itself
+                exclude_self=(
+                    "replication_queue",
+                    "replication_priority_queue",
+                    *self.shard_queues,
+                ),
+                page_size=int(os.environ.get("FRACTAL_REPLICATION_PAGE_SIZE", DEFAULT_PAGE_SIZE)),
+                page_bytes=int(
+                    os.environ.get("FRACTAL_REPLICATION_PAGE_BYTES", DEFAULT_PAGE_BYTES)
+                ),
+            )
+
+        if isinstance(self.result_backend, MatrixResultBackend) and not isinstance(
+            self.result_backend.matrix_client, FractalMatrixClient
+        ):
+            self.result_backend.matrix_client = FractalMatrixClient(
+                self.result_backend.homeserver_url, self.result_backend.access_token
+            )
+
+    def _add_shard_queue(self, room_id: str) -> Optional[ReplicationQueue]:
+        """
+        Adds a replication queue, with its own checkpoint, for a shard room. Returns None if
+        the room already has one.
+        """
+        rooms = {getattr(self, name).room_id for name in self.shard_queues}
+        if room_id == self.replication_queue.room_id or room_id in rooms:
+            return None
+
+        name = f"replication_shard_{len(self.shard_queues) + 1}_queue"
+        queue = ReplicationQueue(
+            self.homeserver_url,
+            self.access_token,
+            room_id=room_id,
+            replication_filter=self.replication_queue.replication_filter,
+            parallel_apply=self.replication_queue.parallel_apply,
+        )
+        setattr(self, name, queue)
+        self.shard_queues.append(name)
+        if hasattr(self, "sync_engine"):
+            self._use_matrix_client(queue)
+            self.sync_engine.queues[name] = queue
+            self.sync_engine.exclude_self.add(name)
+        logger.info("Consuming replication shard room %s", room_id)
+        return queue
+
+    async def refresh_shard_queues(self) -> None:
+        """
+        Adds a queue for every shard room of the replication channel whose device space
+        this broker syncs (see ``MatrixReplicationChannel.shard_rooms``).
+        """
+        self._shards_refreshed = time.monotonic()
+        try:
+            from fractal_database_matrix.models import MatrixReplicationChannel
+
+            channel = await MatrixReplicationChannel.aget_by_device_space(
+                self.replication_queue.room_id
+            )
+            rooms = (await channel.ashard_rooms())[1:] if channel is not None else []
+        except Exception as e:
+            logger.warning("Failed to look up the shard rooms of this device's channel: %s", e)
+            return None
+
+        for room_id in rooms:
+            queue = self._add_shard_queue(room_id)
+            if queue is not None:
+                await queue.checkpoint.get_or_init_checkpoint(full_sync=True)
+
+    def endpoint_selector(self) -> Optional[EndpointSelector]:
+        """
+        Returns the endpoint selector of the broker's homeserver, or None if no local URL
+        is configured (MATRIX_HOMESERVER_LOCAL_URL) and there is nothing to select from.
+        """
+        if not HOMESERVER_LOCAL_URL:
+            return None
+        return get_endpoint_selector(self.homeserver_url, local_url=HOMESERVER_LOCAL_URL)
+
+    async def select_endpoint(self) -> str:
+        """
+        Points the broker's clients at the fastest reachable endpoint of its homeserver.
+        """
+        selector = self.endpoint_selector()
+        if selector is None:
+            return self.homeserver_url
+
+        url = await selector.select()
+        if url == self.endpoint_url:
+            return url
+
+        logger.info("Using homeserver endpoint %s", url)
+        self.endpoint_url = url
+        clients = [getattr(self, name).client for name in self.synced_queues]
+        clients.append(self.sync_engine.client)
+        if isinstance(self.result_backend, MatrixResultBackend):
+            clients.append(self.result_backend.matrix_client)
+        for client in clients:
+            client.homeserver = url
+        return url
+
+    def _use_matrix_client(self, queue: MatrixQueue) -> None:
+        """
+        Swaps the queue's client for one that goes through the homeserver's
+        rate limiter and circuit breaker.
+        """
+        if isinstance(queue.client, FractalMatrixClient):
+            return None
+        client = FractalMatrixClient(self.endpoint_url or self.homeserver_url, self.access_token)
+        queue.client = client
+        queue.checkpoint.client = client
 
     async def startup(self) -> None:
+        await self.select_endpoint()
         await super().startup()
 
         # full sync is required for replication queue because it needs to
         # sync any tasks that were sent before the checkpoint was created for
         # this device
         await self.replication_queue.checkpoint.get_or_init_checkpoint(full_sync=True)
+        await self.replication_priority_queue.checkpoint.get_or_init_checkpoint(full_sync=True)
+        for name in self.shard_queues:
+            await getattr(self, name).checkpoint.get_or_init_checkpoint(full_sync=True)
+        await self.refresh_shard_queues()
+
+        from django.conf import settings
+
+        if getattr(settings, "FRACTAL_REPLICATION_OUTBOX", False):
+            # send what is left in the outbox without waiting for the next push
+            from fractal_database_matrix.outbox import DRAINER
+
+            DRAINER.wake()
 
     async def shutdown(self) -> None:
         """
         Shuts down the broker.
         """
         await super().shutdown()
+        from fractal_database_matrix.outbox import DRAINER
+
+        await DRAINER.stop()
         await self.replication_queue.shutdown()
+        await self.replication_priority_queue.shutdown()
+        for name in self.shard_queues:
+            await getattr(self, name).shutdown()
+        await self.sync_engine.client.close()
 
     async def get_tasks(self) -> AsyncGenerator[List[Task], Any]:  # pragma: no cover
+        # failed syncs are retried with backoff, never longer than the circuit stays open
+        backoff = Backoff(cap=get_circuit_breaker(self.homeserver_url).reset_timeout)
+        failures = 0
         while True:
-            tasks = {
-                "device_queue": asyncio.create_task(
-                    self.device_queue.get_unacked_tasks(), name="device_queue"
-                ),
-                "broadcast_queue": asyncio.create_task(
-                    self.broadcast_queue.get_unacked_tasks(), name="broadcast_queue"
-                ),
-                "mutex_queue": asyncio.create_task(
-                    self.mutex_queue.get_unacked_tasks(), name="mutex_queue"
-                ),
-                "replication_queue": asyncio.create_task(
-                    self.replication_queue.get_unacked_tasks(), name="replication_queue"
-                ),
-            }
-            sync_task_results: List[List[Task]] = []
-
-            while tasks:
-                done, _ = await asyncio.wait(tasks.values(), return_when=asyncio.FIRST_COMPLETED)
-
-                for completed_task in done:
-                    queue_name = completed_task.get_name()
-                    try:
-                        queue, pending_tasks = completed_task.result()
-                        if pending_tasks:
-                            sync_task_results.append(pending_tasks)
-                            logger.debug(f"Got {len(pending_tasks)} tasks from {queue}")
-                    except Exception as e:
-                        logger.exception(f"Sync failed: {e}")
-
-                    tasks[queue_name] = asyncio.create_task(
-                        getattr(self, queue_name).get_unacked_tasks(), name=queue_name
-                    )
-
-                if sync_task_results:
-                    yield list(itertools.chain.from_iterable(sync_task_results))
-                    sync_task_results = []  # Reset for the next iteration
-
-                # Optionally, add a short delay before starting the next round
-                await asyncio.sleep(0)
+            delay = 0.0
+            try:
+                # picks up a faster endpoint once the background probe finds one
+                await self.select_endpoint()
+
+                if time.monotonic() - self._shards_refreshed > SHARD_REFRESH_INTERVAL:
+                    # shard rooms may have been created since the last look
+                    await self.refresh_shard_queues()
+
+                # batches are handed out while the sync response is still being read, bulk
+                # tasks are held back so that priority tasks read after them go first
+                lanes = LaneScheduler(self.PRIORITY_BUDGET, self.sync_engine.page_size)
+                async for results in self.sync_engine.get_unacked_tasks():
+                    for name, pending_tasks in results.items():
+                        logger.debug("Got %d tasks from %s", len(pending_tasks), name)
+
+                    # shard tasks are kicked to the "replication" queue, have them yielded
+                    # (and acked) by their shard's queue instead
+                    for name in self.shard_queues:
+                        for task in results.get(name, ()):
+                            task.queue = name[: -len("_queue")]
+
+                    priority = results.pop("replication_priority_queue", [])
+                    bulk = [
+                        task
+                        for name in ("replication_queue", *self.shard_queues)
+                        for task in results.pop(name, ())
+                    ]
+                    if not results and not priority and not bulk:
+                        # the engine is about to wait for what was handed out to be acked
+                        tasks = lanes.flush()
+                    else:
+                        other = list(itertools.chain.from_iterable(results.values()))
+                        tasks = lanes.schedule(priority, bulk, other)
+                    if tasks:
+                        yield tasks
+                tasks = lanes.flush()
+                if tasks:
+                    yield tasks
+                failures = 0
+            except CircuitOpenError as e:
+                failures += 1
+                delay = e.retry_in
+                logger.warning("Sync skipped, retrying in %.1fs: %s", delay, e)
+            except Exception as e:
+                failures += 1
+                delay = backoff.delay(failures)
+                selector = self.endpoint_selector()
+                if selector and isinstance(e, (ClientConnectionError, asyncio.TimeoutError)):
+                    # fall back to the homeserver's other endpoint on the next sync
+                    selector.mark_unreachable(self.endpoint_url or self.homeserver_url)
+                logger.exception("Sync failed, retrying in %.1fs: %s", delay, e)
+
+            await asyncio.sleep(delay)
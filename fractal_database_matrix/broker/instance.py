@@ -2,10 +2,12 @@ import os
 
 from taskiq import TaskiqScheduler
 from taskiq.middlewares.retry_middleware import SimpleRetryMiddleware
-from taskiq_matrix.matrix_result_backend import MatrixResultBackend
 from taskiq_matrix.schedulesource import MatrixRoomScheduleSource
 
+from ..lag import LagMiddleware
+from ..tracing import TracingMiddleware
 from .broker import FractalMatrixBroker
+from .results import FractalMatrixResultBackend
 
 broker = (
     FractalMatrixBroker()
@@ -14,13 +16,18 @@ broker = (
         os.environ.get("MATRIX_ACCESS_TOKEN"),
     )
     .with_result_backend(
-        MatrixResultBackend(
+        FractalMatrixResultBackend(
             homeserver_url=os.environ.get("MATRIX_HOMESERVER_URL"),
             access_token=os.environ.get("MATRIX_ACCESS_TOKEN"),
             result_ex_time=60,
         )
     )
-    .with_middlewares(SimpleRetryMiddleware(default_retry_count=3))
+    .with_middlewares(
+        SimpleRetryMiddleware(default_retry_count=3), TracingMiddleware(), LagMiddleware()
+    )
 )
 
 scheduler = TaskiqScheduler(broker=broker, sources=[MatrixRoomScheduleSource(broker)])
+
+# register the tasks defined by this package with the broker
+import fractal_database_matrix.tasks  # noqa: E402,F401
@@ -1,16 +1,192 @@
+import asyncio
+import hashlib
 import json
 import logging
-from typing import List, Optional, Tuple
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, Iterable, List, Optional, Set, Tuple
 
+from nio import WhoamiError
+from taskiq import AckableMessage
+from taskiq_matrix.filters import run_sync_filter
+from taskiq_matrix.exceptions import TaskAlreadyAcked
 from taskiq_matrix.matrix_queue import BroadcastQueue, Task
 from taskiq_matrix.utils import send_message
 
+from .. import metrics
+from ..apply import referenced_values
+from ..filters import ReplicationFilter
+from ..lag import TRACKER
+from .sync import get_sync_filter, is_own_task, task_room_filter
+
 logger = logging.getLogger(__name__)
 
+REPLICATION_QUEUE = "replication"
+# latency sensitive control changes are replicated through their own lane so that
+# they don't wait behind bulk data
+PRIORITY_REPLICATION_QUEUE = "replication_priority"
+PRIORITY_MODELS = (
+    "fractal_database.databasemembership",
+    "fractal_database.devicemembership",
+    "fractal_database_matrix.matrixcredentials",
+    "fractal_database_matrix.matrixreplicationchannel",
+    "fractal_database.replicationchannel",
+)
+PRIORITY_MAX_OBJECTS = 50
+# seconds an object pushed through the bulk lane is considered not applied yet (see
+# InFlightObjects)
+BULK_IN_FLIGHT_SECONDS = float(os.environ.get("FRACTAL_REPLICATION_BULK_IN_FLIGHT_SECONDS", 300))
+
+REPLICATE_FIXTURE_TASK = "fractal_database.replication.tasks:replicate_fixture"
+PARALLEL_REPLICATE_FIXTURE_TASK = "fractal_database_matrix.tasks:replicate_fixture_parallel"
+
+# metadata label of a sharded channel's shard rooms, shard 0 is the channel's device space
+SHARD_ROOM_LABEL = "replication_shard_{}"
+
+
+def replication_lane(objects: list, priority_models: tuple = PRIORITY_MODELS) -> str:
+    """
+    Returns the name of the replication queue a fixture should be pushed through. Small
+    fixtures made up only of control models (memberships, credentials, channels) go through
+    the priority lane, everything else through the bulk replication queue. Fixtures that
+    refer to, or hold newer versions of, objects still in flight on the bulk lane have to
+    stay on it (see ``InFlightObjects``).
+    """
+    if not objects or len(objects) > PRIORITY_MAX_OBJECTS:
+        return REPLICATION_QUEUE
+    for item in objects:
+        if str(item.get("model", "")).lower() not in priority_models:
+            return REPLICATION_QUEUE
+    return PRIORITY_REPLICATION_QUEUE
+
+
+class InFlightObjects:
+    """
+    The objects recently pushed through the bulk lane, per channel, with the shard they
+    were pushed to. Pushers don't see acks, so an object counts as in flight for ``ttl``
+    seconds after it was pushed.
+
+    A fixture that refers to an object in flight, or holds a newer version of one, has to
+    follow it through the same room. Otherwise it can be applied before the object exists
+    on the receiving end, or the older version is applied after the newer one.
+    """
+
+    def __init__(self, ttl: float = BULK_IN_FLIGHT_SECONDS):
+        self.ttl = ttl
+        # (channel pk, object pk) -> (shard, pushed at), oldest push first
+        self._objects: "OrderedDict[Tuple[str, str], Tuple[int, float]]" = OrderedDict()
+
+    def _expire(self, now: float) -> None:
+        while self._objects:
+            key, (_, pushed) = next(iter(self._objects.items()))
+            if now - pushed < self.ttl:
+                break
+            del self._objects[key]
+
+    def add(self, channel_pk: Any, objects: list, shard: int = 0) -> None:
+        now = time.monotonic()
+        self._expire(now)
+        for item in objects:
+            if isinstance(item, dict) and item.get("pk") is not None:
+                key = (str(channel_pk), str(item["pk"]))
+                self._objects.pop(key, None)
+                self._objects[key] = (shard, now)
+
+    def shards(self, channel_pk: Any, objects: list) -> Set[int]:
+        """
+        Returns the shards of the objects in flight that ``objects`` are earlier versions
+        of or refer to.
+        """
+        self._expire(time.monotonic())
+        if not self._objects:
+            return set()
+        shards = set()
+        for item in objects:
+            if not isinstance(item, dict):
+                continue
+            values = [item.get("pk"), *referenced_values(item.get("fields") or {})]
+            for value in values:
+                in_flight = self._objects.get((str(channel_pk), str(value)))
+                if in_flight is not None:
+                    shards.add(in_flight[0])
+        return shards
+
+
+BULK_OBJECTS = InFlightObjects()
+
+
+class LaneScheduler:
+    """
+    Orders the tasks the broker hands out so that the priority lane is drained first.
+
+    Both lanes share the device space's timeline, so bulk tasks read from a sync response
+    are held back (up to ``max_held`` of them) while the rest of it is read, letting
+    priority tasks read later overtake them. To keep the bulk lane from starving, a held
+    bulk task is let through after every ``budget`` priority tasks.
+    """
+
+    def __init__(self, budget: int = 8, max_held: int = 100):
+        self.budget = budget
+        self.max_held = max_held
+        self.held: "deque[Task]" = deque()
+        self._run = 0
+
+    def schedule(self, priority: List[Task], bulk: List[Task], other: List[Task]) -> List[Task]:
+        """
+        Returns the tasks to hand out now: the tasks of other queues, the priority tasks
+        (with a held bulk task after every ``budget`` of them), and the bulk tasks that
+        don't fit in the hold.
+        """
+        tasks = list(other)
+        for task in priority:
+            tasks.append(task)
+            self._run += 1
+            if self._run >= self.budget and self.held:
+                tasks.append(self.held.popleft())
+                self._run = 0
+        self.held.extend(bulk)
+        while len(self.held) > self.max_held:
+            tasks.append(self.held.popleft())
+        return tasks
+
+    def flush(self) -> List[Task]:
+        """
+        Returns every held bulk task, in the order they were read.
+        """
+        tasks = list(self.held)
+        self.held.clear()
+        self._run = 0
+        return tasks
+
+
+def replication_shard(objects: list, shard_count: int) -> int:
+    """
+    Returns the shard a fixture is pushed to on a channel with ``shard_count`` shard rooms.
+    A fixture whose objects are all the same object (same model and pk) goes to the shard
+    that object hashes to, so the versions of an object pushed on its own arrive in order.
+    Fixtures that mix objects go to shard 0, the device space, in push order with every
+    other mixed fixture.
+    """
+    if shard_count <= 1 or not objects or not all(isinstance(item, dict) for item in objects):
+        return 0
+    keys = {(str(item.get("model", "")).lower(), str(item.get("pk"))) for item in objects}
+    if len(keys) != 1:
+        return 0
+    model, pk = keys.pop()
+    key = f"{model}:{pk}"
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], "big") % shard_count
+
 
 class ReplicationQueue(BroadcastQueue):
     """
     Replication queues are broadcast queues whose checkpoints are device specific.
+    Each replication lane (see ``replication_lane``) is its own queue, with its own
+    event types and checkpoint.
+
+    If a ``replication_filter`` is provided, objects it doesn't match are dropped from
+    received fixtures before they are applied. With ``parallel_apply``, received fixtures
+    are applied by ``replicate_fixture_parallel`` instead of ``replicate_fixture``.
     """
 
     def __init__(
@@ -18,13 +194,37 @@ class ReplicationQueue(BroadcastQueue):
         homeserver_url: str,
         access_token: str,
         *args,
+        replication_filter: Optional[ReplicationFilter] = None,
+        name: str = REPLICATION_QUEUE,
+        parallel_apply: bool = False,
         **kwargs,
     ):
-        self.name = "replication"
+        self.name = name
+        self.replication_filter = replication_filter
+        self.parallel_apply = parallel_apply
         super().__init__(self.name, homeserver_url, access_token, *args, **kwargs)
         self.checkpoint.type = f"{self.checkpoint.type}.{self.device_name}"
+        # ids of handed out tasks that haven't been acked (or skipped) yet, and of the
+        # ones acked by this queue
+        self.outstanding: Set[str] = set()
+        self.acked: Set[str] = set()
+        self._settled = asyncio.Event()
+
+    def filter_objects(self, replication_event: dict) -> dict:
+        if not self.replication_filter:
+            return replication_event
+        fixture = replication_event["payload"]
+        replication_event["payload"] = self.replication_filter.apply(fixture)
+        metrics.FIXTURES_FILTERED.inc(
+            len(fixture) - len(replication_event["payload"]), channel=self.name
+        )
+        return replication_event
 
     def prune_old_objects(self, replication_event: dict) -> dict:
+        with metrics.PRUNE_SECONDS.time():
+            return self._prune_old_objects(replication_event)
+
+    def _prune_old_objects(self, replication_event: dict) -> dict:
         fixture = replication_event["payload"]
         # dictionary to store the latest version of each object
         latest_versions = {}
@@ -51,32 +251,134 @@ class ReplicationQueue(BroadcastQueue):
 
         # extract the values to get the pruned list of objects
         replication_event["payload"] = list(latest_versions.values())
+        metrics.FIXTURES_PRUNED.inc(len(fixture) - len(replication_event["payload"]))
         return replication_event
 
+    async def get_tasks(
+        self,
+        timeout: int = 30000,
+        since_token: Optional[str] = None,
+        exclude_self: bool = False,
+    ) -> list[Task]:
+        """
+        Returns a list of tasks and acks, synced through a filter registered on the
+        homeserver. When ``exclude_self`` is set, tasks sent by this user are dropped
+        before their bodies are parsed.
+        """
+        next_batch = since_token or self.checkpoint.since_token
+        sync_filter = await get_sync_filter(
+            self.client,
+            task_room_filter([self.room_id], [self.task_types.task, f"{self.task_types.ack}.*"]),
+        )
+        task_events = await run_sync_filter(
+            self.client, sync_filter, timeout=timeout, since=next_batch
+        )
+        user_id = self.client.user_id if exclude_self else None
+        return [
+            Task(**event)
+            for event in task_events.get(self.room_id, [])
+            if not is_own_task(event, self.task_types.task, user_id)
+        ]
+
     async def get_unacked_tasks(
         self, timeout: int = 30000, exclude_self: bool = True
     ) -> Tuple[str, List[Task]]:
-        _, unacked_tasks = await super().get_unacked_tasks(timeout, exclude_self)
+        start = time.perf_counter()
+        # the user id is needed to recognize our own tasks
+        if not self.client.user_id:
+            whoami = await self.client.whoami()
+            if isinstance(whoami, WhoamiError):
+                raise Exception(whoami.message)
+
+        tasks = await self.get_tasks(
+            timeout=timeout, since_token=self.checkpoint.since_token, exclude_self=exclude_self
+        )
+        unacked_tasks = self.filter_acked_tasks(tasks, exclude_self=exclude_self)
+        metrics.SYNC_SECONDS.observe(time.perf_counter() - start, queue=self.name)
+        return self.name, unacked_tasks
+
+    def filter_acked_tasks(self, tasks: List[Task], exclude_self: bool = False) -> List[Task]:
+        """
+        Filters out acked tasks, then filters and prunes the fixtures of the unacked
+        replication tasks.
+        """
+        unacked_tasks = super().filter_acked_tasks(tasks, exclude_self=exclude_self)
 
         for task in unacked_tasks:
             task_name = task.data["task_name"]
             # ignore any tasks that aren't the replicate fixture task
-            if task_name != "fractal_database.replication.tasks:replicate_fixture":
+            if task_name != REPLICATE_FIXTURE_TASK:
                 continue
 
+            TRACKER.received(task.id, self.room_id, task.data.setdefault("labels", {}))
             replication_event = json.loads(task.data["args"][0])
+            replication_event = self.filter_objects(replication_event)
             task.data["args"][0] = json.dumps(self.prune_old_objects(replication_event))
+            if self.parallel_apply:
+                task.data["task_name"] = PARALLEL_REPLICATE_FIXTURE_TASK
 
-        return self.name, unacked_tasks
+        metrics.TASKS_RECEIVED.inc(len(unacked_tasks), queue=self.name)
+        return unacked_tasks
+
+    def track(self, task_ids: Iterable[str]) -> None:
+        """
+        Starts tracking handed out tasks until they are acked (or skipped).
+        """
+        self.outstanding.update(task_ids)
+        if self.outstanding:
+            self._settled.clear()
+
+    def reset_tracking(self) -> None:
+        self.outstanding.clear()
+        self.acked.clear()
+        self._settled.set()
+
+    def settle(self, task_id: str, acked: bool = True) -> None:
+        if task_id in self.outstanding and acked:
+            self.acked.add(task_id)
+        self.outstanding.discard(task_id)
+        if not self.outstanding:
+            self._settled.set()
+
+    async def wait_for_acks(self, timeout: float) -> bool:
+        """
+        Waits until every tracked task has been acked. Returns False on timeout.
+        """
+        if not self.outstanding:
+            return True
+        try:
+            await asyncio.wait_for(self._settled.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            # stop pacing on them, they still hold back the checkpoint until acked
+            self.outstanding.clear()
+            self._settled.set()
+            return False
+
+    async def yield_task(self, task: Task) -> AckableMessage:
+        try:
+            return await super().yield_task(task)
+        except TaskAlreadyAcked:
+            self.settle(task.id)
+            TRACKER.discard(task.id)
+            raise
+        except Exception:
+            # most likely locked by another worker, it won't be acked here
+            self.settle(task.id, acked=False)
+            raise
 
     async def ack_msg(
-        self, task_id: str, room_id: str, tasks_to_ack: Optional[list[str]] = None
+        self,
+        task_id: str,
+        room_id: Optional[str] = None,
+        tasks_to_ack: Optional[list[str]] = None,
     ) -> None:
         """
         Acks a given task id.
 
         FIXME: ack list of tasks_to_ack
         """
+        room_id = room_id or self.room_id
         message = json.dumps(
             {
                 "task_id": task_id,
@@ -84,7 +386,11 @@ class ReplicationQueue(BroadcastQueue):
             }
         )
         logger.debug(
-            f"Sending ack for task {task_id} to room: {room_id}\nAck type: {self.task_types.ack}.{task_id}",
+            "Sending ack for task %s to room: %s\nAck type: %s.%s",
+            task_id,
+            room_id,
+            self.task_types.ack,
+            task_id,
         )
         await send_message(
             self.client,
@@ -94,3 +400,5 @@ class ReplicationQueue(BroadcastQueue):
             task_id=task_id,
             queue=self.name,
         )
+        metrics.ACKS_SENT.inc(queue=self.name)
+        self.settle(task_id)
@@ -0,0 +1,47 @@
+import logging
+import pickle
+from typing import Any, TypeVar
+
+from taskiq.result import TaskiqResult
+from taskiq_matrix.matrix_result_backend import MatrixResultBackend
+
+from .. import metrics
+
+logger = logging.getLogger(__name__)
+
+_ReturnType = TypeVar("_ReturnType")
+
+# label of tasks whose result nobody reads, their workers don't send a result event
+NO_RESULT_LABEL = "no_result"
+
+
+def wants_result(labels: Any) -> bool:
+    return not (isinstance(labels, dict) and labels.get(NO_RESULT_LABEL))
+
+
+def result_size(result: TaskiqResult) -> int:
+    """
+    Returns the size in bytes of the value of the result's event: the pickled result,
+    base64 encoded (see ``MatrixResultBackend.set_result``).
+    """
+    return 4 * -(-len(pickle.dumps(result)) // 3)
+
+
+class FractalMatrixResultBackend(MatrixResultBackend):
+    """
+    Matrix result backend that doesn't send results for tasks kicked with the
+    ``no_result`` label (i.e. replication tasks), sparing the room an event per task.
+    """
+
+    async def set_result(self, task_id: str, result: TaskiqResult[_ReturnType]) -> None:
+        if not wants_result(result.labels):
+            logger.debug("Not sending the result of task %s, it was kicked without one", task_id)
+            if metrics.enabled():
+                metrics.RESULTS_SKIPPED.inc()
+                metrics.RESULT_BYTES_SKIPPED.inc(result_size(result))
+            return None
+
+        await super().set_result(task_id, result)
+        if metrics.enabled():
+            metrics.RESULTS_SENT.inc()
+            metrics.RESULT_BYTES_SENT.inc(result_size(result))
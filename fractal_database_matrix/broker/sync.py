@@ -0,0 +1,530 @@
+import itertools
+import json
+import logging
+import time
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from aiohttp import ClientResponse, ClientTimeout
+from fractal.matrix.async_client import FractalAsyncClient
+from nio import (
+    Api,
+    MessageDirection,
+    RoomMessagesError,
+    SyncError,
+    UploadFilterError,
+    WhoamiError,
+)
+from nio.client.async_client import client_session
+from taskiq_matrix.matrix_queue import MatrixQueue, Task
+
+from .. import metrics
+
+try:
+    import ijson
+except ImportError:  # pragma: no cover
+    ijson = None
+
+logger = logging.getLogger(__name__)
+
+# limits of the batches of tasks handed out, and of the pages of a catch-up
+DEFAULT_PAGE_SIZE = 100
+DEFAULT_PAGE_BYTES = 4 * 1024 * 1024
+# how long a catch-up waits for a page's tasks to be acked before fetching the next one
+DEFAULT_PAGE_ACK_TIMEOUT = 60
+
+# nothing but room timelines are needed to sync tasks
+EMPTY_EVENT_FILTER = {"types": [], "limit": 0}
+
+# (user id, room filter) -> filter id
+_filter_ids: Dict[Tuple[str, str], str] = {}
+
+
+def task_room_filter(
+    room_ids: Iterable[str], types: Iterable[str], limit: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    Returns a room filter that only lets the given task (and ack) event types through
+    for the given rooms, at most ``limit`` timeline events per room. Member events are
+    lazy loaded and room state, ephemeral and account data events are left out entirely.
+    """
+    timeline: Dict[str, Any] = {"types": sorted(set(types)), "lazy_load_members": True}
+    if limit is not None:
+        timeline["limit"] = limit
+    return {
+        "rooms": sorted(set(room_ids)),
+        "state": {**EMPTY_EVENT_FILTER, "lazy_load_members": True},
+        "timeline": timeline,
+        "ephemeral": EMPTY_EVENT_FILTER,
+        "account_data": EMPTY_EVENT_FILTER,
+    }
+
+
+async def get_sync_filter(
+    client: FractalAsyncClient, room_filter: Dict[str, Any]
+) -> Union[str, Dict[str, Any]]:
+    """
+    Returns the id of a filter registered on the homeserver for ``room_filter``. Filters
+    are registered once per user and reused, so sync requests only carry the filter id.
+    Falls back to sending the filter inline if it can't be registered.
+    """
+    inline = {
+        "presence": EMPTY_EVENT_FILTER,
+        "account_data": EMPTY_EVENT_FILTER,
+        "room": room_filter,
+    }
+    if not client.user_id:
+        return inline
+
+    key = (client.user_id, json.dumps(room_filter, sort_keys=True))
+    try:
+        return _filter_ids[key]
+    except KeyError:
+        pass
+
+    res = await client.upload_filter(
+        presence=EMPTY_EVENT_FILTER, account_data=EMPTY_EVENT_FILTER, room=room_filter
+    )
+    if isinstance(res, UploadFilterError):
+        logger.warning("Failed to register sync filter, sending it inline: %s", res.message)
+        return inline
+
+    logger.debug("Registered sync filter %s for %s", res.filter_id, client.user_id)
+    _filter_ids[key] = res.filter_id
+    return res.filter_id
+
+
+def is_own_task(event: Dict[str, Any], task_type: str, user_id: Optional[str]) -> bool:
+    """
+    Returns True for task events sent by ``user_id``. Checked before a task's body is
+    parsed so that a device doesn't pay for decoding the tasks it sent itself.
+    """
+    return bool(user_id) and event.get("sender") == user_id and event.get("msgtype") == task_type
+
+
+class SyncStream:
+    """
+    Reads the room timelines out of a /sync response body.
+
+    With ijson installed the body is parsed incrementally as it is read off the wire and
+    only one room's timeline (bounded by the filter's timeline limit) is held in memory
+    at a time. Without it the whole body is read and parsed with json (still skipping
+    nio's response objects).
+    """
+
+    def __init__(self, response: ClientResponse):
+        self.response = response
+        # the body isn't guaranteed to have next_batch before the rooms
+        self.next_batch: Optional[str] = None
+
+    async def rooms(self) -> AsyncIterator[Tuple[str, List[Dict[str, Any]], bool]]:
+        """
+        Yields (room id, timeline events, limited) for every joined room.
+        """
+        if ijson is None:
+            body = json.loads(await self.response.read())
+            self.next_batch = body.get("next_batch")
+            for room_id, room in body.get("rooms", {}).get("join", {}).items():
+                timeline = room.get("timeline", {})
+                yield room_id, timeline.get("events", []), bool(timeline.get("limited"))
+            return
+
+        room_id = None
+        room_prefix = item_prefix = limited_prefix = None
+        events: List[Dict[str, Any]] = []
+        limited = False
+        builder = None
+        async for prefix, event, value in ijson.parse_async(self.response.content, use_float=True):
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == item_prefix and event == "end_map":
+                    events.append(builder.value)
+                    builder = None
+            elif prefix == item_prefix and event == "start_map":
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            elif prefix == limited_prefix and event == "boolean":
+                limited = value
+            elif prefix == room_prefix and event == "end_map":
+                yield room_id, events, limited
+                events, limited = [], False
+            elif prefix == "rooms.join" and event == "map_key":
+                room_id = value
+                room_prefix = f"rooms.join.{room_id}"
+                item_prefix = f"{room_prefix}.timeline.events.item"
+                limited_prefix = f"{room_prefix}.timeline.limited"
+            elif prefix == "next_batch" and event == "string":
+                self.next_batch = value
+
+
+@client_session
+async def _open_session(client: FractalAsyncClient) -> None:
+    """
+    Opens the client's HTTP session if it isn't yet.
+    """
+
+
+class _Batches:
+    """
+    Cuts the tasks routed to each queue into batches of at most ``page_size`` tasks or
+    ``page_bytes`` bytes, and keeps track of the tasks handed out whose ack hasn't
+    been seen.
+    """
+
+    def __init__(self, engine: "SyncEngine", names: Iterable[str]):
+        self.engine = engine
+        self.tasks: Dict[str, List[Task]] = {name: [] for name in names}
+        self.sizes: Dict[str, int] = {name: 0 for name in names}
+        self.pending: Dict[str, Set[str]] = {name: set() for name in names}
+        for name in names:
+            # acks of tasks handed out in earlier rounds are seen in the stream again
+            if hasattr(engine.queues[name], "reset_tracking"):
+                engine.queues[name].reset_tracking()
+
+    def add(self, name: str, task: Task, size: int) -> List[Task]:
+        """
+        Adds a task (or ack) and returns the batch it completes, if any.
+        """
+        queue = self.engine.queues[name]
+        if task.type != queue.task_types.task:
+            # an ack, for a task in the current batch or one handed out already
+            self.pending[name].discard(task.id)
+            self.tasks[name] = [t for t in self.tasks[name] if t.id != task.id]
+            if hasattr(queue, "settle"):
+                queue.settle(task.id)
+            return []
+
+        self.tasks[name].append(task)
+        self.sizes[name] += size
+        if (
+            len(self.tasks[name]) >= self.engine.page_size
+            or self.sizes[name] >= self.engine.page_bytes
+        ):
+            return self.flush(name)
+        return []
+
+    def flush(self, name: str) -> List[Task]:
+        """
+        Returns the unacked tasks of the queue's current batch.
+        """
+        queue = self.engine.queues[name]
+        batch, self.tasks[name], self.sizes[name] = self.tasks[name], [], 0
+        unacked = queue.filter_acked_tasks(batch, exclude_self=name in self.engine.exclude_self)
+        task_ids = {task.id for task in unacked}
+        self.pending[name].update(task_ids)
+        if hasattr(queue, "track"):
+            queue.track(task_ids)
+        return unacked
+
+    def done(self, name: str) -> bool:
+        """
+        Returns True once every task handed out to the queue has been acked.
+        """
+        queue = self.engine.queues[name]
+        pending = self.pending[name]
+        if hasattr(queue, "acked"):
+            pending = pending - queue.acked
+        return not pending
+
+
+class SyncEngine:
+    """
+    Runs a single /sync long-poll for several queues that share an access token and
+    demultiplexes the returned events to each queue by room and event type.
+
+    Every queue keeps its own checkpoint. A queue whose sync came back without unacked
+    tasks moves its checkpoint to the sync's ``next_batch``, a queue with unacked tasks
+    keeps it until they are handled. Each round syncs from the oldest checkpoint: the
+    queues that are further ahead only see events they have already processed again,
+    which are dropped along with their acks.
+
+    The response is read as a stream and unacked tasks are handed out in batches while
+    it is being read. A task whose ack comes later in the same response is still handed
+    out, ``yield_task`` checks that the task hasn't been acked before running it.
+
+    Queues that fell behind are caught up with paged /messages requests instead of a
+    single /sync whose timeline would be cut off (``limited``). That's the case for
+    checkpoints that weren't produced by the engine (loaded from room state, or rewound
+    by the checkpoint task) and for queues whose room came back limited. A catch-up
+    pages forward from the checkpoint up to the current sync position, one page of at
+    most ``page_size`` tasks at a time, and waits for the page's tasks to be acked
+    before fetching the next one, so memory stays flat however far behind a queue is.
+    Once everything handed out has been acked, the checkpoint is moved to that position
+    and saved.
+    """
+
+    def __init__(
+        self,
+        client: FractalAsyncClient,
+        queues: Dict[str, MatrixQueue],
+        exclude_self: Iterable[str] = (),
+        page_size: int = DEFAULT_PAGE_SIZE,
+        page_bytes: int = DEFAULT_PAGE_BYTES,
+        page_ack_timeout: float = DEFAULT_PAGE_ACK_TIMEOUT,
+    ):
+        self.client = client
+        self.queues = queues
+        self.exclude_self = set(exclude_self)
+        self.page_size = page_size
+        self.page_bytes = page_bytes
+        self.page_ack_timeout = page_ack_timeout
+        # sync tokens produced by the engine, in the order they were received
+        self._positions: Dict[str, int] = {}
+        self._counter = itertools.count()
+        # queues whose timeline came back limited
+        self._behind: Set[str] = set()
+        # checkpoint -> (sync position, cursor per room) of unfinished catch-ups
+        self._cursors: Dict[str, Tuple[str, Dict[str, Optional[str]]]] = {}
+
+    def _types(self, names: Iterable[str]) -> List[str]:
+        return sorted(
+            itertools.chain.from_iterable(
+                (self.queues[name].task_types.task, f"{self.queues[name].task_types.ack}.*")
+                for name in names
+            )
+        )
+
+    def _task_filter(self, names: Iterable[str], limit: Optional[int] = None) -> Dict[str, Any]:
+        names = list(names)
+        return task_room_filter(
+            [self.queues[name].room_id for name in names], self._types(names), limit=limit
+        )
+
+    async def _ensure_user_id(self) -> None:
+        # the user id is needed to recognize our own tasks
+        if not self.client.user_id:
+            whoami = await self.client.whoami()
+            if isinstance(whoami, WhoamiError):
+                raise Exception(whoami.message)
+        for queue in self.queues.values():
+            queue.client.user_id = queue.client.user_id or self.client.user_id
+
+    async def _request(
+        self, names: List[str], since: Optional[str], timeout: int
+    ) -> ClientResponse:
+        sync_filter = await get_sync_filter(
+            self.client, self._task_filter(names, limit=self.page_size)
+        )
+        method, path = Api.sync(
+            self.client.access_token, since=since, timeout=timeout or None, filter=sync_filter
+        )
+        await _open_session(self.client)
+        # the body is read while tasks are handed out, only bound the wait for data
+        response = await self.client.send(
+            method,
+            path,
+            timeout=ClientTimeout(
+                total=None, sock_connect=30, sock_read=timeout / 1000 + 15 if timeout else None
+            ),
+        )
+        if response.status != 200:
+            try:
+                error = (await response.json()).get("error")
+            except Exception:
+                error = response.reason
+            response.release()
+            raise Exception(f"Sync failed with {response.status}: {error}")
+        return response
+
+    async def _position(self, names: List[str], since: str) -> str:
+        # the current sync position, without any events
+        sync_filter = await get_sync_filter(self.client, self._task_filter(names, limit=0))
+        res = await self.client.sync(timeout=0, sync_filter=sync_filter, since=since)
+        if isinstance(res, SyncError):
+            raise Exception(res.message)
+        return res.next_batch
+
+    def _route(self, room_id: str, event: Dict[str, Any]) -> Iterable[Tuple[str, Task, int]]:
+        content = event.get("content", {})
+        event_type = content.get("msgtype", "")
+        content["sender"] = event.get("sender")
+        for name, queue in self.queues.items():
+            if queue.room_id != room_id:
+                continue
+            task_type = queue.task_types.task
+            if event_type != task_type and not event_type.startswith(f"{queue.task_types.ack}."):
+                continue
+            user_id = self.client.user_id if name in self.exclude_self else None
+            if is_own_task(content, task_type, user_id):
+                continue
+            try:
+                body = content["body"]
+                yield name, Task(**{**content, "room_id": room_id}), len(body.get("task", ""))
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning("Dropping malformed %s event for %s: %s", event_type, name, e)
+
+    async def _wait_for_acks(self, names: Iterable[str]) -> None:
+        for name in names:
+            queue = self.queues[name]
+            if hasattr(queue, "wait_for_acks") and not await queue.wait_for_acks(
+                self.page_ack_timeout
+            ):
+                logger.info("Tasks of %s not acked yet, fetching the next page", name)
+
+    async def sync(
+        self, names: List[str], since: Optional[str], timeout: int
+    ) -> AsyncGenerator[Dict[str, List[Task]], None]:
+        """
+        Syncs the given queues from ``since`` and yields their unacked tasks in batches
+        as the response is read.
+        """
+        start = time.perf_counter()
+        response = await self._request(names, since, timeout)
+
+        batches = _Batches(self, names)
+        behind: Set[str] = set()
+        stream = SyncStream(response)
+        try:
+            async for room_id, events, limited in stream.rooms():
+                if limited and since is not None:
+                    # only the latest events of the room were returned, the room's queues
+                    # are caught up page by page from their checkpoint instead
+                    behind.add(room_id)
+                    continue
+                for event in events:
+                    for name, task, size in self._route(room_id, event):
+                        batch = batches.add(name, task, size) if name in batches.tasks else []
+                        if batch:
+                            yield {name: batch}
+        finally:
+            response.release()
+
+        if stream.next_batch is None:
+            raise Exception("Sync response is missing next_batch")
+        self._positions[stream.next_batch] = next(self._counter)
+
+        results = {}
+        elapsed = time.perf_counter() - start
+        for name in names:
+            queue = self.queues[name]
+            metrics.SYNC_SECONDS.observe(elapsed, queue=queue.name)
+            if queue.room_id in behind:
+                self._behind.add(name)
+                continue
+            unacked = batches.flush(name)
+            if unacked:
+                results[name] = unacked
+            if batches.done(name):
+                queue.checkpoint.since_token = stream.next_batch
+            # keep the queue's client in step for code that reads its next batch
+            queue.client.next_batch = stream.next_batch
+        if results:
+            yield results
+
+    async def catch_up(
+        self, names: List[str], since: str
+    ) -> AsyncGenerator[Dict[str, List[Task]], None]:
+        """
+        Pages through the events the given queues missed since ``since`` and yields their
+        unacked tasks, one page at a time. Every page ends with an empty batch.
+        """
+        # resume an interrupted catch-up where it stopped
+        position, cursors = self._cursors.get(since) or (await self._position(names, since), {})
+        self._cursors[since] = (position, cursors)
+
+        batches = _Batches(self, names)
+        for room_id in sorted({self.queues[name].room_id for name in names}):
+            room_names = [name for name in names if self.queues[name].room_id == room_id]
+            message_filter = {"types": self._types(room_names), "lazy_load_members": True}
+            cursor = cursors.get(room_id, since)
+            while cursor is not None:
+                res = await self.client.room_messages(
+                    room_id,
+                    start=cursor,
+                    end=position,
+                    direction=MessageDirection.front,
+                    limit=self.page_size,
+                    message_filter=message_filter,
+                )
+                if isinstance(res, RoomMessagesError):
+                    raise Exception(res.message)
+                logger.debug(
+                    "Catching up %s: %d event(s) from %s", room_id, len(res.chunk), cursor
+                )
+
+                for event in res.chunk:
+                    for name, task, size in self._route(room_id, event.source):
+                        batch = batches.add(name, task, size) if name in room_names else []
+                        if batch:
+                            yield {name: batch}
+                for name in room_names:
+                    batch = batches.flush(name)
+                    if batch:
+                        yield {name: batch}
+
+                # don't fetch more than a page ahead of the workers, the empty batch tells
+                # the broker to hand out whatever it is holding back first
+                yield {}
+                await self._wait_for_acks(room_names)
+                cursor = cursors[room_id] = res.end if res.chunk and res.end != cursor else None
+
+        del self._cursors[since]
+        self._positions[position] = next(self._counter)
+        for name in names:
+            queue = self.queues[name]
+            self._behind.discard(name)
+            if batches.done(name):
+                await queue.checkpoint.put_checkpoint_state(position)
+                queue.checkpoint.since_token = position
+                queue.client.next_batch = position
+
+    async def get_unacked_tasks(
+        self, timeout: int = 30000
+    ) -> AsyncGenerator[Dict[str, List[Task]], None]:
+        """
+        Runs one sync round and yields the unacked tasks of the queues in batches. An empty
+        batch is yielded before waiting for the tasks handed out so far to be acked.
+        """
+        await self._ensure_user_id()
+
+        groups: Dict[Optional[str], List[str]] = {}
+        for name, queue in self.queues.items():
+            groups.setdefault(queue.checkpoint.since_token, []).append(name)
+
+        # forget positions and catch-ups no checkpoint is at anymore
+        self._positions = {
+            token: position for token, position in self._positions.items() if token in groups
+        }
+        self._cursors = {
+            token: cursors for token, cursors in self._cursors.items() if token in groups
+        }
+
+        # queues that fell behind, or whose checkpoint can't be ordered against the others
+        lagging: Dict[str, List[str]] = {}
+        for since, names in list(groups.items()):
+            if since is None:
+                continue
+            if since not in self._positions:
+                lagging[since] = groups.pop(since)
+            elif self._behind.intersection(names):
+                lagging[since] = [name for name in names if name in self._behind]
+                groups[since] = [name for name in names if name not in self._behind]
+                if not groups[since]:
+                    del groups[since]
+
+        for since, names in lagging.items():
+            async for results in self.catch_up(names, since):
+                yield results
+            timeout = 0
+
+        if None in groups:
+            # queues without a checkpoint start from an initial sync
+            async for results in self.sync(groups.pop(None), None, timeout=0):
+                yield results
+            timeout = 0
+
+        if groups:
+            since = min(groups, key=self._positions.__getitem__)
+            names = list(itertools.chain.from_iterable(groups.values()))
+            async for results in self.sync(names, since, timeout=timeout):
+                yield results
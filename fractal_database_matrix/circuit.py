@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import random
+import time
+from enum import Enum
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+from . import metrics
+from .endpoints import canonical_url
+from .exceptions import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+_T = TypeVar("_T")
+
+
+class CircuitState(str, Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class Backoff:
+    """
+    Exponential backoff with full jitter. A ``retry_after`` hint from the
+    homeserver (``M_LIMIT_EXCEEDED``) always takes precedence over a shorter delay.
+    """
+
+    def __init__(self, base: float = 0.5, cap: float = 30.0):
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        delay = random.uniform(0, min(self.cap, self.base * (2 ** max(attempt - 1, 0))))
+        if retry_after is not None:
+            return max(delay, retry_after)
+        return delay
+
+
+class CircuitBreaker:
+    """
+    Per homeserver circuit breaker.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and every request
+    fails fast with ``CircuitOpenError`` until ``reset_timeout`` (or the homeserver's
+    ``retry_after``, whichever is longer) has passed. The circuit then lets a single
+    request through (half open); its outcome closes or reopens the circuit.
+    """
+
+    FAILURE_THRESHOLD = 5
+    RESET_TIMEOUT = 30.0
+
+    def __init__(
+        self,
+        homeserver_url: str,
+        failure_threshold: Optional[int] = None,
+        reset_timeout: Optional[float] = None,
+    ):
+        self.homeserver_url = homeserver_url
+        self.failure_threshold = failure_threshold or self.FAILURE_THRESHOLD
+        self.reset_timeout = reset_timeout or self.RESET_TIMEOUT
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.open_for = self.reset_timeout
+        self.trial_in_flight = False
+
+    def __repr__(self) -> str:
+        return f"CircuitBreaker(homeserver_url={self.homeserver_url}, state={self.state.value})"
+
+    @property
+    def state(self) -> CircuitState:
+        if self.opened_at is None:
+            return CircuitState.CLOSED
+        if time.monotonic() - self.opened_at >= self.open_for:
+            return CircuitState.HALF_OPEN
+        return CircuitState.OPEN
+
+    def retry_in(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(self.open_for - (time.monotonic() - self.opened_at), 0.0)
+
+    def before_request(self) -> bool:
+        """
+        Raises ``CircuitOpenError`` if a request to the homeserver shouldn't be made right now.
+        Returns True if the request is the half open circuit's trial request.
+        """
+        state = self.state
+        if state == CircuitState.CLOSED:
+            return False
+        if state == CircuitState.HALF_OPEN and not self.trial_in_flight:
+            # let a single trial request through
+            self.trial_in_flight = True
+            return True
+        raise CircuitOpenError(self.homeserver_url, self.retry_in() or self.reset_timeout)
+
+    def release_trial(self) -> None:
+        """
+        Lets another request be the trial when the trial request ended without telling
+        anything about the homeserver (i.e. it was cancelled).
+        """
+        self.trial_in_flight = False
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info("Circuit for homeserver %s closed", self.homeserver_url)
+        self.failures = 0
+        self.opened_at = None
+        self.open_for = self.reset_timeout
+        self.trial_in_flight = False
+
+    def record_failure(self, retry_after: Optional[float] = None) -> None:
+        self.failures += 1
+        self.trial_in_flight = False
+
+        if self.opened_at is None and self.failures < self.failure_threshold:
+            return None
+
+        # failures of requests that were already in flight when the circuit opened are ignored
+        if self.opened_at is None or self.state == CircuitState.HALF_OPEN:
+            self.opened_at = time.monotonic()
+            self.open_for = max(self.reset_timeout, retry_after or 0)
+            logger.warning(
+                "Circuit for homeserver %s opened for %.1fs after %d failure(s)",
+                self.homeserver_url,
+                self.open_for,
+                self.failures,
+            )
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "homeserver_url": self.homeserver_url,
+            "state": self.state.value,
+            "failures": self.failures,
+            "retry_in": round(self.retry_in(), 3),
+        }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(homeserver_url: str) -> CircuitBreaker:
+    """
+    Returns the process wide circuit breaker for a homeserver. Local and public URLs
+    of the same homeserver share a breaker.
+    """
+    key = canonical_url(homeserver_url)
+    try:
+        return _breakers[key]
+    except KeyError:
+        breaker = _breakers[key] = CircuitBreaker(key)
+        return breaker
+
+
+def circuit_breakers() -> Dict[str, Dict[str, Any]]:
+    """
+    Returns the current state of every homeserver circuit breaker.
+    """
+    return {url: breaker.snapshot() for url, breaker in _breakers.items()}
+
+
+async def call_with_retry(
+    func: Callable[[], Awaitable[_T]],
+    breaker: CircuitBreaker,
+    retries: int = 3,
+    backoff: Optional[Backoff] = None,
+    retry_on: tuple[type[BaseException], ...] = (Exception,),
+    guard: bool = True,
+) -> _T:
+    """
+    Calls ``func`` through the circuit breaker, retrying failures with jittered
+    exponential backoff. ``CircuitOpenError`` is never retried.
+
+    Calls whose requests already go through the breaker (i.e. are made with a
+    ``FractalMatrixClient``) pass ``guard=False``: they are only retried, so that a
+    half open circuit's trial request is the call's own and failures are counted once.
+    """
+    backoff = backoff or Backoff()
+    attempt = 0
+    while True:
+        trial = breaker.before_request() if guard else False
+        try:
+            result = await func()
+        except CircuitOpenError:
+            if trial:
+                breaker.release_trial()
+            raise
+        except retry_on as err:
+            if guard:
+                breaker.record_failure(getattr(err, "retry_after", None))
+            attempt += 1
+            if attempt > retries:
+                raise
+            delay = backoff.delay(attempt, getattr(err, "retry_after", None))
+            metrics.RETRIES.inc(homeserver=breaker.homeserver_url)
+            logger.warning(
+                "Retrying in %.2fs after failure (%d/%d): %s", delay, attempt, retries, err
+            )
+            await asyncio.sleep(delay)
+        except BaseException:
+            if trial:
+                breaker.release_trial()
+            raise
+        else:
+            if guard:
+                breaker.record_success()
+            return result
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+from urllib.parse import unquote
+
+from aiohttp import ClientConnectionError, ClientResponse
+from fractal.matrix import FractalAsyncClient
+
+from . import metrics, tracing
+from .circuit import Backoff, CircuitBreaker, get_circuit_breaker
+from .ratelimit import RateLimiter, classify_request, get_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+
+def _span_attributes(method: str, path: str) -> dict:
+    # the query string carries the access token, never record it
+    path = path.split("?", 1)[0]
+    attributes = {"http.method": method, "http.route": path}
+    if "/rooms/" in path:
+        attributes["room"] = unquote(path.split("/rooms/", 1)[1].split("/", 1)[0])
+    return attributes
+
+
+class FractalMatrixClient(FractalAsyncClient):
+    """
+    FractalAsyncClient whose requests go through the homeserver's rate limiter and
+    circuit breaker.
+
+    Every HTTP attempt (including nio's internal retries) is scheduled by the rate
+    limiter, checked against and recorded on the breaker, and timeouts are retried
+    with jittered exponential backoff instead of nio's fixed schedule.
+    """
+
+    def __init__(
+        self,
+        homeserver_url: str,
+        access_token: str,
+        *args,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        backoff: Optional[Backoff] = None,
+        **kwargs,
+    ):
+        super().__init__(homeserver_url, access_token, *args, **kwargs)
+        self.circuit_breaker = circuit_breaker or get_circuit_breaker(homeserver_url)
+        self.rate_limiter = rate_limiter or get_rate_limiter(homeserver_url)
+        self.backoff = backoff or Backoff()
+
+    async def get_timeout_retry_wait_time(self, got_timeouts: int) -> float:
+        return self.backoff.delay(got_timeouts)
+
+    async def send(self, method: str, path: str, *args, **kwargs) -> ClientResponse:
+        action = classify_request(method, path)
+        await self.rate_limiter.acquire(action)
+
+        trial = self.circuit_breaker.before_request()
+        start = time.perf_counter()
+        with tracing.span(
+            f"matrix {method} {action.value}", **_span_attributes(method, path)
+        ) as span:
+            try:
+                with metrics.REQUESTS_IN_FLIGHT.track_inprogress(action=action.value):
+                    resp = await super().send(method, path, *args, **kwargs)
+            except (ClientConnectionError, asyncio.TimeoutError):
+                self.circuit_breaker.record_failure()
+                metrics.REQUEST_SECONDS.observe(
+                    time.perf_counter() - start, action=action.value, status="error"
+                )
+                raise
+            except BaseException:
+                # i.e. cancelled, a half open circuit's next request has to be the trial
+                if trial:
+                    self.circuit_breaker.release_trial()
+                raise
+            span.set_attribute("http.status_code", resp.status)
+        metrics.REQUEST_SECONDS.observe(
+            time.perf_counter() - start, action=action.value, status=resp.status
+        )
+
+        if resp.status == 429:
+            retry_after = None
+            try:
+                body = await resp.json()
+                retry_after = body.get("retry_after_ms", 0) / 1000 or None
+            except Exception:
+                pass
+            self.rate_limiter.on_limited(action, retry_after)
+            self.circuit_breaker.record_failure(retry_after)
+        elif resp.status >= 500:
+            self.circuit_breaker.record_failure()
+        else:
+            self.rate_limiter.on_success(action)
+            self.circuit_breaker.record_success()
+        return resp
+
+
+@asynccontextmanager
+async def matrix_client(
+    homeserver_url: str,
+    access_token: str,
+    max_timeouts: int = 15,
+    circuit_breaker: Optional[CircuitBreaker] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+) -> AsyncIterator[FractalMatrixClient]:
+    """
+    Async context manager that yields a FractalMatrixClient and closes it on exit.
+    """
+    client = FractalMatrixClient(
+        homeserver_url,
+        access_token,
+        max_timeouts=max_timeouts,
+        circuit_breaker=circuit_breaker,
+        rate_limiter=rate_limiter,
+    )
+    try:
+        yield client
+    finally:
+        await client.close()
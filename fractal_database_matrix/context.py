@@ -0,0 +1,312 @@
+"""
+Execution context shared by the operations of a replication plan.
+
+Operations of a plan mostly run against the same channel, homeserver and credentials.
+While a context is active (see ``operation_context``), the objects operations fetch are
+loaded once and reused by every operation that follows, and ``preload`` batch loads the
+channels and instances of a list of operations up front in a query per model.
+
+Objects are cached per set of related objects they were loaded with, and the metadata an
+operation returns is mirrored onto the cached copies of its instance, the same way it is
+merged into the instance once the operation completes. Fixtures operations send as room
+state are cached as well (see ``FixtureCache``).
+"""
+
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from fractal.cli.controllers.auth import AuthenticatedController
+
+if TYPE_CHECKING:
+    from django.db.models import Model
+    from fractal_database.models import Device, DurableOperation
+
+    from fractal_database_matrix.models import (
+        MatrixCredentials,
+        MatrixHomeserver,
+        MatrixReplicationChannel,
+    )
+
+logger = logging.getLogger(__name__)
+
+# what operations need of a channel: its homeserver and database, and the homeserver's
+# credentials. Channels are always loaded with these, so a plan loads each channel once
+CHANNEL_SELECT_RELATED = ("homeserver", "database", "database__parent_db")
+CHANNEL_PREFETCH_RELATED = ("homeserver__credentials",)
+
+_current: ContextVar[Optional["OperationContext"]] = ContextVar(
+    "fractal_operation_context", default=None
+)
+
+# upper bound on the size of the fixtures cached by a context
+FIXTURE_CACHE_BYTES = int(os.environ.get("FRACTAL_MATRIX_FIXTURE_CACHE_BYTES", 16 * 1024 * 1024))
+
+_Key = Tuple[type, str, Tuple[str, ...], Tuple[str, ...]]
+_FixtureKey = Tuple[str, str, Optional[int], bool, bool]
+
+
+def _fields_digest(obj: "Model") -> str:
+    # the object's own (concrete) field values, without touching the database
+    values = [(field.attname, field.value_from_object(obj)) for field in obj._meta.concrete_fields]
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class FixtureCache:
+    """
+    LRU cache of object fixtures, keyed by (model, pk, object_version, with_relations).
+
+    Entries also remember a digest of the object's own field values, so that changes that
+    haven't bumped the version yet (a channel's metadata gets the room id of a space before
+    the space's state is sent) are serialized again rather than served stale.
+    """
+
+    def __init__(self, max_bytes: int = FIXTURE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[_FixtureKey, Tuple[str, Any, int]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes and self._entries:
+            _, (_, _, size) = self._entries.popitem(last=False)
+            self.size -= size
+
+    async def aget(
+        self, obj: "Model", json: bool = False, with_relations: bool = False
+    ) -> Union[str, List[Dict[str, Any]]]:
+        """
+        Returns ``obj.ato_fixture(json=json, with_relations=with_relations)``, serializing
+        the object at most once per version.
+        """
+        key = (
+            obj._meta.label_lower,
+            str(obj.pk),
+            getattr(obj, "object_version", None),
+            with_relations,
+            json,
+        )
+        digest = _fields_digest(obj)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == digest:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        fixture = await obj.ato_fixture(json=json, with_relations=with_relations)  # type: ignore
+        size = len(fixture) if isinstance(fixture, str) else len(repr(fixture))
+        if entry is not None:
+            self.size -= entry[2]
+            del self._entries[key]
+        if size <= self.max_bytes:
+            self._entries[key] = (digest, fixture, size)
+            self.size += size
+            self._evict()
+        return fixture
+
+
+class OperationContext:
+    """
+    Caches the objects fetched by the operations of a plan.
+    """
+
+    def __init__(self):
+        self._objects: Dict[_Key, "Model"] = {}
+        # homeserver pk -> its credentials
+        self._credentials: Dict[str, List["MatrixCredentials"]] = {}
+        self._creds: Optional[Tuple[str, str, str]] = None
+        # pks of the operations found to be satisfied already (see skip_if_satisfied)
+        self.satisfied: Set[str] = set()
+        self.fixtures = FixtureCache()
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+
+    async def _load(
+        self,
+        model: type["Model"],
+        pks: Iterable[Any],
+        select_related: Tuple[str, ...] = (),
+        prefetch_related: Tuple[str, ...] = (),
+    ) -> None:
+        pks = {str(pk) for pk in pks} - {
+            key[1]
+            for key in self._objects
+            if key[0] is model and key[2:] == (select_related, prefetch_related)
+        }
+        if not pks:
+            return None
+        queryset = model.objects.filter(pk__in=pks)
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        async for obj in queryset:
+            self._objects[(model, str(obj.pk), select_related, prefetch_related)] = obj
+
+    async def preload(self, operations: Iterable["DurableOperation"]) -> None:
+        """
+        Loads the channels (with their homeserver and credentials) and the instances of the
+        given operations, in a query per model.
+        """
+        channels: Dict[type, List[Any]] = defaultdict(list)
+        instances: Dict[type, List[Any]] = defaultdict(list)
+        for operation in operations:
+            channels[operation.channel_type.model_class()].append(operation.channel_id)
+            instances[operation.content_type.model_class()].append(operation.object_id)
+
+        for model, pks in channels.items():
+            await self._load(model, pks, CHANNEL_SELECT_RELATED, CHANNEL_PREFETCH_RELATED)
+        for model, pks in instances.items():
+            await self._load(model, pks)
+
+    async def aget(
+        self,
+        model: type["Model"],
+        pk: Any,
+        select_related: Tuple[str, ...] = (),
+        prefetch_related: Tuple[str, ...] = (),
+    ) -> "Model":
+        """
+        Returns the object, loading it with the given related objects if it isn't cached.
+        """
+        key = (model, str(pk), tuple(select_related), tuple(prefetch_related))
+        try:
+            obj = self._objects[key]
+            self.hits += 1
+            return obj
+        except KeyError:
+            self.misses += 1
+
+        await self._load(model, [pk], key[2], key[3])
+        try:
+            return self._objects[key]
+        except KeyError:
+            raise model.DoesNotExist(f"{model.__name__} matching query does not exist.")
+
+    async def aget_channel(self, operation: "DurableOperation") -> "MatrixReplicationChannel":
+        return await self.aget(  # type: ignore
+            operation.channel_type.model_class(),
+            operation.channel_id,
+            CHANNEL_SELECT_RELATED,
+            CHANNEL_PREFETCH_RELATED,
+        )
+
+    async def aget_instance(
+        self,
+        operation: "DurableOperation",
+        select_related: Tuple[str, ...] = (),
+        prefetch_related: Tuple[str, ...] = (),
+    ) -> "Model":
+        return await self.aget(
+            operation.content_type.model_class(),
+            operation.object_id,
+            select_related,
+            prefetch_related,
+        )
+
+    async def aget_device_credentials(
+        self, homeserver: "MatrixHomeserver", device: "Device"
+    ) -> Optional["MatrixCredentials"]:
+        """
+        Returns the device's credentials for the homeserver. All of the homeserver's
+        credentials are loaded at once.
+        """
+        from fractal_database_matrix.models import MatrixCredentials
+
+        key = str(homeserver.pk)
+        if key not in self._credentials:
+            self._credentials[key] = [
+                creds
+                async for creds in MatrixCredentials.objects.filter(
+                    homeserver_id=homeserver.pk
+                ).order_by("pk")
+            ]
+        for creds in self._credentials[key]:
+            if str(creds.device_id) == str(device.pk):
+                return creds
+
+        # the device may have been registered by an earlier operation of the plan
+        creds = await MatrixCredentials.objects.filter(
+            homeserver_id=homeserver.pk, device_id=device.pk
+        ).afirst()
+        if creds is not None:
+            self._credentials[key].append(creds)
+        return creds
+
+    def get_creds(self) -> Optional[Tuple[str, str, str]]:
+        """
+        Returns the logged in user's (access token, homeserver url, matrix id).
+        """
+        if self._creds is None:
+            self._creds = AuthenticatedController.get_creds()
+        return self._creds
+
+    def mirror_metadata(self, operation: "DurableOperation", metadata: Dict[str, Any]) -> None:
+        """
+        Applies the metadata returned by an operation to the cached copies of its instance.
+        """
+        model = operation.content_type.model_class()
+        pk = str(operation.object_id)
+        for key, obj in self._objects.items():
+            if key[0] is model and key[1] == pk and isinstance(obj.metadata, dict):
+                obj.metadata.update(metadata)
+
+
+def current_context() -> OperationContext:
+    """
+    Returns the active context, or a fresh one that only lives as long as the caller
+    holds on to it.
+    """
+    return _current.get() or OperationContext()
+
+
+@asynccontextmanager
+async def operation_context(
+    operations: Optional[Iterable["DurableOperation"]] = None,
+) -> AsyncIterator[OperationContext]:
+    """
+    Activates an operation context for the operations run inside the block. Nested blocks
+    share the outermost context.
+    """
+    context = _current.get()
+    if context is not None:
+        if operations is not None:
+            await context.preload(operations)
+        yield context
+        return
+
+    context = OperationContext()
+    if operations is not None:
+        await context.preload(operations)
+    token = _current.set(context)
+    try:
+        yield context
+    finally:
+        _current.reset(token)
+        logger.debug(
+            "Operation context done: %d cache hit(s), %d miss(es), %d fixture(s) reused",
+            context.hits,
+            context.misses,
+            context.fixtures.hits,
+        )
+        if context.skipped:
+            logger.info("Skipped %d already satisfied operation(s)", context.skipped)
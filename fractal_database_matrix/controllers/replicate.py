@@ -22,6 +22,8 @@ class ReplicationController(AuthenticatedController):
         confirm: bool = False,
         set_as_origin: bool = False,
         local_url: Optional[str] = None,
+        parallel: bool = False,
+        workers: int = 4,
         **kwargs,
     ):
         """
@@ -32,6 +34,8 @@ class ReplicationController(AuthenticatedController):
             confirm: Consent to replicating your data to the provided homeserver.
             set_as_origin: Set the homeserver as your current database's origin.
             local_url: Local URL for the homeserver (prefer using this url for faster replication).
+            parallel: Replicate your databases concurrently. Interrupted runs resume where they stopped.
+            workers: Number of databases replicated at once when replicating in parallel.
         """
         if not confirm:
             res = input(
@@ -107,6 +111,10 @@ class ReplicationController(AuthenticatedController):
 
         # fetch all of the groups (excluding the current database since it already has a primary target)
         databases = Database.objects.exclude(pk=current_database.pk)
+        if parallel:
+            self._replicate_in_parallel(databases, homeserver, workers)
+            return None
+
         with transaction.atomic():
             for database in databases:
                 database.set_origin_channel(current_db_matrix_channel)
@@ -132,5 +140,56 @@ class ReplicationController(AuthenticatedController):
                         # this replicates any existing data in the group to the new target
                         matrix_channel.replay_replication_logs_from(local_channel)
 
+    @cli_method
+    def status(self, json: bool = False, **kwargs):
+        """
+        Show how far behind this device's replication is.
+        ---
+        Args:
+            json: Print the raw status as JSON.
+        """
+        import json as jsonlib
+        import time
+
+        from fractal_database_matrix.lag import read_status
+
+        status = read_status()
+        if status is None:
+            print("No replication status found. Is this device replicating?")
+            exit(1)
+
+        if json:
+            print(jsonlib.dumps(status, indent=2))
+            return None
+
+        age = time.time() - status["updated"] / 1000
+        print(f"Status updated {age:.0f}s ago")
+        print(f"{'ROOM':<45} {'ORIGIN DEVICE':<20} {'LAG':>10} {'BACKLOG':>8} {'APPLIED':>8}")
+        for stream in sorted(status["streams"], key=lambda stream: -stream["lag"]):
+            print(
+                f"{stream['room']:<45} {stream['origin_device']:<20}"
+                f" {stream['lag']:>9.1f}s {stream['backlog']:>8} {stream['applied']:>8}"
+            )
+
+    def _replicate_in_parallel(self, databases, homeserver, workers: int) -> None:
+        from fractal_database_matrix.replication import replicate_databases
+
+        reports = replicate_databases(databases, homeserver, workers=workers)
+        failed = False
+        for report in reports:
+            if "error" in report:
+                failed = True
+                print(f"Failed to replicate {report['database']}: {report['error']}")
+                continue
+            rate = report["replayed"] / report["seconds"] if report["seconds"] else 0
+            print(
+                f"Replicated {report['database']}: {report['replayed']} log(s) in"
+                f" {report['seconds']:.2f}s ({rate:.1f} logs/s)"
+            )
+
+        if failed:
+            print("Run the command again to resume replicating the remaining databases.")
+            exit(1)
+
 
 Controller = ReplicationController
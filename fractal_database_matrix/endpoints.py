@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# endpoints that are probed (in order) to determine if a homeserver url is reachable
+PROBE_PATHS = ("/_matrix/client/versions", "/health")
+
+
+class Endpoint:
+    """
+    A single URL that a homeserver can be reached at along with the
+    result of the last probe against it.
+    """
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.reachable: Optional[bool] = None
+        self.latency: Optional[float] = None
+        self.checked_at: Optional[float] = None
+
+    def __repr__(self) -> str:
+        return f"Endpoint(url={self.url}, reachable={self.reachable}, latency={self.latency})"
+
+
+class EndpointSelector:
+    """
+    Selects the lowest latency reachable URL for a homeserver.
+
+    Both the homeserver's ``local_url`` and its public ``url`` are probed. Probe
+    results are cached for ``PROBE_TTL`` seconds. Once the cache is stale the cached
+    selection keeps being returned while a probe refreshes it in the background.
+    """
+
+    PROBE_TTL = 30
+    PROBE_TIMEOUT = 3
+
+    def __init__(self, url: str, local_url: Optional[str] = None):
+        self.url = url.rstrip("/")
+        self.endpoints: Dict[str, Endpoint] = {}
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.set_local_url(local_url)
+
+    def set_local_url(self, local_url: Optional[str]) -> None:
+        """
+        Updates the candidate endpoints for this homeserver.
+        """
+        urls = [self.url]
+        if local_url:
+            urls.insert(0, local_url.rstrip("/"))
+
+        self.endpoints = {url: self.endpoints.get(url) or Endpoint(url) for url in urls}
+
+    @property
+    def probed(self) -> bool:
+        return all(endpoint.checked_at is not None for endpoint in self.endpoints.values())
+
+    @property
+    def stale(self) -> bool:
+        now = time.monotonic()
+        return any(
+            endpoint.checked_at is None or now - endpoint.checked_at > self.PROBE_TTL
+            for endpoint in self.endpoints.values()
+        )
+
+    async def _probe_endpoint(self, session: aiohttp.ClientSession, endpoint: Endpoint) -> None:
+        for path in PROBE_PATHS:
+            start = time.monotonic()
+            try:
+                async with session.get(f"{endpoint.url}{path}") as resp:
+                    if resp.status != 200:
+                        continue
+                    endpoint.latency = time.monotonic() - start
+                    endpoint.reachable = True
+                    break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                logger.debug("Failed to probe %s%s: %s", endpoint.url, path, err)
+        else:
+            endpoint.latency = None
+            endpoint.reachable = False
+
+        endpoint.checked_at = time.monotonic()
+
+    async def probe(self) -> List[Endpoint]:
+        """
+        Probes every candidate endpoint concurrently.
+
+        Returns:
+            The candidate endpoints with their updated probe results.
+        """
+        timeout = aiohttp.ClientTimeout(total=self.PROBE_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            await asyncio.gather(
+                *[self._probe_endpoint(session, endpoint) for endpoint in self.endpoints.values()]
+            )
+
+        logger.debug("Probed endpoints for %s: %s", self.url, list(self.endpoints.values()))
+        return list(self.endpoints.values())
+
+    def _refresh_in_background(self) -> None:
+        loop = asyncio.get_running_loop()
+        if (
+            self._refresh_task
+            and not self._refresh_task.done()
+            and self._refresh_task.get_loop() is loop
+        ):
+            return None
+        self._refresh_task = loop.create_task(self.probe())
+
+    def best(self) -> str:
+        """
+        Returns the lowest latency reachable URL from the cached probe results.
+        Falls back to the local URL (if one is configured) or the public URL when
+        no endpoint is known to be reachable.
+        """
+        reachable = [
+            endpoint
+            for endpoint in self.endpoints.values()
+            if endpoint.reachable and endpoint.latency is not None
+        ]
+        if reachable:
+            return min(reachable, key=lambda endpoint: endpoint.latency).url  # type: ignore
+
+        # nothing is known to be reachable, prefer anything that hasn't been marked down
+        for endpoint in self.endpoints.values():
+            if endpoint.reachable is not False:
+                return endpoint.url
+        return next(iter(self.endpoints))
+
+    async def select(self) -> str:
+        """
+        Returns the URL that requests to this homeserver should be made against.
+        """
+        if not self.probed:
+            await self.probe()
+        elif self.stale:
+            self._refresh_in_background()
+
+        return self.best()
+
+    def mark_unreachable(self, url: str) -> None:
+        """
+        Marks the given URL as unreachable so that the next selection falls back to
+        another endpoint. A probe is scheduled to find out when it comes back up.
+        """
+        endpoint = self.endpoints.get(url.rstrip("/"))
+        if not endpoint:
+            return None
+
+        logger.warning("Homeserver endpoint %s is unreachable", endpoint.url)
+        endpoint.reachable = False
+        endpoint.checked_at = time.monotonic()
+        try:
+            self._refresh_in_background()
+        except RuntimeError:
+            # no running event loop, the next stale selection will reprobe
+            pass
+
+
+_selectors: Dict[str, EndpointSelector] = {}
+
+
+def get_endpoint_selector(url: str, local_url: Optional[str] = None) -> EndpointSelector:
+    """
+    Returns the process wide endpoint selector for the homeserver with the provided url.
+    """
+    key = url.rstrip("/")
+    try:
+        selector = _selectors[key]
+    except KeyError:
+        selector = _selectors[key] = EndpointSelector(url, local_url=local_url)
+    else:
+        selector.set_local_url(local_url)
+    return selector
+
+
+def canonical_url(url: str) -> str:
+    """
+    Returns the public URL of the homeserver that the provided URL (local or public) belongs to.
+    """
+    url = url.rstrip("/")
+    for selector in _selectors.values():
+        if url in selector.endpoints:
+            return selector.url
+    return url
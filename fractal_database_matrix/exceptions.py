@@ -2,3 +2,16 @@ class MatrixHomeserverAlreadyExists(Exception):
     def __init__(self, homeserver_url: str):
         self.homeserver_url = homeserver_url
         super().__init__(f"Matrix homeserver with URL {homeserver_url} already exists.")
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, homeserver_url: str, retry_in: float):
+        self.homeserver_url = homeserver_url
+        self.retry_in = retry_in
+        super().__init__(
+            f"Circuit breaker for homeserver {homeserver_url} is open. Retry in {retry_in:.1f}s."
+        )
+
+
+class InvalidReplicationFilter(Exception):
+    pass
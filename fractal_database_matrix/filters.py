@@ -0,0 +1,161 @@
+"""
+Replication filters.
+
+A channel's ``filter`` selects which serialized objects are replicated through it. The
+filter is either a JSON object or the dotted path of a callable that returns one
+(useful when the spec doesn't fit in the field):
+
+    {
+        "models": ["fractal_database.device", "fractal_database.database*"],
+        "exclude_models": ["fractal_database.snapshot"],
+        "fields": {"fractal_database.device": {"name__startswith": "phone"}},
+        "databases": ["<database pk>"]
+    }
+
+* ``models`` / ``exclude_models``: model labels, ``*`` matches any suffix.
+* ``fields``: per model label, field lookups that must all match. Supported lookups are
+  ``exact`` (the default), ``ne``, ``in``, ``startswith``, ``contains``, ``isnull``,
+  ``gt``, ``gte``, ``lt`` and ``lte``.
+* ``databases``: only objects belonging to one of these databases (through a
+  ``database`` field, or the database itself) are replicated. Objects that don't
+  belong to a database are always replicated.
+
+Filters are compiled once and cached, evaluating them is a few dict lookups per object.
+"""
+
+import importlib
+import json
+import logging
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from .exceptions import InvalidReplicationFilter
+
+logger = logging.getLogger(__name__)
+
+_LOOKUPS: Dict[str, Callable[[Any, Any], bool]] = {
+    "exact": lambda value, arg: value == arg,
+    "ne": lambda value, arg: value != arg,
+    "in": lambda value, arg: value in arg,
+    "startswith": lambda value, arg: isinstance(value, str) and value.startswith(arg),
+    "contains": lambda value, arg: value is not None and arg in value,
+    "isnull": lambda value, arg: (value is None) == bool(arg),
+    "gt": lambda value, arg: value is not None and value > arg,
+    "gte": lambda value, arg: value is not None and value >= arg,
+    "lt": lambda value, arg: value is not None and value < arg,
+    "lte": lambda value, arg: value is not None and value <= arg,
+}
+
+
+def _compile_labels(labels: Iterable[str]) -> Callable[[str], bool]:
+    labels = [label.lower() for label in labels]
+    exact = {label for label in labels if not label.endswith("*")}
+    prefixes = tuple(label[:-1] for label in labels if label.endswith("*"))
+    return lambda model: model in exact or (bool(prefixes) and model.startswith(prefixes))
+
+
+def _compile_predicates(lookups: Dict[str, Any]) -> Callable[[Dict[str, Any]], bool]:
+    predicates = []
+    for key, arg in lookups.items():
+        field, _, lookup = key.partition("__")
+        lookup = lookup or "exact"
+        try:
+            compare = _LOOKUPS[lookup]
+        except KeyError:
+            raise InvalidReplicationFilter(f"Unsupported lookup {lookup} in {key}")
+        if lookup == "in":
+            arg = set(arg)
+        predicates.append((field, compare, arg))
+
+    def matches(item: Dict[str, Any]) -> bool:
+        fields = item.get("fields", {})
+        for field, compare, arg in predicates:
+            value = item.get("pk") if field == "pk" else fields.get(field)
+            try:
+                if not compare(value, arg):
+                    return False
+            except TypeError:
+                return False
+        return True
+
+    return matches
+
+
+class ReplicationFilter:
+    """
+    A compiled replication filter. Operates on serialized (fixture) objects.
+    """
+
+    def __init__(self, spec: Dict[str, Any]):
+        if not isinstance(spec, dict):
+            raise InvalidReplicationFilter("Replication filter must be a JSON object")
+        unknown = set(spec) - {"models", "exclude_models", "fields", "databases"}
+        if unknown:
+            raise InvalidReplicationFilter(f"Unknown replication filter keys: {sorted(unknown)}")
+
+        self.spec = spec
+        self._include = _compile_labels(spec["models"]) if spec.get("models") else None
+        self._exclude = (
+            _compile_labels(spec["exclude_models"]) if spec.get("exclude_models") else None
+        )
+        self._fields = {
+            label.lower(): _compile_predicates(lookups)
+            for label, lookups in (spec.get("fields") or {}).items()
+        }
+        self._databases = (
+            {str(pk) for pk in spec["databases"]} if spec.get("databases") else None
+        )
+
+    def matches(self, item: Dict[str, Any]) -> bool:
+        model = str(item.get("model", "")).lower()
+        if self._include and not self._include(model):
+            return False
+        if self._exclude and self._exclude(model):
+            return False
+
+        predicate = self._fields.get(model)
+        if predicate and not predicate(item):
+            return False
+
+        if self._databases is not None:
+            fields = item.get("fields", {})
+            if "database" in fields:
+                return str(fields["database"]) in self._databases
+            if model.endswith(".database"):
+                return str(item.get("pk")) in self._databases
+        return True
+
+    def apply(self, objects: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [item for item in objects if self.matches(item)]
+
+
+_compiled: Dict[str, Optional[ReplicationFilter]] = {}
+
+
+def _load_spec(filter: str) -> Dict[str, Any]:
+    filter = filter.strip()
+    if filter.startswith("{"):
+        try:
+            return json.loads(filter)
+        except json.JSONDecodeError as e:
+            raise InvalidReplicationFilter(f"Invalid replication filter JSON: {e}")
+
+    # dotted path to a callable that returns the spec
+    module_name, _, attr = filter.rpartition(".")
+    try:
+        spec = getattr(importlib.import_module(module_name), attr)
+    except (ImportError, AttributeError, ValueError) as e:
+        raise InvalidReplicationFilter(f"Failed to load replication filter {filter}: {e}")
+    return spec() if callable(spec) else spec
+
+
+def compile_filter(filter: Optional[str]) -> Optional[ReplicationFilter]:
+    """
+    Compiles (and caches) a channel filter. Returns None when there is nothing to filter.
+    """
+    if not filter or not filter.strip():
+        return None
+    try:
+        return _compiled[filter]
+    except KeyError:
+        compiled = _compiled[filter] = ReplicationFilter(_load_spec(filter))
+        return compiled
@@ -0,0 +1,287 @@
+"""
+End-to-end replication lag.
+
+``push_replication_log`` labels every replication task with the time it was pushed
+(``origin_ts``, in milliseconds), a sequence number that only ever increases on the
+pushing device (``seq``) and the name of that device (``origin_device``).
+
+On the receiving end ``ReplicationQueue`` records when each replication task arrives
+and ``LagMiddleware`` when it has been applied, which gives push -> receive and
+receive -> apply latencies per device room and origin device (exported as histograms
+when metrics are enabled). ``TRACKER`` keeps the current lag and the backlog of
+received but not yet applied tasks, and periodically writes them to a status file so
+that ``fractal replicate status`` (or ``read_status``) can report them from another
+process. Every worker process writes its own status file, ``read_status`` merges them.
+"""
+
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from fractal.cli import FRACTAL_DATA_DIR
+from taskiq import TaskiqMessage, TaskiqMiddleware, TaskiqResult
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+ORIGIN_TS_LABEL = "origin_ts"
+SEQ_LABEL = "seq"
+ORIGIN_DEVICE_LABEL = "origin_device"
+RECEIVED_TS_LABEL = "received_ts"
+
+STATUS_FILE = os.environ.get("FRACTAL_REPLICATION_STATUS_FILE") or os.path.join(
+    FRACTAL_DATA_DIR, "replication_status.json"
+)
+# minimum number of seconds between two writes of the status file
+STATUS_INTERVAL = float(os.environ.get("FRACTAL_REPLICATION_STATUS_INTERVAL", 1))
+
+
+def process_status_file(path: str, pid: Optional[int] = None) -> str:
+    """
+    Returns the status file a process writes, i.e. replication_status.<pid>.json.
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}.{pid or os.getpid()}{ext}"
+
+
+_seq_lock = threading.Lock()
+_last_seq = 0
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def next_seq() -> int:
+    """
+    Returns the next sequence number of this device. Sequence numbers are microsecond
+    timestamps bumped when needed, so they keep increasing across restarts.
+    """
+    global _last_seq
+    with _seq_lock:
+        _last_seq = max(_last_seq + 1, time.time_ns() // 1000)
+        return _last_seq
+
+
+def origin_labels(origin_device: str) -> Dict[str, Any]:
+    """
+    Returns the labels ``push_replication_log`` adds to a replication task.
+    """
+    return {
+        ORIGIN_TS_LABEL: now_ms(),
+        SEQ_LABEL: next_seq(),
+        ORIGIN_DEVICE_LABEL: origin_device,
+    }
+
+
+def int_label(labels: Dict[str, Any], label: str) -> Optional[int]:
+    """
+    Returns the integer value of a label, or None if it's missing or invalid. Taskiq's
+    kicker turns every label into a string, so received labels have to be parsed.
+    """
+    try:
+        return int(labels[label])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+_Key = Tuple[str, str]
+
+
+class LagTracker:
+    """
+    Current lag and backlog per (device room, origin device).
+    """
+
+    def __init__(self, path: Optional[str] = STATUS_FILE, interval: float = STATUS_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._lock = threading.Lock()
+        # task id -> (key, origin_ts) of the tasks received but not applied yet
+        self._pending: Dict[str, Tuple[_Key, int]] = {}
+        self._streams: Dict[_Key, Dict[str, Any]] = {}
+        self._written = 0.0
+
+    def _stream(self, key: _Key) -> Dict[str, Any]:
+        return self._streams.setdefault(
+            key,
+            {"room": key[0], "origin_device": key[1], "last_seq": 0, "applied": 0},
+        )
+
+    def received(self, task_id: str, room_id: str, labels: Dict[str, Any]) -> None:
+        """
+        Records the arrival of a replication task. Returns right away for tasks pushed
+        without (valid) origin labels, and for tasks that were already received.
+        """
+        origin_ts = int_label(labels, ORIGIN_TS_LABEL)
+        if origin_ts is None or task_id in self._pending:
+            return None
+
+        received_ts = now_ms()
+        labels[RECEIVED_TS_LABEL] = received_ts
+        origin_device = str(labels.get(ORIGIN_DEVICE_LABEL, ""))
+        key = (room_id, origin_device)
+        with self._lock:
+            self._pending[task_id] = (key, origin_ts)
+            self._stream(key)["last_received_ts"] = received_ts
+
+        metrics.REPLICATION_RECEIVE_LAG_SECONDS.observe(
+            max(received_ts - origin_ts, 0) / 1000, room=room_id, origin_device=origin_device
+        )
+        self.write()
+
+    def applied(self, task_id: str, labels: Dict[str, Any]) -> None:
+        """
+        Records that a replication task has been applied.
+        """
+        received_ts = int_label(labels, RECEIVED_TS_LABEL)
+        with self._lock:
+            pending = self._pending.pop(task_id, None)
+            if pending is None:
+                return None
+            key, origin_ts = pending
+            applied_ts = now_ms()
+            stream = self._stream(key)
+            stream["applied"] += 1
+            stream["last_seq"] = max(stream["last_seq"], int_label(labels, SEQ_LABEL) or 0)
+            stream["last_origin_ts"] = origin_ts
+            stream["last_applied_ts"] = applied_ts
+
+        if received_ts is not None:
+            metrics.REPLICATION_APPLY_LAG_SECONDS.observe(
+                max(applied_ts - received_ts, 0) / 1000, room=key[0], origin_device=key[1]
+            )
+        self.write()
+
+    def discard(self, task_id: str) -> None:
+        """
+        Forgets a received task that won't be applied here (i.e. acked in the meantime).
+        """
+        with self._lock:
+            self._pending.pop(task_id, None)
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Returns the lag (seconds between the oldest pending task being pushed and now, or
+        between the last applied task being pushed and applied) and the backlog of every
+        device room and origin device.
+        """
+        now = now_ms()
+        with self._lock:
+            oldest: Dict[_Key, int] = {}
+            backlog: Dict[_Key, int] = {}
+            for key, origin_ts in self._pending.values():
+                backlog[key] = backlog.get(key, 0) + 1
+                oldest[key] = min(oldest.get(key, origin_ts), origin_ts)
+
+            streams = []
+            for key, stream in self._streams.items():
+                if key in oldest:
+                    lag = now - oldest[key]
+                elif "last_applied_ts" in stream:
+                    lag = stream["last_applied_ts"] - stream["last_origin_ts"]
+                else:
+                    lag = 0
+                streams.append({**stream, "backlog": backlog.get(key, 0), "lag": lag / 1000})
+        return {"updated": now, "streams": streams}
+
+    def write(self, force: bool = False) -> None:
+        """
+        Writes the status file, at most once every ``interval`` seconds unless forced.
+        """
+        if not self.path:
+            return None
+        now = time.monotonic()
+        if not force and now - self._written < self.interval:
+            return None
+        self._written = now
+        # worker processes are forked after the tracker is created, so the pid is only
+        # known here
+        path = process_status_file(self.path)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.status(), f)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning("Failed to write replication status to %s: %s", path, e)
+
+
+TRACKER = LagTracker()
+
+
+def _running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merge_status(statuses: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Merges the statuses of several processes into one: backlogs and applied counts are
+    added up, and every stream gets the highest lag and sequence number reported for it.
+    """
+    streams: Dict[_Key, Dict[str, Any]] = {}
+    for status in statuses:
+        for stream in status["streams"]:
+            key = (stream["room"], stream["origin_device"])
+            merged = streams.get(key)
+            if merged is None:
+                streams[key] = dict(stream)
+                continue
+            for field, value in stream.items():
+                if field in ("backlog", "applied"):
+                    merged[field] = merged.get(field, 0) + value
+                elif field not in ("room", "origin_device"):
+                    merged[field] = max(merged.get(field, value), value)
+    return {
+        "updated": max(status["updated"] for status in statuses),
+        "streams": list(streams.values()),
+    }
+
+
+def read_status(path: str = STATUS_FILE) -> Optional[Dict[str, Any]]:
+    """
+    Returns the status last written by the running replicating processes, merged, or None
+    if there isn't one. Status files left behind by processes that are gone are removed.
+    """
+    root, ext = os.path.splitext(path)
+    statuses = []
+    for filename in glob.glob(f"{glob.escape(root)}.*{ext}"):
+        pid = filename[len(root) + 1 : len(filename) - len(ext)]
+        if not pid.isdigit():
+            continue
+        if not _running(int(pid)):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(filename) as f:
+                statuses.append(json.load(f))
+        except (FileNotFoundError, ValueError):
+            # removed, or being replaced, in the meantime
+            continue
+    if not statuses:
+        return None
+    return merge_status(statuses)
+
+
+class LagMiddleware(TaskiqMiddleware):
+    """
+    Records when replication tasks have been applied.
+    """
+
+    def post_execute(self, message: TaskiqMessage, result: TaskiqResult) -> None:
+        TRACKER.applied(message.task_id, message.labels)
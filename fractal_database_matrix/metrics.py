@@ -0,0 +1,394 @@
+"""
+Lightweight in-process metrics for replication.
+
+Metrics are disabled by default and every recording call returns immediately while
+they are. Enable them with the ``FRACTAL_MATRIX_METRICS`` setting or environment
+variable (or by calling ``enable()``), then render them with ``export("prometheus")``
+or ``export("json")``. Additional exporters can be added with ``register_exporter``.
+Setting ``FRACTAL_MATRIX_METRICS_FILE`` dumps the metrics to that file on exit.
+"""
+
+import json
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+_enabled = os.environ.get("FRACTAL_MATRIX_METRICS", "").lower() in ("1", "true", "yes")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# replication lag goes from sub-second to hours for devices that were offline
+LAG_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0, 21600.0, 86400.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def enable() -> None:
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+class _NullTimer:
+    """
+    Timer returned while metrics are disabled so that ``with metric.time():`` costs nothing.
+    """
+
+    def __enter__(self) -> "_NullTimer":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        return None
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, description: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        raise NotImplementedError
+
+    def reset(self) -> None:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        if not _enabled:
+            return None
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        return [
+            (self.name, dict(zip(self.labelnames, key)), value)
+            for key, value in self.values.items()
+        ]
+
+    def reset(self) -> None:
+        self.values.clear()
+
+
+class _GaugeTracker:
+    def __init__(self, gauge: "Gauge", labels: Dict[str, Any]):
+        self.gauge = gauge
+        self.labels = labels
+
+    def __enter__(self) -> "_GaugeTracker":
+        self.gauge.inc(**self.labels)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.gauge.dec(**self.labels)
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount: float = 1, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: Any) -> None:
+        if not _enabled:
+            return None
+        self.values[self._key(labels)] = value
+
+    def track_inprogress(self, **labels: Any):
+        """
+        Context manager that counts the wrapped block as in flight while it runs.
+        """
+        if not _enabled:
+            return _NULL_TIMER
+        return _GaugeTracker(self, labels)
+
+
+class _HistogramTimer:
+    def __init__(self, histogram: "Histogram", labels: Dict[str, Any]):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self) -> "_HistogramTimer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Iterable[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> (bucket counts, sum, count)
+        self.values: Dict[LabelValues, List[Any]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        if not _enabled:
+            return None
+        key = self._key(labels)
+        try:
+            counts, _, _ = entry = self.values[key]
+        except KeyError:
+            counts = [0] * len(self.buckets)
+            entry = self.values[key] = [counts, 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def time(self, **labels: Any):
+        """
+        Context manager that observes the wrapped block's duration in seconds.
+        """
+        if not _enabled:
+            return _NULL_TIMER
+        return _HistogramTimer(self, labels)
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        samples = []
+        for key, (counts, total, count) in self.values.items():
+            labels = dict(zip(self.labelnames, key))
+            for bound, bucket_count in zip(self.buckets, counts):
+                samples.append(
+                    (f"{self.name}_bucket", {**labels, "le": str(bound)}, bucket_count)
+                )
+            samples.append((f"{self.name}_bucket", {**labels, "le": "+Inf"}, count))
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+    def reset(self) -> None:
+        self.values.clear()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def _get_or_create(self, cls: type, name: str, description: str, labelnames, **kwargs):
+        try:
+            metric = self.metrics[name]
+        except KeyError:
+            metric = self.metrics[name] = cls(name, description, labelnames, **kwargs)
+            return metric
+        if not isinstance(metric, cls):
+            raise Exception(f"Metric {name} is already registered as a {metric.type}")
+        return metric
+
+    def counter(self, name: str, description: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, description, labelnames)
+
+    def gauge(self, name: str, description: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, description, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        description: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._get_or_create(Histogram, name, description, labelnames, buckets=buckets)
+
+    def reset(self) -> None:
+        for metric in self.metrics.values():
+            metric.reset()
+
+
+REGISTRY = Registry()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def prometheus_exporter(registry: Registry) -> str:
+    """
+    Renders the registry in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in registry.metrics.values():
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, labels, value in metric.samples():
+            if labels:
+                rendered = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                lines.append(f"{name}{{{rendered}}} {value}")
+            else:
+                lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def json_exporter(registry: Registry) -> str:
+    """
+    Renders the registry as a JSON document.
+    """
+    return json.dumps(
+        {
+            metric.name: {
+                "type": metric.type,
+                "description": metric.description,
+                "samples": [
+                    {"name": name, "labels": labels, "value": value}
+                    for name, labels, value in metric.samples()
+                ],
+            }
+            for metric in registry.metrics.values()
+        },
+        indent=2,
+    )
+
+
+_exporters: Dict[str, Callable[[Registry], str]] = {
+    "prometheus": prometheus_exporter,
+    "json": json_exporter,
+}
+
+
+def register_exporter(name: str, exporter: Callable[[Registry], str]) -> None:
+    _exporters[name] = exporter
+
+
+def export(format: str = "prometheus", registry: Optional[Registry] = None) -> str:
+    try:
+        exporter = _exporters[format]
+    except KeyError:
+        raise Exception(f"Unknown metrics format {format}. Choose one of {list(_exporters)}")
+    return exporter(registry or REGISTRY)
+
+
+def dump(path: str, format: Optional[str] = None, registry: Optional[Registry] = None) -> None:
+    """
+    Writes the exported metrics to ``path``. The format defaults to JSON for ``.json`` files
+    and Prometheus text otherwise.
+    """
+    format = format or ("json" if path.endswith(".json") else "prometheus")
+    with open(path, "w") as f:
+        f.write(export(format, registry))
+
+
+# replication metrics
+EVENTS_PUSHED = REGISTRY.counter(
+    "fractal_replication_events_pushed_total", "Replication events pushed", ["channel"]
+)
+FIXTURES_PUSHED = REGISTRY.counter(
+    "fractal_replication_fixtures_pushed_total", "Fixture objects pushed", ["channel"]
+)
+FIXTURES_FILTERED = REGISTRY.counter(
+    "fractal_replication_fixtures_filtered_total",
+    "Fixture objects dropped by replication filters",
+    ["channel"],
+)
+PUSH_SECONDS = REGISTRY.histogram(
+    "fractal_replication_push_seconds", "Time spent in push_replication_log", ["channel"]
+)
+KICK_SECONDS = REGISTRY.histogram(
+    "fractal_matrix_kick_seconds", "Time spent kicking a task (including retries)", ["task"]
+)
+KICKS_IN_FLIGHT = REGISTRY.gauge("fractal_matrix_kicks_in_flight", "Tasks being kicked")
+RETRIES = REGISTRY.counter(
+    "fractal_matrix_retries_total", "Retried homeserver calls", ["homeserver"]
+)
+SYNC_SECONDS = REGISTRY.histogram(
+    "fractal_replication_sync_seconds", "Time spent fetching unacked tasks", ["queue"]
+)
+TASKS_RECEIVED = REGISTRY.counter(
+    "fractal_replication_tasks_received_total", "Unacked tasks received", ["queue"]
+)
+FIXTURES_PRUNED = REGISTRY.counter(
+    "fractal_replication_fixtures_pruned_total", "Outdated fixture objects pruned"
+)
+PRUNE_SECONDS = REGISTRY.histogram(
+    "fractal_replication_prune_seconds", "Time spent pruning outdated fixture objects"
+)
+ACKS_SENT = REGISTRY.counter("fractal_replication_acks_sent_total", "Task acks sent", ["queue"])
+OPERATION_SECONDS = REGISTRY.histogram(
+    "fractal_matrix_operation_seconds", "Durable operation run time", ["operation", "status"]
+)
+OPERATIONS_IN_FLIGHT = REGISTRY.gauge(
+    "fractal_matrix_operations_in_flight", "Durable operations running", ["operation"]
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "fractal_matrix_request_seconds", "Matrix HTTP request time", ["action", "status"]
+)
+REQUESTS_IN_FLIGHT = REGISTRY.gauge(
+    "fractal_matrix_requests_in_flight", "Matrix HTTP requests in flight", ["action"]
+)
+OPERATIONS_SKIPPED = REGISTRY.counter(
+    "fractal_matrix_operations_skipped_total",
+    "Durable operations skipped because they were already satisfied",
+    ["operation"],
+)
+REPLICATION_RECEIVE_LAG_SECONDS = REGISTRY.histogram(
+    "fractal_replication_receive_lag_seconds",
+    "Time between a replication event being pushed and received",
+    ["room", "origin_device"],
+    buckets=LAG_BUCKETS,
+)
+REPLICATION_APPLY_LAG_SECONDS = REGISTRY.histogram(
+    "fractal_replication_apply_lag_seconds",
+    "Time between a replication event being received and applied",
+    ["room", "origin_device"],
+    buckets=LAG_BUCKETS,
+)
+OUTBOX_ENQUEUED = REGISTRY.counter(
+    "fractal_replication_outbox_enqueued_total",
+    "Replication events written to the outbox",
+    ["channel"],
+)
+OUTBOX_SENT = REGISTRY.counter(
+    "fractal_replication_outbox_sent_total",
+    "Replication events sent from the outbox",
+    ["channel"],
+)
+OUTBOX_SUPERSEDED = REGISTRY.counter(
+    "fractal_replication_outbox_superseded_total",
+    "Objects dropped from the outbox because a newer version was enqueued",
+    ["channel"],
+)
+RESULTS_SENT = REGISTRY.counter(
+    "fractal_matrix_results_sent_total", "Task result events sent to the room"
+)
+RESULTS_SKIPPED = REGISTRY.counter(
+    "fractal_matrix_results_skipped_total",
+    "Task results not sent because the task was kicked without a result",
+)
+RESULT_BYTES_SENT = REGISTRY.counter(
+    "fractal_matrix_result_bytes_sent_total", "Size of the task result events sent to the room"
+)
+RESULT_BYTES_SKIPPED = REGISTRY.counter(
+    "fractal_matrix_result_bytes_skipped_total",
+    "Size of the task result events not sent because the task was kicked without a result",
+)
+KICKS_WITHOUT_RESULT = REGISTRY.counter(
+    "fractal_matrix_kicks_without_result_total",
+    "Tasks kicked without a result backend",
+    ["task"],
+)
@@ -0,0 +1,60 @@
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+def index_channel_rooms(apps, schema_editor):
+    """
+    Indexes the room ids that are already stored in the metadata of existing channels.
+    """
+    ContentType = apps.get_model("contenttypes", "ContentType")
+    MatrixReplicationChannel = apps.get_model("fractal_database_matrix", "MatrixReplicationChannel")
+    MatrixRoom = apps.get_model("fractal_database_matrix", "MatrixRoom")
+
+    owner_type, _ = ContentType.objects.get_or_create(
+        app_label="fractal_database_matrix", model="matrixreplicationchannel"
+    )
+    for channel in MatrixReplicationChannel.objects.all():
+        for role, room_id in (channel.metadata or {}).items():
+            if not isinstance(room_id, str) or not room_id.startswith("!"):
+                continue
+            MatrixRoom.objects.update_or_create(
+                channel=channel,
+                owner_type=owner_type,
+                owner_id=str(channel.pk),
+                role=role,
+                defaults={"room_id": room_id},
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('fractal_database_matrix', '0002_matrixhomeserver_local_url'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatrixRoom',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_modified', models.DateTimeField(auto_now=True)),
+                ('deleted', models.BooleanField(default=False)),
+                ('room_id', models.CharField(db_index=True, max_length=255)),
+                ('role', models.CharField(max_length=255)),
+                ('owner_id', models.CharField(max_length=255)),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rooms', to='fractal_database_matrix.matrixreplicationchannel')),
+                ('owner_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['owner_type', 'owner_id'], name='matrixroom_owner_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='matrixroom',
+            constraint=models.UniqueConstraint(fields=('channel', 'owner_type', 'owner_id', 'role'), name='unique_matrix_room_role_per_owner'),
+        ),
+        migrations.RunPython(index_channel_rooms, migrations.RunPython.noop),
+    ]
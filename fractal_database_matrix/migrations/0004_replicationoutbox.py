@@ -0,0 +1,35 @@
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fractal_database_matrix', '0003_matrixroom'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReplicationOutbox',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_modified', models.DateTimeField(auto_now=True)),
+                ('deleted', models.BooleanField(default=False)),
+                ('room_id', models.CharField(max_length=255)),
+                ('seq', models.BigIntegerField()),
+                ('payload', models.TextField()),
+                ('labels', models.JSONField(default=dict)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('next_attempt', models.DateTimeField(blank=True, null=True)),
+                ('sent', models.BooleanField(default=False)),
+                ('date_sent', models.DateTimeField(blank=True, null=True)),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outbox', to='fractal_database_matrix.matrixreplicationchannel')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['sent', 'seq'], name='outbox_pending_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fractal_database_matrix', '0004_replicationoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='matrixreplicationchannel',
+            name='shard_count',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+    ]
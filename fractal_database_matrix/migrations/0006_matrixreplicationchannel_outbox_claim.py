@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fractal_database_matrix', '0005_matrixreplicationchannel_shard_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='matrixreplicationchannel',
+            name='outbox_claimed_by',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='matrixreplicationchannel',
+            name='outbox_claimed_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
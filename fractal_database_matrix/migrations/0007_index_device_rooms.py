@@ -0,0 +1,47 @@
+from django.db import migrations
+
+
+def index_device_rooms(apps, schema_editor):
+    """
+    Indexes the device rooms that are already stored in the metadata of device memberships
+    (under the pk of the channel they belong to).
+    """
+    ContentType = apps.get_model("contenttypes", "ContentType")
+    MatrixReplicationChannel = apps.get_model("fractal_database_matrix", "MatrixReplicationChannel")
+    MatrixRoom = apps.get_model("fractal_database_matrix", "MatrixRoom")
+    try:
+        DeviceMembership = apps.get_model("fractal_database", "DeviceMembership")
+    except LookupError:
+        return
+
+    channels = {str(channel.pk): channel for channel in MatrixReplicationChannel.objects.all()}
+    if not channels:
+        return
+
+    owner_type, _ = ContentType.objects.get_or_create(
+        app_label="fractal_database", model="devicemembership"
+    )
+    for membership in DeviceMembership.objects.all():
+        for role, room_id in (membership.metadata or {}).items():
+            channel = channels.get(role)
+            if channel is None or not isinstance(room_id, str) or not room_id.startswith("!"):
+                continue
+            MatrixRoom.objects.update_or_create(
+                channel=channel,
+                owner_type=owner_type,
+                owner_id=str(membership.pk),
+                role=role,
+                defaults={"room_id": room_id},
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fractal_database', '0001_initial'),
+        ('fractal_database_matrix', '0006_matrixreplicationchannel_outbox_claim'),
+    ]
+
+    operations = [
+        migrations.RunPython(index_device_rooms, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import subprocess
@@ -7,8 +8,11 @@ import docker
 import fractal_database_matrix
 import tldextract
 import yaml
+from aiohttp import ClientConnectionError
 from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
 from django.db import models, transaction
 from docker.errors import NotFound
 from docker.models.networks import Network
@@ -28,11 +32,28 @@ from fractal_database.models import (
     docker_compose,
 )
 from fractal_database_matrix.broker.broker import FractalMatrixBroker
+from fractal_database_matrix.broker.queue import (
+    BULK_OBJECTS,
+    REPLICATION_QUEUE,
+    SHARD_ROOM_LABEL,
+    replication_lane,
+    replication_shard,
+)
+from fractal_database_matrix.broker.results import NO_RESULT_LABEL
 from taskiq import SendTaskError
 from taskiq.middlewares.retry_middleware import SimpleRetryMiddleware
 from taskiq_matrix.matrix_result_backend import MatrixResultBackend
 
-from .exceptions import MatrixHomeserverAlreadyExists
+from . import metrics, tracing
+from .circuit import CircuitBreaker, call_with_retry, get_circuit_breaker
+from .context import operation_context
+from .endpoints import EndpointSelector, get_endpoint_selector
+from .exceptions import CircuitOpenError, MatrixHomeserverAlreadyExists
+from .filters import ReplicationFilter, compile_filter
+from .lag import origin_labels
+from .operations import plan_operations
+from .payloads import PayloadSummary, fixture_objects
+from .ratelimit import RateLimiter, get_rate_limiter
 
 if TYPE_CHECKING:
     from fractal.gateway.models import Gateway, Link
@@ -42,6 +63,20 @@ if TYPE_CHECKING:
 
 logger = logging.getLogger(__name__)
 
+_origin_device: Optional[str] = None
+
+
+async def _aget_origin_device() -> str:
+    """
+    Returns the name of the current device, which replication events are labelled with.
+    """
+    global _origin_device
+    if _origin_device is None:
+        device = await sync_to_async(Device.current_device)()
+        _origin_device = device.name
+    return _origin_device
+
+
 # class MatrixHomeserver(BaseModel):
 #     url = models.URLField(primary_key=True) # is the homeserver url
 
@@ -150,8 +185,9 @@ class MatrixHomeserver(Service):
                 config.links.add(link)
 
         logger.info(
-            "Created homeserver %s with and assigned the current device %s to run the app."
-            % (homeserver, device)
+            "Created homeserver %s with and assigned the current device %s to run the app.",
+            homeserver,
+            device,
         )
         return homeserver
 
@@ -173,7 +209,7 @@ class MatrixHomeserver(Service):
         try:
             cls.get_docker_network()
         except NotFound:
-            logger.info("Creating local matrix network %s" % cls.LOCAL_MATRIX_NETWORK)
+            logger.info("Creating local matrix network %s", cls.LOCAL_MATRIX_NETWORK)
             client.networks.create(cls.LOCAL_MATRIX_NETWORK)
 
     def _render_compose_file(self) -> str:
@@ -198,8 +234,8 @@ class MatrixHomeserver(Service):
         link: Optional["Link"] = self.config.links.first()  # type: ignore
         if not link:
             logger.warning(
-                "Matrix Homeserver %s ServiceInstanceConfig does not have any links or gateways. Your Matrix Homeserver will only work locally."
-                % self
+                "Matrix Homeserver %s ServiceInstanceConfig does not have any links or gateways. Your Matrix Homeserver will only work locally.",
+                self,
             )
             return yaml.dump(compose_file)
 
@@ -253,6 +289,21 @@ class MatrixHomeserver(Service):
     def get_operation_module(self) -> str:
         return "fractal_database_matrix.operations.RegisterOwnedDevices"
 
+    def endpoint_selector(self) -> EndpointSelector:
+        return get_endpoint_selector(self.url, local_url=self.local_url)
+
+    async def aget_endpoint_url(self) -> str:
+        """
+        Returns the lowest latency reachable URL (local_url or url) for this homeserver.
+        """
+        return await self.endpoint_selector().select()
+
+    def circuit_breaker(self) -> CircuitBreaker:
+        return get_circuit_breaker(self.url)
+
+    def rate_limiter(self) -> RateLimiter:
+        return get_rate_limiter(self.url)
+
 
 class MatrixCredentials(BaseModel):
     matrix_id = models.CharField(max_length=255)
@@ -279,6 +330,12 @@ class MatrixReplicationChannel(ReplicationChannel):
     homeserver = models.ForeignKey(
         MatrixHomeserver, on_delete=models.CASCADE, related_name="channels"
     )
+    # number of rooms bulk replication events are spread over (see shard_rooms). Keys move
+    # between rooms when it changes, so it is best set when the channel is created
+    shard_count = models.PositiveSmallIntegerField(default=1)
+    # the outbox drainer currently sending this channel's entries (see outbox.claim)
+    outbox_claimed_by = models.CharField(max_length=64, blank=True, null=True)
+    outbox_claimed_until = models.DateTimeField(blank=True, null=True)
 
     def __str__(self):
         if self.metadata.get("room_id"):
@@ -302,13 +359,42 @@ class MatrixReplicationChannel(ReplicationChannel):
     async def aget_creds(self):
         return await sync_to_async(self.get_creds)()
 
+    async def apending_operations(self) -> List[DurableOperation]:
+        """
+        Returns the channel's durable operations that haven't been applied yet, in the order
+        they were created.
+        """
+        channel_type = await sync_to_async(ContentType.objects.get_for_model)(self)
+        return [
+            operation
+            async for operation in DurableOperation.objects.filter(
+                channel_type=channel_type, channel_id=str(self.pk), deleted=False
+            )
+            .select_related("channel_type", "content_type")
+            .order_by("date_created")
+        ]
+
+    async def replicate(self, *args, **kwargs):
+        """
+        Runs the channel's operations in a shared operation context. The channel (with its
+        homeserver and credentials) and the instances of the pending operations are loaded
+        up front, in a query per model, and reused by every operation of the plan.
+
+        Operations that local state shows to be satisfied already are skipped before any of
+        them runs (see ``plan_operations``).
+        """
+        operations = await self.apending_operations()
+        async with operation_context(operations):
+            await plan_operations(operations)
+            return await super().replicate(*args, **kwargs)
+
     def create_durable_operations(self, instance: "ReplicatedModel"):
         """
         Create the durable operations (tasks) for an instance.
         """
         durable_operations = []
         # get the operation module specified by the provided instance
-        logger.info("Fetching operation module for %s" % instance)
+        logger.info("Fetching operation module for %s", instance)
         operation_module = instance.get_operation_module()
         if not operation_module:
             # provided instance doesn't specify an operation module
@@ -372,7 +458,7 @@ class MatrixReplicationChannel(ReplicationChannel):
         # get current device's room for the channel
         # this is the room that we'll kick the replicate_async task into
         membership = await root_database.device_memberships.aget(device=current_device)
-        device_room = membership.metadata.get(str(channel.id))
+        device_room = await MatrixRoom.alookup(channel, membership, str(channel.id))
 
         # if device room isn't found on root database's channel, then
         # synchronously replicate the channel so that the room can be created.
@@ -383,7 +469,7 @@ class MatrixReplicationChannel(ReplicationChannel):
             # if for some reason the device room still isn't found, raise an exception
             # so we dont recursively call this method
             membership = await root_database.device_memberships.aget(device=current_device)
-            device_room = membership.metadata.get(str(channel.id))
+            device_room = await MatrixRoom.alookup(channel, membership, str(channel.id))
             if not device_room:
                 raise Exception(
                     "Failed to replicate async. Device room for current device %s not found for root database %s on channel %s"
@@ -411,6 +497,70 @@ class MatrixReplicationChannel(ReplicationChannel):
         except SendTaskError as e:
             raise Exception(e.__cause__)
 
+    @classmethod
+    async def aget_by_device_space(cls, room_id: str) -> Optional["MatrixReplicationChannel"]:
+        """
+        Returns the channel whose device space is ``room_id``.
+        """
+        room = await MatrixRoom.aresolve(room_id)
+        if room is not None and room.role == "devices_room_id":
+            owner = await room.aget_owner()
+            return owner if isinstance(owner, cls) else room.channel
+        # channels whose rooms weren't indexed
+        return await cls.objects.filter(metadata__devices_room_id=room_id).afirst()
+
+    def shard_rooms(self) -> List[str]:
+        """
+        Returns the rooms bulk replication events are spread over: the device space followed
+        by the channel's other shard rooms. Until every shard room has been created, events
+        all go to the device space.
+        """
+        device_space = self.device_space
+        rooms = [
+            self.metadata.get(SHARD_ROOM_LABEL.format(shard))
+            for shard in range(1, self.shard_count)
+        ]
+        if not all(rooms):
+            return [device_space]
+        return [device_space, *rooms]
+
+    async def ashard_rooms(self) -> List[str]:
+        """
+        Same as ``shard_rooms``, with the rooms looked up in the room index.
+        """
+        device_space = await MatrixRoom.alookup(self, self, "devices_room_id")
+        rooms = [
+            await MatrixRoom.alookup(self, self, SHARD_ROOM_LABEL.format(shard))
+            for shard in range(1, self.shard_count)
+        ]
+        if not all(rooms):
+            return [device_space]
+        return [device_space, *rooms]
+
+    def compiled_filter(self) -> Optional[ReplicationFilter]:
+        """
+        Returns the channel's compiled ``filter`` (see ``fractal_database_matrix.filters``).
+        """
+        return compile_filter(self.filter)
+
+    def filter_fixture(self, fixture: Any) -> Any:
+        """
+        Applies the channel's filter to a fixture. Returns None if every object was
+        filtered out.
+        """
+        replication_filter = self.compiled_filter()
+        objects = fixture_objects(fixture)
+        if not replication_filter or objects is None:
+            return fixture
+
+        filtered = replication_filter.apply(objects)
+        metrics.FIXTURES_FILTERED.inc(len(objects) - len(filtered), channel=self.name)
+        if not filtered:
+            return None
+        if isinstance(fixture, dict):
+            return {**fixture, "payload": filtered}
+        return filtered
+
     async def push_replication_log(self, fixture: Dict[str, Any]) -> None:
         """
         Pushes a replication log to the replication self as a replicate. Uses taskiq
@@ -420,7 +570,11 @@ class MatrixReplicationChannel(ReplicationChannel):
         if not self.target:
             raise Exception("Channel cannot push replication logs if target property is False")
 
-        from fractal_database.replication.tasks import replicate_fixture
+        # drop the objects this channel doesn't replicate before paying for serialization
+        fixture = self.filter_fixture(fixture)
+        if fixture is None:
+            logger.debug("Nothing to push to %s, every object was filtered out", self)
+            return None
 
         # we have to serialize the fixture to json because Matrix has a non-standard
         # JSON encoding that doesn't allow floats
@@ -431,18 +585,75 @@ class MatrixReplicationChannel(ReplicationChannel):
         try:
             room_id = self.device_space
         except Exception:
-            logger.warning("Unable to replicate, no room_id found for %s" % self.name)
+            logger.warning("Unable to replicate, no room_id found for %s", self.name)
             return None
 
+        # small control changes skip the line of bulk replication, unless they refer to (or
+        # are newer versions of) objects that may still be waiting on it
+        task_labels = origin_labels(await _aget_origin_device())
+        objects = fixture_objects(fixture) or []
+        lane = replication_lane(objects)
+        held = BULK_OBJECTS.shards(self.pk, objects)
+        if lane != REPLICATION_QUEUE and not held:
+            task_labels["queue"] = lane
+        else:
+            shard = 0
+            if self.shard_count > 1:
+                # bulk events of a sharded channel go to the shard room of their object, or
+                # follow the in flight objects they refer to or hold newer versions of
+                rooms = self.shard_rooms()
+                shard = replication_shard(objects, len(rooms))
+                if held and held != {shard}:
+                    shard = held.pop() if len(held) == 1 else 0
+                    if shard >= len(rooms):
+                        shard = 0
+                room_id = task_labels["room_id"] = rooms[shard]
+            BULK_OBJECTS.add(self.pk, objects, shard)
+
+        # log a summary of the payload, the payload itself can be large and contain user data
         logger.info(
-            "Target %s is pushing fixture(s): %s to room %s on homeserver %s"
-            % (self, replication_event, room_id, self.homeserver)
+            "Target %s is pushing %s to room %s on homeserver %s",
+            self,
+            PayloadSummary(replication_event, fixture),
+            room_id,
+            self.homeserver,
         )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Replication event pushed to room %s: %s", room_id, replication_event)
 
-        try:
-            await self.kick_task(replicate_fixture, replication_event, room_id)
-        except SendTaskError as e:
-            raise Exception(e.__cause__)
+        if getattr(settings, "FRACTAL_REPLICATION_OUTBOX", False):
+            # written locally (in the caller's transaction, if any) and sent in the background
+            from fractal_database_matrix.outbox import enqueue
+
+            await enqueue(self, room_id, replication_event, task_labels, fixture)
+        else:
+            await self.send_replication_event(replication_event, room_id, task_labels)
+
+        if objects:
+            metrics.FIXTURES_PUSHED.inc(len(objects), channel=self.name)
+
+    async def send_replication_event(
+        self, replication_event: str, room_id: str, task_labels: Dict[str, Any]
+    ) -> None:
+        """
+        Kicks the replicate_fixture task for a serialized replication event into the room.
+        """
+        from fractal_database.replication.tasks import replicate_fixture
+
+        with metrics.PUSH_SECONDS.time(channel=self.name):
+            try:
+                # nobody waits for the result of a replication task
+                await self.kick_task(
+                    replicate_fixture,
+                    replication_event,
+                    room_id,
+                    task_labels=task_labels,
+                    with_result=False,
+                )
+            except SendTaskError as e:
+                raise Exception(e.__cause__)
+
+        metrics.EVENTS_PUSHED.inc(channel=self.name)
 
     async def kick_task(
         self,
@@ -450,8 +661,14 @@ class MatrixReplicationChannel(ReplicationChannel):
         *targs,
         task_labels: Optional[dict] = None,
         as_user: bool = False,
+        with_result: bool = True,
         **tkwargs,
     ):
+        """
+        Kicks a task into the channel's device space (or the ``room_id`` label's room).
+        Tasks kicked ``with_result=False`` have no result backend and are labeled so
+        that the worker running them doesn't send their result to the room either.
+        """
         if not task_labels:
             task_labels = {}
 
@@ -475,20 +692,27 @@ class MatrixReplicationChannel(ReplicationChannel):
             except Exception as e:
                 raise Exception(f"Cannot push replication log: {e}")
 
-        broker = (
-            FractalMatrixBroker()
-            .with_matrix_config(
-                homeserver_url=self.homeserver.url,
-                access_token=access_token,
-            )
-            .with_result_backend(
+        # credentials work against the local URL as well, so kick
+        # into whichever homeserver endpoint is currently the fastest
+        homeserver_url = await self.homeserver.aget_endpoint_url()
+
+        broker = FractalMatrixBroker().with_matrix_config(
+            homeserver_url=homeserver_url,
+            access_token=access_token,
+        )
+        if with_result:
+            broker = broker.with_result_backend(
                 MatrixResultBackend(
-                    homeserver_url=self.homeserver.url,
+                    homeserver_url=homeserver_url,
                     access_token=access_token,
                     result_ex_time=3600,
                 )
             )
-            .with_middlewares(SimpleRetryMiddleware(default_retry_count=3))
+        else:
+            task_labels[NO_RESULT_LABEL] = True
+            metrics.KICKS_WITHOUT_RESULT.inc(task=task_func.task_name)
+        broker = broker.with_middlewares(
+            SimpleRetryMiddleware(default_retry_count=3), tracing.TracingMiddleware()
         )
 
         if "room_id" not in task_labels:
@@ -496,18 +720,182 @@ class MatrixReplicationChannel(ReplicationChannel):
 
         room_id = task_labels["room_id"]
 
-        logger.debug("Kicking task %s to room %s" % (task_func, room_id))
-        return (
-            await task_func.kicker()
-            .with_broker(broker)
-            .with_labels(**task_labels)
-            .kiq(*targs, **tkwargs)
-        )
+        logger.debug("Kicking task %s to room %s", task_func, room_id)
+
+        async def kick():
+            try:
+                return (
+                    await task_func.kicker()
+                    .with_broker(broker)
+                    .with_labels(**task_labels)
+                    .kiq(*targs, **tkwargs)
+                )
+            except SendTaskError as e:
+                if isinstance(e.__cause__, CircuitOpenError):
+                    # the homeserver's circuit is open, retrying won't help
+                    raise e.__cause__
+                if isinstance(e.__cause__, (ClientConnectionError, asyncio.TimeoutError)):
+                    self.homeserver.endpoint_selector().mark_unreachable(homeserver_url)
+                raise
+
+        # kicks share the homeserver's circuit breaker with operations so that an
+        # overloaded homeserver isn't hammered with retries. The broker sends through
+        # a FractalMatrixClient, which already checks and records on the breaker
+        with (
+            metrics.KICK_SECONDS.time(task=task_func.task_name),
+            metrics.KICKS_IN_FLIGHT.track_inprogress(),
+            tracing.span(f"kick {task_func.task_name}", room=room_id, channel=str(self.id)),
+        ):
+            return await call_with_retry(
+                kick,
+                self.homeserver.circuit_breaker(),
+                retries=3,
+                retry_on=(SendTaskError,),
+                guard=False,
+            )
 
     def get_operation_module(self) -> str:
         return "fractal_database_matrix.operations.CreateMatrixDatabase"
 
 
+class MatrixRoom(BaseModel):
+    """
+    Index of the Matrix rooms that operations create for replicated objects.
+
+    Room ids are also stored in the free form ``metadata`` of the objects that own them
+    (``room_id``, ``devices_room_id``, the channel's pk for device rooms, ...). This table
+    mirrors them so that a room id can be resolved to its channel and owner (and the other
+    way around) with an indexed query instead of scanning every channel's metadata.
+    """
+
+    room_id = models.CharField(max_length=255, db_index=True)
+    channel = models.ForeignKey(
+        MatrixReplicationChannel, on_delete=models.CASCADE, related_name="rooms"
+    )
+    # metadata label the room id is stored under on the owner (i.e. "room_id")
+    role = models.CharField(max_length=255)
+    owner_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    owner_id = models.CharField(max_length=255)
+    owner = GenericForeignKey("owner_type", "owner_id")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["channel", "owner_type", "owner_id", "role"],
+                name="unique_matrix_room_role_per_owner",
+            )
+        ]
+        indexes = [models.Index(fields=["owner_type", "owner_id"], name="matrixroom_owner_idx")]
+
+    def __str__(self) -> str:
+        return f"{self.room_id} ({self.role} - {self.owner_type.model} {self.owner_id})"
+
+    @classmethod
+    async def arecord(
+        cls,
+        room_id: str,
+        channel: "MatrixReplicationChannel",
+        owner: models.Model,
+        role: str = "room_id",
+    ) -> "MatrixRoom":
+        """
+        Records (or updates) the room that ``owner`` stores under ``role`` for ``channel``.
+        """
+        owner_type = await sync_to_async(ContentType.objects.get_for_model)(owner)
+        room, _ = await cls.objects.aupdate_or_create(
+            channel=channel,
+            owner_type=owner_type,
+            owner_id=str(owner.pk),
+            role=role,
+            defaults={"room_id": room_id},
+        )
+        return room
+
+    @classmethod
+    async def aget_room_id(
+        cls,
+        owner: models.Model,
+        channel: "MatrixReplicationChannel",
+        role: str = "room_id",
+    ) -> Optional[str]:
+        """
+        Returns the id of the room that ``owner`` has for ``channel`` under ``role``.
+        """
+        owner_type = await sync_to_async(ContentType.objects.get_for_model)(owner)
+        return (
+            await cls.objects.filter(
+                channel=channel, owner_type=owner_type, owner_id=str(owner.pk), role=role
+            )
+            .values_list("room_id", flat=True)
+            .afirst()
+        )
+
+    @classmethod
+    async def aresolve(cls, room_id: str) -> Optional["MatrixRoom"]:
+        """
+        Returns the index entry for a room id with its channel and homeserver fetched.
+        Use ``aget_owner`` to fetch the object that owns the room.
+        """
+        return (
+            await cls.objects.select_related("channel__homeserver", "owner_type")
+            .filter(room_id=room_id)
+            .afirst()
+        )
+
+    @classmethod
+    async def alookup(
+        cls,
+        channel: "MatrixReplicationChannel",
+        owner: models.Model,
+        role: str = "room_id",
+    ) -> Optional[str]:
+        """
+        Like ``aget_room_id``, but falls back to the owner's metadata for rooms that were
+        never indexed, and indexes them.
+        """
+        room_id = await cls.aget_room_id(owner, channel, role=role)
+        if room_id:
+            return room_id
+        room_id = (getattr(owner, "metadata", None) or {}).get(role)
+        if room_id:
+            await cls.arecord(room_id, channel, owner, role=role)
+        return room_id
+
+    async def aget_owner(self) -> Optional[models.Model]:
+        model_class = self.owner_type.model_class()
+        if not model_class:
+            return None
+        return await model_class.objects.filter(pk=self.owner_id).afirst()
+
+
+class ReplicationOutbox(BaseModel):
+    """
+    Replication events waiting to be pushed to the homeserver. Entries are written by
+    ``push_replication_log`` when ``FRACTAL_REPLICATION_OUTBOX`` is enabled and sent in
+    ``seq`` order by the outbox drainer (see ``fractal_database_matrix.outbox``).
+    """
+
+    channel = models.ForeignKey(
+        MatrixReplicationChannel, on_delete=models.CASCADE, related_name="outbox"
+    )
+    room_id = models.CharField(max_length=255)
+    # the order events were pushed in (the replication event's seq label)
+    seq = models.BigIntegerField()
+    payload = models.TextField()
+    labels = models.JSONField(default=dict)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+    next_attempt = models.DateTimeField(blank=True, null=True)
+    sent = models.BooleanField(default=False)
+    date_sent = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["sent", "seq"], name="outbox_pending_idx")]
+
+    def __str__(self) -> str:
+        return f"{self.seq} to {self.room_id} ({'sent' if self.sent else 'pending'})"
+
+
 class BaseMatrixReplicationChannel(MatrixReplicationChannel):
 
     class Meta:
@@ -1,17 +1,31 @@
+import asyncio
+import functools
 import logging
+import time
+from contextlib import asynccontextmanager
 from secrets import token_hex
-from typing import TYPE_CHECKING, Any, Optional, Sequence
+from typing import TYPE_CHECKING, Any, AsyncIterator, Optional, Sequence, Tuple
 
+from aiohttp import ClientConnectionError
 from django.conf import settings
 from fractal.cli.controllers.auth import AuthenticatedController
-from fractal.matrix import MatrixClient
 from fractal_database.models import (
     DurableOperation,
     ReplicatedModel,
     ReplicationChannel,
 )
 from fractal_database.operations import Operation
-from nio import RoomCreateError, RoomLeaveError, RoomPutStateError, RoomVisibility
+from fractal_database_matrix import metrics, tracing
+from fractal_database_matrix.broker.queue import SHARD_ROOM_LABEL
+from fractal_database_matrix.client import FractalMatrixClient, matrix_client
+from fractal_database_matrix.context import _current, current_context
+from nio import (
+    RoomCreateError,
+    RoomKickError,
+    RoomLeaveError,
+    RoomPutStateError,
+    RoomVisibility,
+)
 
 if TYPE_CHECKING:
     from fractal_database.models import (
@@ -25,6 +39,7 @@ if TYPE_CHECKING:
     )
     from fractal_database_matrix.models import (
         MatrixCredentials,
+        MatrixHomeserver,
         MatrixReplicationChannel,
     )
 
@@ -34,8 +49,250 @@ USE_MINIMIZED_REPRESENTATION = getattr(
     settings, "FRACTAL_DATABASE_MINIMIZED_REPRESENTATION", False
 )
 
+# maximum number of rooms that are left (or kicked from) at once when removing a member
+REMOVAL_CONCURRENCY = getattr(settings, "FRACTAL_MATRIX_REMOVAL_CONCURRENCY", 10)
+
+# register owned devices with a single operation instead of an operation per device
+BULK_DEVICE_REGISTRATION = getattr(settings, "FRACTAL_MATRIX_BULK_DEVICE_REGISTRATION", True)
+# maximum number of device accounts that are registered at once
+REGISTRATION_CONCURRENCY = getattr(settings, "FRACTAL_MATRIX_REGISTRATION_CONCURRENCY", 5)
+
+
+def _not_in_room(message: str) -> bool:
+    message = message.lower()
+    return "not in room" in message or "not in the room" in message
+
+
+def _mirror_result(operation: "DurableOperation", result: Any) -> Any:
+    # the returned metadata is merged into the instance once the operation completes,
+    # keep the copies cached by the active context in sync for the operations that follow
+    context = _current.get()
+    if context is not None and isinstance(result, dict):
+        context.mirror_metadata(operation, result)
+    return result
+
+
+async def _shard_rooms(channel: "MatrixReplicationChannel") -> list[str]:
+    # the shard rooms that have been created so far, other than the device space
+    from fractal_database_matrix.models import MatrixRoom
+
+    rooms = [
+        await MatrixRoom.alookup(channel, channel, SHARD_ROOM_LABEL.format(shard))
+        for shard in range(1, getattr(channel, "shard_count", 1))
+    ]
+    return [room_id for room_id in rooms if room_id]
+
+
+def _display_name(display_name: str, owner_matrix_id: Optional[str] = None) -> str:
+    if owner_matrix_id:
+        # get local part of owner_matrix_id without the @
+        owner_username = owner_matrix_id.split("@")[1].split(":")[0]
+        display_name = f"{owner_username}'s {display_name}"
+    return display_name
+
+
+def _instrument_run(run):
+    @functools.wraps(run)
+    async def instrumented_run(self, operation: "DurableOperation"):
+        if await self.skip_if_satisfied(operation):
+            return {}
+
+        if not metrics.enabled() and not tracing.enabled():
+            return _mirror_result(operation, await run(self, operation))
+
+        name = type(self).__name__
+        status = "error"
+        with metrics.OPERATIONS_IN_FLIGHT.track_inprogress(operation=name), tracing.span(
+            f"operation {name}",
+            **{
+                "operation.module": operation.module,
+                "operation.id": str(operation.pk),
+                "channel.id": str(operation.channel_id),
+                "instance.type": getattr(operation.content_type, "model", None),
+                "instance.id": str(operation.object_id),
+                "room.label": (operation.metadata or {}).get("metadata_label"),
+            },
+        ) as span:
+            start = time.perf_counter()
+            try:
+                result = await run(self, operation)
+                status = "ok"
+                if isinstance(result, dict):
+                    # operations that create rooms return the new room id
+                    for room_id in result.values():
+                        span.set_attribute("room", room_id)
+                return _mirror_result(operation, result)
+            finally:
+                metrics.OPERATION_SECONDS.observe(
+                    time.perf_counter() - start, operation=name, status=status
+                )
+
+    instrumented_run.__instrumented__ = True  # type: ignore
+    return instrumented_run
+
 
 class MatrixOperation(Operation):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # time and trace every operation's run
+        run = cls.__dict__.get("run")
+        if run and not getattr(run, "__instrumented__", False):
+            cls.run = _instrument_run(run)
+
+    async def is_satisfied(self, operation: "DurableOperation") -> bool:
+        """
+        Returns True if local state shows that the operation has nothing left to do. Checked
+        before the operation runs, so it must not make any homeserver requests.
+        """
+        return False
+
+    async def skip_if_satisfied(self, operation: "DurableOperation") -> bool:
+        """
+        Returns True if the operation is satisfied already and shouldn't run. The decision
+        is recorded in the active context, so the operation is only checked once per plan.
+        """
+        context = current_context()
+        key = str(operation.pk)
+        if key in context.satisfied:
+            return True
+
+        try:
+            satisfied = await self.is_satisfied(operation)
+        except Exception as e:
+            # leave it to run() to fail with a proper error
+            logger.debug("Failed to check whether operation %s is satisfied: %s", key, e)
+            return False
+
+        if satisfied:
+            name = type(self).__name__
+            context.satisfied.add(key)
+            context.skipped += 1
+            metrics.OPERATIONS_SKIPPED.inc(operation=name)
+            logger.info("Skipping %s for %s, already satisfied", name, operation.object_id)
+        return satisfied
+
+    async def aget_channel(self, operation: "DurableOperation") -> "MatrixReplicationChannel":
+        """
+        Returns the channel the operation is for, shared with the other operations of
+        the plan (see ``fractal_database_matrix.context``).
+        """
+        return await current_context().aget_channel(operation)
+
+    async def aget_instance(
+        self,
+        operation: "DurableOperation",
+        select_related: Tuple[str, ...] = (),
+        prefetch_related: Tuple[str, ...] = (),
+    ) -> Any:
+        """
+        Returns the replicated instance the operation is for.
+        """
+        return await current_context().aget_instance(operation, select_related, prefetch_related)
+
+    async def aget_device_credentials(
+        self, homeserver: "MatrixHomeserver", device: "Device"
+    ) -> Optional["MatrixCredentials"]:
+        return await current_context().aget_device_credentials(homeserver, device)
+
+    def get_creds(self) -> Optional[Tuple[str, str, str]]:
+        return current_context().get_creds()
+
+    async def aget_fixture(self, obj: "ReplicatedModel", with_relations: bool = True) -> str:
+        """
+        Returns the object's JSON fixture, serialized at most once per version for the
+        operations of a plan.
+        """
+        return await current_context().fixtures.aget(  # type: ignore
+            obj, json=True, with_relations=with_relations
+        )
+
+    @asynccontextmanager
+    async def matrix_client(
+        self, channel: "MatrixReplicationChannel", access_token: str
+    ) -> AsyncIterator[FractalMatrixClient]:
+        """
+        Opens a Matrix client against the fastest reachable endpoint of the channel's homeserver.
+        Requests made with the client go through the homeserver's circuit breaker. If the
+        endpoint can't be reached, it is marked as down so that the next client falls back
+        to the homeserver's other endpoint.
+        """
+        # credentials will work with the local URL as well
+        selector = channel.homeserver.endpoint_selector()
+        homeserver_url = await selector.select()
+
+        try:
+            async with matrix_client(
+                homeserver_url,
+                access_token,
+                circuit_breaker=channel.homeserver.circuit_breaker(),
+                rate_limiter=channel.homeserver.rate_limiter(),
+            ) as client:
+                yield client
+        except (ClientConnectionError, asyncio.TimeoutError):
+            selector.mark_unreachable(homeserver_url)
+            raise
+
+    async def has_room(self, operation: "DurableOperation") -> bool:
+        """
+        Returns True if the operation's instance already has a room under the operation's
+        ``metadata_label``.
+        """
+        metadata_label = (operation.metadata or {}).get("metadata_label", "room_id")
+        instance = await self.aget_instance(operation)
+        return bool(instance.metadata.get(metadata_label))
+
+    async def record_room(
+        self,
+        room_id: str,
+        channel: "MatrixReplicationChannel",
+        owner: "ReplicatedModel",
+        role: str = "room_id",
+    ) -> None:
+        """
+        Records a created room in the room index (see ``MatrixRoom``).
+        """
+        from fractal_database_matrix.models import MatrixRoom
+
+        await MatrixRoom.arecord(room_id, channel, owner, role=role)
+
+    async def get_room_id(
+        self,
+        channel: "MatrixReplicationChannel",
+        owner_type: type["ReplicatedModel"],
+        owner_id: Any,
+        role: str = "room_id",
+    ) -> str:
+        """
+        Returns the room id ``owner`` stores under ``role`` for ``channel``. Looks the room up in
+        the room index and falls back to the owner's metadata for rooms created before the index
+        existed.
+        """
+        from fractal_database_matrix.models import MatrixRoom
+
+        owner = owner_type(pk=owner_id)
+        room_id = await MatrixRoom.aget_room_id(owner, channel, role=role)
+        if room_id:
+            return room_id
+
+        owner = await owner_type.objects.aget(pk=owner_id)
+        room_id = await MatrixRoom.alookup(channel, owner, role=role)
+        if not room_id:
+            raise Exception(f"Failed to find room id for {role} on {owner}")
+        return room_id
+
+    async def get_channel_room_id(
+        self, channel: "MatrixReplicationChannel", role: str = "room_id"
+    ) -> str:
+        """
+        Returns the id of the channel's own room stored under ``role`` (see ``get_room_id``).
+        """
+        from fractal_database_matrix.models import MatrixRoom
+
+        room_id = await MatrixRoom.alookup(channel, channel, role=role)
+        if not room_id:
+            raise Exception(f"Failed to find room id in channel metadata for {role}")
+        return room_id
+
     async def put_state(
         self,
         room_id: str,
@@ -43,7 +300,7 @@ class MatrixOperation(Operation):
         state_type: str,
         content: dict[str, Any],
     ) -> None:
-        creds = AuthenticatedController.get_creds()
+        creds = self.get_creds()
         if not creds:
             raise Exception("You must be logged in to put state")
 
@@ -53,12 +310,8 @@ class MatrixOperation(Operation):
             raise Exception(
                 f"You are logged into the wrong homeserver ({homeserver_url}). You must be logged into the homeserver {channel.homeserver.url}"
             )
-        else:
-            # credentials will work with the local URL as well
-            # prefer the local URL if it exists
-            homeserver_url = channel.homeserver.local_url or homeserver_url
 
-        async with MatrixClient(homeserver_url, access_token, max_timeouts=15) as client:
+        async with self.matrix_client(channel, access_token) as client:
             res = await client.room_put_state(
                 room_id,
                 state_type,
@@ -89,7 +342,7 @@ class MatrixOperation(Operation):
                 }
             ]
 
-        creds = AuthenticatedController.get_creds()
+        creds = self.get_creds()
         if not creds:
             raise Exception("You must be logged in to create a room")
 
@@ -97,17 +350,13 @@ class MatrixOperation(Operation):
 
         if homeserver_url != channel.homeserver.url:
             raise Exception("You must be logged into the correct homeserver")
-        else:
-            # credentials will work with the local URL as well
-            # prefer the local URL if it exists
-            homeserver_url = channel.homeserver.local_url or homeserver_url
 
         # verify that matrix IDs passed in invite are all lowercase
         if invite:
             if not any([matrix_id.split("@")[1].islower() for matrix_id in invite]):
                 raise Exception("Matrix IDs must be lowercase")
 
-        async with MatrixClient(homeserver_url, access_token, max_timeouts=15) as client:
+        async with self.matrix_client(channel, access_token) as client:
             res = await client.room_create(
                 name=name,
                 space=space,
@@ -123,8 +372,10 @@ class MatrixOperation(Operation):
                 await client.invite(account, room_id, admin=True)
 
             logger.info(
-                "Successfully created %s for %s in Matrix: %s"
-                % ("Room" if not space else "Space", name, room_id)
+                "Successfully created %s for %s in Matrix: %s",
+                "Room" if not space else "Space",
+                name,
+                room_id,
             )
 
         return room_id
@@ -132,7 +383,7 @@ class MatrixOperation(Operation):
     async def add_subspace(
         self, channel: "MatrixReplicationChannel", parent_room_id: str, child_room_id: str
     ) -> None:
-        creds = AuthenticatedController.get_creds()
+        creds = self.get_creds()
         if not creds:
             raise Exception("You must be logged in to add a subspace")
 
@@ -140,12 +391,8 @@ class MatrixOperation(Operation):
 
         if homeserver_url != channel.homeserver.url:
             raise Exception("You must be logged into the correct homeserver")
-        else:
-            # credentials will work with the local URL as well
-            # prefer the local URL if it exists
-            homeserver_url = channel.homeserver.local_url or homeserver_url
 
-        async with MatrixClient(homeserver_url, access_token, max_timeouts=15) as client:
+        async with self.matrix_client(channel, access_token) as client:
             res = await client.room_put_state(
                 parent_room_id,
                 "m.space.child",
@@ -156,8 +403,9 @@ class MatrixOperation(Operation):
                 raise Exception(res.message)
 
             logger.info(
-                "Successfully added child space %s to parent space %s"
-                % (child_room_id, parent_room_id)
+                "Successfully added child space %s to parent space %s",
+                child_room_id,
+                parent_room_id,
             )
 
     async def accept_invite_as_user(
@@ -174,7 +422,7 @@ class MatrixOperation(Operation):
                                                                      Defaults to logged in user's credentials.
         """
         if not matrix_creds:
-            creds = AuthenticatedController.get_creds()
+            creds = self.get_creds()
             if not creds:
                 raise Exception("You must be logged in to accept an invite to a space")
             access_token, homeserver_url, user_matrix_id = creds
@@ -186,30 +434,19 @@ class MatrixOperation(Operation):
             raise Exception(
                 f"You are currently logged into {homeserver_url} not {channel.homeserver.url}"
             )
-        else:
-            # credentials will work with the local URL as well
-            # prefer the local URL if it exists
-            homeserver_url = channel.homeserver.local_url or homeserver_url
-
-        async with MatrixClient(
-            homeserver_url=homeserver_url, access_token=access_token, max_timeouts=15
-        ) as client:
-            logger.info("Accepting invite for %s as %s" % (room_id, user_matrix_id))
+
+        async with self.matrix_client(channel, access_token) as client:
+            logger.info("Accepting invite for %s as %s", room_id, user_matrix_id)
             await client.join_room(room_id)
 
     async def accept_invite_as_device(
         self, device_creds: "MatrixCredentials", room_id: str, channel: "MatrixReplicationChannel"
     ):
         device_matrix_id = device_creds.matrix_id
-        homeserver_url = channel.homeserver.local_url or channel.homeserver.url
 
         # accept invite on behalf of device
-        async with MatrixClient(
-            homeserver_url=homeserver_url,
-            access_token=device_creds.access_token,
-            max_timeouts=15,
-        ) as client:
-            logger.info("Accepting invite for %s as %s" % (room_id, device_matrix_id))
+        async with self.matrix_client(channel, device_creds.access_token) as client:
+            logger.info("Accepting invite for %s as %s", room_id, device_matrix_id)
             await client.join_room(room_id)
 
     async def invite_user(
@@ -217,7 +454,7 @@ class MatrixOperation(Operation):
     ) -> None:
         # FIXME: Once user has accounts on many homeservers, we need to strip the
         # host off of the room id and try to find credentials that match that host
-        creds = AuthenticatedController.get_creds()
+        creds = self.get_creds()
         if creds:
             access_token, homeserver_url, owner_matrix_id = creds
         else:
@@ -227,37 +464,36 @@ class MatrixOperation(Operation):
             raise Exception(
                 f"You are currently logged into {homeserver_url} not {channel.homeserver.url}"
             )
-        else:
-            # credentials will work with the local URL as well
-            # prefer the local URL if it exists
-            homeserver_url = channel.homeserver.local_url or homeserver_url
-
-        async with MatrixClient(
-            homeserver_url=homeserver_url,
-            access_token=access_token,
-            max_timeouts=15,
-        ) as client:
-            logger.info("Inviting %s to %s" % (matrix_id, room_id))
+
+        async with self.matrix_client(channel, access_token) as client:
+            logger.info("Inviting %s to %s", matrix_id, room_id)
             await client.invite(user_id=matrix_id, room_id=room_id, admin=True)
 
+    async def homeserver_name(self, client: FractalMatrixClient) -> str:
+        """
+        Returns the server name of the logged in user, asking the homeserver only if the
+        stored credentials don't have the user's matrix id.
+        """
+        creds = self.get_creds()
+        matrix_id = creds[2] if creds else None
+        if not matrix_id:
+            await client.whoami()
+            matrix_id = client.user_id
+        return matrix_id.split(":", 1)[1]
+
     async def register_device_account(
         self,
         device_name: str,
     ) -> tuple[str, str, str]:
-        creds = AuthenticatedController.get_creds()
+        creds = self.get_creds()
         if creds:
             access_token, homeserver_url, _ = creds
         else:
             raise Exception("You must be logged in to Matrix to register a device account")
 
-        async with MatrixClient(
-            homeserver_url=homeserver_url,
-            access_token=access_token,
-            max_timeouts=15,
-        ) as client:
+        async with matrix_client(homeserver_url, access_token) as client:
             registration_token = await client.generate_registration_token()
-            await client.whoami()
-            homeserver_name = client.user_id.split(":")[1]
+            homeserver_name = await self.homeserver_name(client)
             device_matrix_id = f"@{device_name.lower()}:{homeserver_name}"
             password = token_hex(32)  # FIXME
             access_token = await client.register_with_token(
@@ -268,6 +504,77 @@ class MatrixOperation(Operation):
             )
             return access_token, device_matrix_id, password
 
+    async def register_device_accounts(
+        self,
+        homeserver: "MatrixHomeserver",
+        devices: dict[str, dict[str, Any]],
+    ) -> dict[str, str]:
+        """
+        Registers accounts for many devices at once: a single registration token with a use
+        per device, then up to ``REGISTRATION_CONCURRENCY`` registrations at a time. Each new
+        account sets its display name right away and its credentials are stored as soon as
+        it is registered.
+
+        Args:
+            devices: Mapping of device pk to the device's operation metadata (``name``,
+                ``display_name`` and ``owner_matrix_id``).
+
+        Returns:
+            Mapping of device pk to the device's matrix id or the error message.
+        """
+        from fractal_database_matrix.models import MatrixCredentials
+
+        creds = self.get_creds()
+        if creds:
+            access_token, homeserver_url, _ = creds
+        else:
+            raise Exception("You must be logged in to Matrix to register a device account")
+
+        async with matrix_client(homeserver_url, access_token) as client:
+            registration_token = await client.generate_registration_token(
+                uses_allowed=len(devices)
+            )
+            homeserver_name = await self.homeserver_name(client)
+
+        semaphore = asyncio.Semaphore(REGISTRATION_CONCURRENCY)
+
+        async def register(device_id: str, metadata: dict[str, Any]) -> tuple[str, str]:
+            name = metadata["name"]
+            matrix_id = f"@{name.lower()}:{homeserver_name}"
+            password = token_hex(32)  # FIXME
+            async with semaphore, matrix_client(homeserver_url, "") as client:
+                try:
+                    device_token = await client.register_with_token(
+                        matrix_id=matrix_id,
+                        password=password,
+                        registration_token=registration_token,
+                        device_name=name,
+                    )
+                    await MatrixCredentials.objects.acreate(
+                        matrix_id=matrix_id,
+                        password=password,
+                        access_token=device_token,
+                        homeserver=homeserver,
+                        device_id=device_id,
+                    )
+                except Exception as e:
+                    return device_id, f"error: {e}"
+
+                # registration leaves the client logged in as the new account
+                display_name = _display_name(
+                    metadata.get("display_name", name), metadata.get("owner_matrix_id")
+                )
+                try:
+                    await client.set_displayname(display_name)
+                except Exception as e:
+                    logger.warning("Failed to set display name for %s: %s", matrix_id, e)
+            return device_id, matrix_id
+
+        results = await asyncio.gather(
+            *[register(device_id, metadata) for device_id, metadata in devices.items()]
+        )
+        return dict(results)
+
     async def set_display_name(
         self,
         channel: "MatrixReplicationChannel",
@@ -275,18 +582,9 @@ class MatrixOperation(Operation):
         display_name: str,
         owner_matrix_id: Optional[str] = None,
     ):
-        if owner_matrix_id:
-            # get local part of owner_matrix_id without the @
-            owner_username = owner_matrix_id.split("@")[1].split(":")[0]
-            display_name = f"{owner_username}'s {display_name}"
-
-        homeserver_url = channel.homeserver.local_url or channel.homeserver.url
-
-        async with MatrixClient(
-            homeserver_url=homeserver_url,
-            access_token=creds.access_token,
-            max_timeouts=15,
-        ) as client:
+        display_name = _display_name(display_name, owner_matrix_id)
+
+        async with self.matrix_client(channel, creds.access_token) as client:
             await client.set_displayname(display_name)
 
     async def user_leave_room(
@@ -299,7 +597,7 @@ class MatrixOperation(Operation):
         FIXME: Can't kick other admins from a room.
         """
         if not creds:
-            creds = AuthenticatedController.get_creds()
+            creds = self.get_creds()
             if not creds:
                 raise Exception("You must be logged in to remove a user from a room")
             access_token, homeserver_url, _ = creds
@@ -307,21 +605,122 @@ class MatrixOperation(Operation):
             access_token = creds.access_token
 
         # FIXME: Cannot kick other admins from the room
-        homeserver_url = channel.homeserver.local_url or channel.homeserver.url
-
-        async with MatrixClient(
-            homeserver_url=homeserver_url,
-            access_token=access_token,
-            max_timeouts=15,
-        ) as client:
+        async with self.matrix_client(channel, access_token) as client:
             res = await client.room_leave(room_id)
             if isinstance(res, RoomLeaveError):
                 if "not in room" in res.message:
                     return None
                 raise Exception(res.message)
 
+    async def remove_from_rooms(
+        self,
+        channel: "MatrixReplicationChannel",
+        room_ids: dict[str, str],
+        access_token: str,
+        kick_matrix_id: Optional[str] = None,
+    ) -> dict[str, str]:
+        """
+        Leaves (or kicks ``kick_matrix_id`` from) every room concurrently over a single client.
+        Being already out of a room counts as success.
+
+        Args:
+            room_ids: Mapping of room id label to room id.
+            kick_matrix_id: Kick this user instead of leaving as the user the access token belongs to.
+
+        Returns:
+            Mapping of room id label to ``left``, ``kicked``, ``not_in_room`` or the error message.
+        """
+        semaphore = asyncio.Semaphore(REMOVAL_CONCURRENCY)
+
+        async def remove(client: FractalMatrixClient, label: str, room_id: str) -> tuple[str, str]:
+            async with semaphore:
+                try:
+                    if kick_matrix_id:
+                        res = await client.room_kick(room_id, kick_matrix_id)
+                    else:
+                        res = await client.room_leave(room_id)
+                except Exception as e:
+                    return label, f"error: {e}"
+
+            if isinstance(res, (RoomLeaveError, RoomKickError)):
+                if _not_in_room(res.message):
+                    return label, "not_in_room"
+                return label, f"error: {res.message}"
+            return label, "kicked" if kick_matrix_id else "left"
+
+        async with self.matrix_client(channel, access_token) as client:
+            results = await asyncio.gather(
+                *[remove(client, label, room_id) for label, room_id in room_ids.items()]
+            )
+
+        return dict(results)
+
+    async def _remove_member_from_rooms(
+        self,
+        operation: "DurableOperation",
+        channel: "MatrixReplicationChannel",
+        access_token: str,
+        member: str,
+        kick_matrix_id: Optional[str] = None,
+    ) -> None:
+        """
+        Removes a member from every room in the operation's ``room_id_labels`` (defaults to
+        every room on the channel), records the per room results in the operation's metadata
+        and raises if any of the rooms failed.
+        """
+        from fractal_database.models import DurableOperation
+        from fractal_database_matrix.models import MatrixRoom
+
+        room_id_labels = operation.metadata.get("room_id_labels") or list(channel.metadata.keys())
+        room_ids = {}
+        for label in room_id_labels:
+            room_id = await MatrixRoom.alookup(channel, channel, role=label)
+            if room_id:
+                room_ids[label] = room_id
+        missing = set(room_id_labels) - set(room_ids)
+        if missing:
+            logger.warning("Failed to find room ids in channel metadata for %s", sorted(missing))
+
+        logger.info("Removing %s from %d room(s) for channel %s", member, len(room_ids), channel)
+        results = await self.remove_from_rooms(
+            channel, room_ids, access_token, kick_matrix_id=kick_matrix_id
+        )
+        for label, result in results.items():
+            logger.info("Removed %s from room %s: %s", member, label, result)
+
+        operation.metadata = {**operation.metadata, "results": results}
+        await DurableOperation.objects.filter(pk=operation.pk).aupdate(metadata=operation.metadata)
+
+        failed = {label: result for label, result in results.items() if result.startswith("error")}
+        if failed:
+            raise Exception(f"Failed to remove {member} from {len(failed)} room(s): {failed}")
+
+
+async def plan_operations(operations: Sequence["DurableOperation"]) -> int:
+    """
+    Checks the pending operations of a plan against local state before any of them runs.
+    Satisfied operations are recorded in the active context, so running them is a no-op.
+
+    Returns the number of operations that will be skipped.
+    """
+    skipped = 0
+    for operation in operations:
+        handler = DurableOperation.get_operation(operation.module)
+        if isinstance(handler, MatrixOperation) and await handler.skip_if_satisfied(operation):
+            skipped += 1
+
+    if operations:
+        logger.info(
+            "Planned %d operation(s), skipping %d already satisfied", len(operations), skipped
+        )
+    return skipped
+
 
 class CreateMatrixRoom(MatrixOperation):
+    async def is_satisfied(self, operation: "DurableOperation") -> bool:
+        # the room was already created for the instance
+        return await self.has_room(operation)
+
     async def run(self, operation: "DurableOperation") -> dict[str, str]:
         """
         Creates a Matrix room for the ReplicatedModel "instance" using the channel.
@@ -333,15 +732,7 @@ class CreateMatrixRoom(MatrixOperation):
         except KeyError as err:
             raise Exception("name must be specified in metadata")
 
-        channel: "MatrixReplicationChannel" = (
-            await operation.channel_type.model_class()
-            .objects.select_related("homeserver", "database")
-            .prefetch_related(
-                "homeserver__credentials",
-                "database__device_memberships__device__matrixcredentials_set",
-            )
-            .aget(pk=operation.channel_id)
-        )  # type: ignore
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
 
         # if the room already exists, return the room id
         # we don't want to overwrite the room id if it already exists
@@ -382,11 +773,45 @@ class CreateMatrixRoom(MatrixOperation):
             ):
                 await self.accept_invite_as_device(account, room_id, channel)
 
-        logger.info("Successfully created Matrix Room for %s" % name)
+        await self.record_room(room_id, channel, operation.instance, metadata_label)
+
+        logger.info("Successfully created Matrix Room for %s", name)
         return {metadata_label: room_id}
 
 
+class CreateReplicationShardRooms(CreateMatrixRoom):
+    @classmethod
+    def create_durable_operations(
+        cls,
+        instance: "ReplicationChannel",
+        channel: "ReplicationChannel",
+    ) -> list["DurableOperation"]:
+        """
+        Create the operations (tasks) for creating the shard rooms of a channel with a
+        ``shard_count`` above 1 (see ``MatrixReplicationChannel.shard_rooms``). Like the
+        device space, every device of the database is invited to them.
+        """
+        from fractal_database.models import DurableOperation
+
+        return [
+            DurableOperation.objects.create(
+                instance=instance,
+                module=CreateMatrixRoom.operation_module(),
+                channel=channel,
+                metadata={
+                    "name": f"{instance.name} shard {shard}",
+                    "metadata_label": SHARD_ROOM_LABEL.format(shard),
+                },
+            )
+            for shard in range(1, getattr(instance, "shard_count", 1))
+        ]
+
+
 class CreateMatrixSpace(MatrixOperation):
+    async def is_satisfied(self, operation: "DurableOperation") -> bool:
+        # the room was already created for the instance
+        return await self.has_room(operation)
+
     async def run(self, operation: "DurableOperation") -> dict[str, str]:
         """
         Creates a Matrix space for the ReplicatedModel "instance" that inherits from this class
@@ -398,18 +823,14 @@ class CreateMatrixSpace(MatrixOperation):
         except KeyError:
             raise Exception("name must be specified in metadata")
 
-        channel: "MatrixReplicationChannel" = (
-            await operation.channel_type.model_class()
-            .objects.select_related("database", "homeserver", "database__parent_db")
-            .aget(pk=operation.channel_id)
-        )  # type: ignore
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
 
         # if the room already exists, return the room id
         # we don't want to overwrite the room id if it already exists
         if operation.instance.metadata.get(metadata_label):
             return {}
 
-        logger.info("Creating Matrix space for %s on channel %s" % (name, channel))
+        logger.info("Creating Matrix space for %s on channel %s", name, channel)
 
         initial_state = [
             {
@@ -438,23 +859,25 @@ class CreateMatrixSpace(MatrixOperation):
         channel.metadata[metadata_label] = room_id
 
         if channel.database:
-            initial_state[0]["content"]["fixture"] = await channel.database.ato_fixture(
-                json=True, with_relations=True
-            )
-        initial_state[1]["content"]["fixture"] = await channel.ato_fixture(
-            json=True, with_relations=True
-        )
+            initial_state[0]["content"]["fixture"] = await self.aget_fixture(channel.database)
+        initial_state[1]["content"]["fixture"] = await self.aget_fixture(channel)
 
         await self.put_state(room_id, channel, "f.database", initial_state[0]["content"])
         await self.put_state(room_id, channel, "f.database.channel", initial_state[1]["content"])
 
-        logger.info("Successfully created Matrix Space for %s on channel %s" % (name, channel))
+        await self.record_room(room_id, channel, operation.instance, metadata_label)
+
+        logger.info("Successfully created Matrix Space for %s on channel %s", name, channel)
         return {
             metadata_label: room_id,
         }
 
 
 class CreateMatrixSubSpace(CreateMatrixSpace):
+    async def is_satisfied(self, operation: "DurableOperation") -> bool:
+        # subspaces are only added to their parent on the homeserver
+        return False
+
     @classmethod
     def create_durable_operations(
         cls,
@@ -478,20 +901,12 @@ class CreateMatrixSubSpace(CreateMatrixSpace):
         # get the model the object that this operation is for
         # (this is usually a Replicationchannel model since only Replicationchannels run operations)
         model_class: "MatrixReplicationChannel" = operation.content_type.model_class()  # type: ignore
-        # fetch the replicated model that this operation is for
-        instance = await model_class.objects.aget(pk=operation.object_id)
-        # get the model for the channel that this operation is for
-        channel_model = operation.channel_type.model_class()
-        # fetch the channel
-        channel: "MatrixReplicationChannel" = await channel_model.objects.select_related(
-            "homeserver"
-        ).aget(
-            pk=operation.channel_id
-        )  # type: ignore
+        # fetch the channel that this operation is for
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
 
         # pull room ids from metadata
-        parent_room_id = channel.metadata["room_id"]
-        child_room_id = instance.metadata["room_id"]
+        parent_room_id = await self.get_channel_room_id(channel)
+        child_room_id = await self.get_room_id(channel, model_class, operation.object_id)
         if parent_room_id == child_room_id:
             raise Exception("Parent and child room IDs cannot be the same")
 
@@ -535,15 +950,10 @@ class CreateDevicesSubSpace(CreateMatrixSubSpace):
         Adds the device space as a subspace to the channel's space
         """
         # get the channel that this operation is for
-        channel_model = operation.channel_type.model_class()
-        channel: "MatrixReplicationChannel" = await channel_model.objects.select_related(
-            "homeserver"
-        ).aget(
-            pk=operation.channel_id
-        )  # type: ignore
-
-        parent_room_id = channel.room
-        child_room_id = channel.device_space
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
+
+        parent_room_id = await self.get_channel_room_id(channel)
+        child_room_id = await self.get_channel_room_id(channel, "devices_room_id")
         if parent_room_id == child_room_id:
             raise Exception("Parent and child room IDs cannot be the same")
 
@@ -582,15 +992,10 @@ class CreateAppsSubSpace(CreateMatrixSubSpace):
         Adds the apps space as a subspace to the channel's space
         """
         # get the channel that this operation is for
-        channel_model = operation.channel_type.model_class()
-        channel: "MatrixReplicationChannel" = await channel_model.objects.select_related(
-            "homeserver"
-        ).aget(
-            pk=operation.channel_id
-        )  # type: ignore
-
-        parent_room_id = channel.room
-        child_room_id = channel.app_space
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
+
+        parent_room_id = await self.get_channel_room_id(channel)
+        child_room_id = await self.get_channel_room_id(channel, "apps_room_id")
         if parent_room_id == child_room_id:
             raise Exception("Parent and child room IDs cannot be the same")
 
@@ -609,29 +1014,20 @@ class InviteDeviceToSpace(MatrixOperation):
         except KeyError:
             raise Exception("metadata_label must be specified in metadata")
 
-        model_class = operation.content_type.model_class()  # type: ignore
-        membership: "DeviceMembership" = await model_class.objects.select_related("device").aget(
-            pk=operation.object_id
-        )  # type: ignore
+        membership: "DeviceMembership" = await self.aget_instance(
+            operation, select_related=("device",)
+        )
 
         # fetch channel in order to get credentials of users to invite to the apps subspace
-        channel: "MatrixReplicationChannel" = (
-            await operation.channel_type.model_class()
-            .objects.select_related("homeserver")
-            .prefetch_related("homeserver__credentials")
-            .aget(pk=operation.channel_id)
-        )  # type: ignore
-
-        device_creds: Optional["MatrixCredentials"] = await channel.homeserver.credentials.filter(
-            device=membership.device
-        ).afirst()
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
+
+        device_creds: Optional["MatrixCredentials"] = await self.aget_device_credentials(
+            channel.homeserver, membership.device
+        )
         if not device_creds:
             raise Exception(f"Failed to find device credentials for {membership.device}")
 
-        try:
-            room_id = channel.metadata[metadata_label]
-        except KeyError:
-            raise Exception(f"Failed to find room id in channel metadata for {metadata_label}")
+        room_id = await self.get_channel_room_id(channel, metadata_label)
 
         try:
             await self.invite_user(device_creds.matrix_id, channel, room_id)
@@ -654,37 +1050,25 @@ class AcceptSpaceInvite(MatrixOperation):
         except KeyError:
             raise Exception("metadata_label must be specified in metadata")
 
-        model_class = operation.content_type.model_class()  # type: ignore
-        membership: "DeviceMembership" = await model_class.objects.select_related("device").aget(
-            pk=operation.object_id
-        )  # type: ignore
+        membership: "DeviceMembership" = await self.aget_instance(
+            operation, select_related=("device",)
+        )
 
         # fetch channel in order to get credentials of users to invite to the apps subspace
-        channel: "MatrixReplicationChannel" = (
-            await operation.channel_type.model_class()
-            .objects.select_related("homeserver")
-            .prefetch_related("homeserver__credentials")
-            .aget(pk=operation.channel_id)
-        )  # type: ignore
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
 
-        try:
-            room_id = channel.metadata[metadata_label]
-        except KeyError:
-            raise Exception(f"Failed to find room id in channel metadata for {metadata_label}")
+        room_id = await self.get_channel_room_id(channel, metadata_label)
 
-        device_creds = await channel.homeserver.credentials.filter(
-            device=membership.device
-        ).afirst()
+        device_creds = await self.aget_device_credentials(channel.homeserver, membership.device)
         if not device_creds:
             raise Exception(f"Failed to find device credentials for {membership.device}")
 
         logger.info(
-            "Accepting invite for %s(%s) as %s"
-            % (metadata_label, room_id, device_creds.matrix_id)
+            "Accepting invite for %s(%s) as %s", metadata_label, room_id, device_creds.matrix_id
         )
         # accept invite on behalf of device
         await self.accept_invite_as_device(device_creds, room_id, channel)
-        logger.info("Device has successfully joined space %s for channel %s" % (room_id, channel))
+        logger.info("Device has successfully joined space %s for channel %s", room_id, channel)
 
         return None
 
@@ -746,19 +1130,14 @@ class CreateServicesSubSpace(CreateMatrixSubSpace):
         Adds the apps space as a subspace to the channel's space
         """
         # get the channel that this operation is for
-        channel_model = operation.channel_type.model_class()
-        channel: "MatrixReplicationChannel" = await channel_model.objects.select_related(
-            "homeserver"
-        ).aget(
-            pk=operation.channel_id
-        )  # type: ignore
-
-        parent_room_id = channel.room
-        child_room_id = channel.service_space
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
+
+        parent_room_id = await self.get_channel_room_id(channel)
+        child_room_id = await self.get_channel_room_id(channel, "services_room_id")
         if parent_room_id == child_room_id:
             raise Exception("Parent and child room IDs cannot be the same")
 
-        logger.info("Adding Services subspace to channel %s" % channel)
+        logger.info("Adding Services subspace to channel %s", channel)
         # add the apps space to the channel's space
         await self.add_subspace(channel, parent_room_id, child_room_id)
 
@@ -768,30 +1147,23 @@ class AcceptDeviceSpaceInvite(MatrixOperation):
         """
         Accepts an invite to the devices subspace on the associated channel.
         """
-        model_class = operation.content_type.model_class()  # type: ignore
-        membership: "DeviceMembership" = await model_class.objects.select_related("device").aget(
-            pk=operation.object_id
-        )  # type: ignore
+        membership: "DeviceMembership" = await self.aget_instance(
+            operation, select_related=("device",)
+        )
 
         # fetch channel in order to get credentials of users to invite to the apps subspace
-        channel: "MatrixReplicationChannel" = (
-            await operation.channel_type.model_class()
-            .objects.select_related("homeserver")
-            .prefetch_related("homeserver__credentials")
-            .aget(pk=operation.channel_id)
-        )  # type: ignore
-
-        device_creds = await channel.homeserver.credentials.filter(
-            device=membership.device
-        ).afirst()
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
+
+        device_creds = await self.aget_device_credentials(channel.homeserver, membership.device)
         if not device_creds:
             raise Exception(f"Failed to find device credentials for {membership.device}")
 
         # accept invite on behalf of device
-        await self.accept_invite_as_device(device_creds, channel.device_space, channel)
-        logger.info(
-            "Device has successfully joined the devices subspace for channel %s" % channel
-        )
+        device_space = await self.get_channel_room_id(channel, "devices_room_id")
+        await self.accept_invite_as_device(device_creds, device_space, channel)
+        for room_id in await _shard_rooms(channel):
+            await self.accept_invite_as_device(device_creds, room_id, channel)
+        logger.info("Device has successfully joined the devices subspace for channel %s", channel)
 
         return None
 
@@ -821,27 +1193,30 @@ class InviteDeviceToDeviceSpace(MatrixOperation):
         Sends an invite to the device in the instance (DeviceMembership) to the
         devices subspace on the associated channel.
         """
-        model_class = operation.content_type.model_class()  # type: ignore
-        membership: "DeviceMembership" = await model_class.objects.select_related("device").aget(
-            pk=operation.object_id
-        )  # type: ignore
+        membership: "DeviceMembership" = await self.aget_instance(
+            operation, select_related=("device",)
+        )
 
         # fetch channel in order to get credentials of users to invite to the apps subspace
-        channel: "MatrixReplicationChannel" = (
-            await operation.channel_type.model_class()
-            .objects.select_related("homeserver")
-            .prefetch_related("homeserver__credentials")
-            .aget(pk=operation.channel_id)
-        )  # type: ignore
-
-        device_creds: Optional["MatrixCredentials"] = await channel.homeserver.credentials.filter(
-            device=membership.device
-        ).afirst()
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
+
+        device_creds: Optional["MatrixCredentials"] = await self.aget_device_credentials(
+            channel.homeserver, membership.device
+        )
         if not device_creds:
             raise Exception(f"Failed to find device credentials for {membership.device}")
 
+        # devices receive bulk replication events of a sharded channel in its shard rooms
+        for room_id in await _shard_rooms(channel):
+            try:
+                await self.invite_user(device_creds.matrix_id, channel, room_id)
+            except Exception as e:
+                if "is already in the room" not in str(e):
+                    raise e
+
+        device_space = await self.get_channel_room_id(channel, "devices_room_id")
         try:
-            await self.invite_user(device_creds.matrix_id, channel, channel.device_space)
+            await self.invite_user(device_creds.matrix_id, channel, device_space)
         except Exception as e:
             # if the device is already in the room, no need to accept the invite
             if "is already in the room" in str(e):
@@ -902,29 +1277,21 @@ class CreateDeviceSubRoom(MatrixOperation):
         except KeyError:
             raise Exception("name must be specified in metadata")
 
-        model_class = operation.content_type.model_class()  # type: ignore
-        instance: "DeviceMembership" = await model_class.objects.aget(pk=operation.object_id)  # type: ignore
+        instance: "DeviceMembership" = await self.aget_instance(operation)
 
         # fetch channel in order to get the device space room id
-        channel: "MatrixReplicationChannel" = (
-            await operation.channel_type.model_class()
-            .objects.select_related("homeserver")
-            .prefetch_related("homeserver__credentials")
-            .aget(pk=operation.channel_id)
-        )  # type: ignore
-
-        device_space = channel.device_space
-        if not device_space:
-            raise Exception(f"Failed to find device room id in channel: {channel}")
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
 
-        device_room_id = instance.metadata.get(str(channel.pk))  # room_id
+        device_space = await self.get_channel_room_id(channel, "devices_room_id")
 
-        await self.add_subspace(
-            channel, parent_room_id=device_space, child_room_id=device_room_id
+        device_room_id = await self.get_room_id(
+            channel, type(instance), instance.pk, str(channel.pk)
         )
 
+        await self.add_subspace(channel, parent_room_id=device_space, child_room_id=device_room_id)
+
         logger.info(
-            "Successfully Matrix Device room for %s as a subspace on channel %s" % (name, channel)
+            "Successfully Matrix Device room for %s as a subspace on channel %s", name, channel
         )
         return None
 
@@ -955,6 +1322,22 @@ class RegisterDeviceAccount(MatrixOperation):
         operations.extend(SetDisplayName.create_durable_operations(instance, channel))
         return operations
 
+    async def is_satisfied(self, operation: "DurableOperation") -> bool:
+        creds = self.get_creds()
+        if not creds:
+            return False
+
+        _, homeserver_url, _ = creds
+        device: "Device" = await self.aget_instance(
+            operation,
+            prefetch_related=("matrixcredentials_set", "matrixcredentials_set__homeserver"),
+        )
+        # the device already has an account on the homeserver
+        return any(
+            device_creds.homeserver.url == homeserver_url
+            for device_creds in device.matrixcredentials_set.all()
+        )
+
     async def run(self, operation: "DurableOperation") -> dict[str, str]:
         """
         Registers an account for the device
@@ -964,14 +1347,12 @@ class RegisterDeviceAccount(MatrixOperation):
         except KeyError as err:
             raise Exception(f"{err.args[0]} must be specified in metadata")
 
-        model_class = operation.content_type.model_class()  # type: ignore
-        device: "Device" = await model_class.objects.prefetch_related(
-            "matrixcredentials_set", "matrixcredentials_set__homeserver"
-        ).aget(
-            pk=operation.object_id
-        )  # type: ignore
+        device: "Device" = await self.aget_instance(
+            operation,
+            prefetch_related=("matrixcredentials_set", "matrixcredentials_set__homeserver"),
+        )
 
-        creds = AuthenticatedController.get_creds()
+        creds = self.get_creds()
         if not creds:
             raise Exception("You must be logged in to Matrix to register a device account")
 
@@ -982,8 +1363,9 @@ class RegisterDeviceAccount(MatrixOperation):
         ).afirst()
         if homeserver_creds:
             logger.info(
-                "Device account for %s is already registered with homeserver %s"
-                % (device, homeserver_url)
+                "Device account for %s is already registered with homeserver %s",
+                device,
+                homeserver_url,
             )
             return {}
 
@@ -1002,13 +1384,15 @@ class RegisterOwnedDevices(MatrixOperation):
     @classmethod
     def create_durable_operations(
         cls,
-        device: "Device",
+        instance: "MatrixHomeserver",
         channel: "ReplicationChannel",
     ) -> list["DurableOperation"]:
         """
-        Create the operations (tasks) for creating a Matrix space
+        Create the operations (tasks) for registering the logged in user's devices with the
+        homeserver. Unless ``FRACTAL_MATRIX_BULK_DEVICE_REGISTRATION`` is disabled, all of
+        the devices are registered by a single operation.
         """
-        from fractal_database.models import Device
+        from fractal_database.models import Device, DurableOperation
 
         creds = AuthenticatedController.get_creds()
         if not creds:
@@ -1017,13 +1401,67 @@ class RegisterOwnedDevices(MatrixOperation):
             )
 
         _, _, owner_matrix_id = creds
-        ops = []
+        devices = Device.objects.filter(owner_matrix_id=owner_matrix_id)
 
-        for device in Device.objects.filter(owner_matrix_id=owner_matrix_id):
+        if BULK_DEVICE_REGISTRATION:
+            return [
+                DurableOperation.objects.create(
+                    instance=instance,
+                    module=cls.operation_module(),
+                    channel=channel,
+                    metadata={
+                        "devices": {
+                            str(device.pk): device.operation_metadata_props() for device in devices
+                        }
+                    },
+                )
+            ]
+
+        ops = []
+        for device in devices:
             ops.extend(RegisterDeviceAccount.create_durable_operations(device, channel))
 
         return ops
 
+    async def _unregistered(
+        self, homeserver: "MatrixHomeserver", devices: dict[str, dict[str, Any]]
+    ) -> dict[str, dict[str, Any]]:
+        from fractal_database.models import Device
+
+        unregistered = {}
+        async for device in Device.objects.filter(pk__in=list(devices)):
+            if not await self.aget_device_credentials(homeserver, device):
+                unregistered[str(device.pk)] = devices[str(device.pk)]
+        return unregistered
+
+    async def is_satisfied(self, operation: "DurableOperation") -> bool:
+        homeserver: "MatrixHomeserver" = await self.aget_instance(operation)
+        devices = (operation.metadata or {}).get("devices") or {}
+        return not await self._unregistered(homeserver, devices)
+
+    async def run(self, operation: "DurableOperation") -> None:
+        """
+        Registers accounts for the devices that don't have one on the homeserver yet.
+        """
+        from fractal_database.models import DurableOperation
+
+        homeserver: "MatrixHomeserver" = await self.aget_instance(operation)
+        devices = await self._unregistered(homeserver, operation.metadata.get("devices") or {})
+        if not devices:
+            return None
+
+        logger.info("Registering %d device account(s) with %s", len(devices), homeserver)
+        results = await self.register_device_accounts(homeserver, devices)
+        for device_id, result in results.items():
+            logger.info("Registered device %s: %s", device_id, result)
+
+        operation.metadata = {**operation.metadata, "results": results}
+        await DurableOperation.objects.filter(pk=operation.pk).aupdate(metadata=operation.metadata)
+
+        failed = {pk: result for pk, result in results.items() if result.startswith("error")}
+        if failed:
+            raise Exception(f"Failed to register {len(failed)} device account(s): {failed}")
+
 
 class CreateMatrixDatabase(CreateMatrixSpace):
     @classmethod
@@ -1059,6 +1497,11 @@ class CreateMatrixDatabase(CreateMatrixSpace):
                 CreateDeviceSubRoom.create_durable_operations(device_membership, channel)
             )
 
+        # created once the device accounts are registered so that they get invited
+        database_space.extend(
+            CreateReplicationShardRooms.create_durable_operations(instance, channel)
+        )
+
         if not USE_MINIMIZED_REPRESENTATION:
             try:
                 App.objects.get(pk=instance.database.pk)
@@ -1136,21 +1579,10 @@ class AddExistingMatrixSubSpace(CreateMatrixSubSpace):
         """
         from fractal_database.models import App, Service
 
-        # get the model the object that this operation is for
-        # (this is usually a Replicationchannel model since only Replicationchannels run operations)
-        model_class: "MatrixReplicationChannel" = operation.content_type.model_class()  # type: ignore
         # fetch the replicated model that this operation is for
-        instance = await model_class.objects.select_related("database").aget(
-            pk=operation.object_id
-        )
-        # get the model for the channel that this operation is for
-        channel_model = operation.channel_type.model_class()
-        # fetch the channel
-        channel: "MatrixReplicationChannel" = (
-            await channel_model.objects.select_related("homeserver")
-            .prefetch_related("homeserver__credentials")
-            .aget(pk=operation.channel_id)
-        )  # type: ignore
+        instance = await self.aget_instance(operation, select_related=("database",))
+        # fetch the channel that this operation is for
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
 
         # check if instance is a Service
         # FIXME: Use channel.database_type to figure out which space to add under
@@ -1158,20 +1590,19 @@ class AddExistingMatrixSubSpace(CreateMatrixSubSpace):
             await Service.objects.aget(pk=instance.database.pk)
         except Service.DoesNotExist:
             # not a service, so nest it under the database's main space
-            parent_room_id = channel.room
+            parent_room_id = await self.get_channel_room_id(channel)
         else:
             # instance.database is a type of service, so check if instance is an App
             try:
                 await App.objects.aget(pk=instance.database.pk)
             except App.DoesNotExist:
                 # not an app, just a service so nest it under the service space
-                parent_room_id = channel.service_space
+                parent_room_id = await self.get_channel_room_id(channel, "services_room_id")
             else:
                 # instance is an App, so nest it under the app space
-                parent_room_id = channel.app_space
+                parent_room_id = await self.get_channel_room_id(channel, "apps_room_id")
 
-        # pull room ids from metadata
-        child_room_id = instance.metadata["room_id"]
+        child_room_id = await self.get_room_id(channel, type(instance), instance.pk)
         if parent_room_id == child_room_id:
             raise Exception("Parent and child room IDs cannot be the same")
 
@@ -1190,24 +1621,17 @@ class SetDisplayName(MatrixOperation):
         except KeyError as err:
             raise Exception(f"{err.args[0]} must be specified in metadata")
 
-        model_class = operation.content_type.model_class()  # type: ignore
-        device: "Device" = await model_class.objects.prefetch_related().aget(
-            pk=operation.object_id
-        )  # type: ignore
+        device: "Device" = await self.aget_instance(operation)
 
         # fetch channel in order to get credentials of users to invite to the apps subspace
-        channel: "MatrixReplicationChannel" = (
-            await operation.channel_type.model_class()
-            .objects.select_related("homeserver")
-            .prefetch_related("homeserver__credentials")
-            .aget(pk=operation.channel_id)
-        )  # type: ignore
-
-        device_creds = await channel.homeserver.credentials.filter(device=device).afirst()
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
+
+        device_creds = await self.aget_device_credentials(channel.homeserver, device)
         if not device_creds:
             logger.error(
-                "Failed to find matrix credentials for device %s for %s"
-                % (device, channel.homeserver)
+                "Failed to find matrix credentials for device %s for %s",
+                device,
+                channel.homeserver,
             )
             raise Exception(
                 "Failed to find matrix credentials for device %s for %s"
@@ -1220,6 +1644,10 @@ class SetDisplayName(MatrixOperation):
 
 
 class CreateAppSpace(CreateMatrixDatabase):
+    async def is_satisfied(self, operation: "DurableOperation") -> bool:
+        # adds the app's space to the apps subspace, which isn't tracked locally
+        return False
+
     @classmethod
     def create_durable_operations(
         cls,
@@ -1250,28 +1678,20 @@ class CreateAppSpace(CreateMatrixDatabase):
         except KeyError:
             raise Exception("name must be specified in metadata")
 
-        model_class = operation.content_type.model_class()  # type: ignore
-        instance: "App" = await model_class.objects.aget(pk=operation.object_id)
+        instance: "App" = await self.aget_instance(operation)
 
         # fetch channel in order to get credentials of users to invite to the apps subspace
-        channel: "MatrixReplicationChannel" = (
-            await operation.channel_type.model_class()
-            .objects.select_related("homeserver")
-            .aget(pk=operation.channel_id)
-        )  # type: ignore
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
 
-        try:
-            app_space = instance.metadata["room_id"]
-        except Exception as err:
-            raise Exception(
-                f"Failed to find app room id in instance metadata: {instance}"
-            ) from err
+        app_space = await self.get_room_id(channel, type(instance), instance.pk)
+        apps_space = await self.get_channel_room_id(channel, "apps_room_id")
 
-        await self.add_subspace(channel, channel.app_space, app_space)
+        await self.add_subspace(channel, apps_space, app_space)
 
         logger.info(
-            "Successfully created App Space for %s in Matrix representation on channel %s"
-            % (name, channel)
+            "Successfully created App Space for %s in Matrix representation on channel %s",
+            name,
+            channel,
         )
         return None
 
@@ -1287,30 +1707,24 @@ class AcceptDatabaseMemberInvite(MatrixOperation):
         except KeyError:
             raise Exception("room_id_label must be specified in metadata")
 
-        model_class = operation.content_type.model_class()  # type: ignore
-        membership: "DatabaseMembership" = await model_class.objects.select_related("user").aget(
-            pk=operation.object_id
-        )  # type: ignore
+        membership: "DatabaseMembership" = await self.aget_instance(
+            operation, select_related=("user",)
+        )
 
         # fetch channel in order to get room_id for the group to invite user to
-        channel: "MatrixReplicationChannel" = (
-            await operation.channel_type.model_class()
-            .objects.select_related("homeserver")
-            .aget(pk=operation.channel_id)
-        )  # type: ignore
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
 
         user_matrix_id = membership.user.matrix_id
         if not user_matrix_id:
             raise Exception(f"Failed to find user {membership.user} matrix id")
 
-        try:
-            room_id = channel.metadata[room_id_label]
-        except KeyError:
-            raise Exception(f"Failed to find room id in channel metadata for {room_id_label}")
+        room_id = await self.get_channel_room_id(channel, room_id_label)
 
         logger.info(
-            "Accepting invite to %s as user %s for channel %s"
-            % (room_id_label, user_matrix_id, channel)
+            "Accepting invite to %s as user %s for channel %s",
+            room_id_label,
+            user_matrix_id,
+            channel,
         )
         try:
             await self.accept_invite_as_user(room_id, channel=channel)
@@ -1350,29 +1764,21 @@ class RemoveUserFromRoom(MatrixOperation):
         except KeyError:
             raise Exception("room_id_label must be specified in operation metadata")
 
-        model_class = operation.content_type.model_class()  # type: ignore
-        membership: "DatabaseMembership" = await model_class.objects.select_related("user").aget(
-            pk=operation.object_id
-        )  # type: ignore
+        membership: "DatabaseMembership" = await self.aget_instance(
+            operation, select_related=("user",)
+        )
 
         # fetch channel in order to get room_id for the group to invite user to
-        channel: "MatrixReplicationChannel" = (
-            await operation.channel_type.model_class()
-            .objects.select_related("homeserver")
-            .aget(pk=operation.channel_id)
-        )  # type: ignore
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
 
         user_matrix_id = membership.user.matrix_id
         if not user_matrix_id:
             raise Exception(f"Failed to find user {membership.user} matrix id")
 
-        try:
-            room_id = channel.metadata[room_id_label]
-        except KeyError:
-            raise Exception(f"Failed to find room id in channel metadata for {room_id_label}")
+        room_id = await self.get_channel_room_id(channel, room_id_label)
 
         logger.info(
-            "User %s is leaving room %s for channel %s" % (user_matrix_id, room_id_label, channel)
+            "User %s is leaving room %s for channel %s", user_matrix_id, room_id_label, channel
         )
         try:
             await self.user_leave_room(channel, room_id)
@@ -1390,25 +1796,42 @@ class RemoveUserFromDatabase(RemoveUserFromRoom):
         channel: "ReplicationChannel",
     ):
         """
-        Create the optional operations (tasks) for removing a user from a Matrix Database
+        Create the optional operation (task) for removing a user from a Matrix Database.
+        A single operation removes the user from all of the rooms on the channel.
         """
         from fractal_database.models import DurableOperation
 
-        # create operations to remove the user from all of the rooms on the channel
-        for room_id_label in channel.metadata.keys():
-            DurableOperation.objects.create(
-                instance=instance,
-                module=RemoveUserFromRoom.operation_module(),
-                channel=channel,
-                metadata={"room_id_label": room_id_label},
-            )
+        DurableOperation.objects.create(
+            instance=instance,
+            module=cls.operation_module(),
+            channel=channel,
+            metadata={"room_id_labels": list(channel.metadata.keys())},
+        )
 
         return None
 
     async def run(self, operation: "DurableOperation") -> None:
-        # this operation needs to simply create the operations to remove the user from the rooms
-        # those will individually handle the actual removal
-        # this does not need to do anything else
+        membership: "DatabaseMembership" = await self.aget_instance(
+            operation, select_related=("user",)
+        )
+
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
+
+        user_matrix_id = membership.user.matrix_id
+        if not user_matrix_id:
+            raise Exception(f"Failed to find user {membership.user} matrix id")
+
+        creds = self.get_creds()
+        if not creds:
+            raise Exception("You must be logged in to remove a user from a room")
+        access_token, _, logged_in_matrix_id = creds
+
+        # kick the user unless the logged in user is the one being removed
+        kick_matrix_id = user_matrix_id if user_matrix_id != logged_in_matrix_id else None
+        await self._remove_member_from_rooms(
+            operation, channel, access_token, user_matrix_id, kick_matrix_id=kick_matrix_id
+        )
+
         return None
 
 
@@ -1419,19 +1842,14 @@ class RemoveDeviceFromRoom(RemoveUserFromRoom):
         except KeyError:
             raise Exception("room_id_label must be specified in operation metadata")
 
-        model_class = operation.content_type.model_class()  # type: ignore
-        membership: "DeviceMembership" = (
-            await model_class.objects.select_related("device")
-            .prefetch_related("device__matrixcredentials_set")
-            .aget(pk=operation.object_id)
-        )  # type: ignore
+        membership: "DeviceMembership" = await self.aget_instance(
+            operation,
+            select_related=("device",),
+            prefetch_related=("device__matrixcredentials_set",),
+        )
 
         # fetch channel in order to get room_id for the group to invite user to
-        channel: "MatrixReplicationChannel" = (
-            await operation.channel_type.model_class()
-            .objects.select_related("homeserver")
-            .aget(pk=operation.channel_id)
-        )  # type: ignore
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
 
         device_creds = await membership.device.matrixcredentials_set.filter(
             homeserver=channel.homeserver
@@ -1442,14 +1860,13 @@ class RemoveDeviceFromRoom(RemoveUserFromRoom):
                 f"Cannot remove device {membership.device.name} from room as credentials for {channel.homeserver} cannot be found"
             )
 
-        try:
-            room_id = channel.metadata[room_id_label]
-        except KeyError:
-            raise Exception(f"Failed to find room id in channel metadata for {room_id_label}")
+        room_id = await self.get_channel_room_id(channel, room_id_label)
 
         logger.info(
-            "Removing device %s from room %s for channel %s"
-            % (membership.device.name, room_id_label, channel)
+            "Removing device %s from room %s for channel %s",
+            membership.device.name,
+            room_id_label,
+            channel,
         )
         try:
             await self.user_leave_room(channel, room_id, creds=device_creds)
@@ -1467,25 +1884,41 @@ class RemoveDeviceFromDatabase(RemoveDeviceFromRoom):
         channel: "ReplicationChannel",
     ):
         """
-        Create the optional operations (tasks) for removing a device from a Matrix Database
+        Create the optional operation (task) for removing a device from a Matrix Database.
+        A single operation removes the device from all of the rooms on the channel.
         """
         from fractal_database.models import DurableOperation
 
-        # create the operations to remove the device from all of the rooms on the channel
-        for room_id_label in channel.metadata.keys():
-            DurableOperation.objects.create(
-                instance=instance,
-                module=RemoveDeviceFromRoom.operation_module(),
-                channel=channel,
-                metadata={"room_id_label": room_id_label},
-            )
+        DurableOperation.objects.create(
+            instance=instance,
+            module=cls.operation_module(),
+            channel=channel,
+            metadata={"room_id_labels": list(channel.metadata.keys())},
+        )
 
         return None
 
     async def run(self, operation: "DurableOperation") -> None:
-        # this operation needs to simply create the operations to remove the device from the rooms
-        # those operations will individually handle the actual removal
-        # this does not need to do anything else
+        membership: "DeviceMembership" = await self.aget_instance(
+            operation,
+            select_related=("device",),
+            prefetch_related=("device__matrixcredentials_set",),
+        )
+
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
+
+        device_creds = await membership.device.matrixcredentials_set.filter(
+            homeserver=channel.homeserver
+        ).afirst()
+        if not device_creds:
+            raise Exception(
+                f"Cannot remove device {membership.device.name} from room as credentials for {channel.homeserver} cannot be found"
+            )
+
+        await self._remove_member_from_rooms(
+            operation, channel, device_creds.access_token, device_creds.matrix_id
+        )
+
         return None
 
 
@@ -1557,30 +1990,24 @@ class InviteDatabaseMemberToSpace(MatrixOperation):
         except KeyError:
             raise Exception("room_id_label must be specified in operation metadata")
 
-        model_class = operation.content_type.model_class()  # type: ignore
-        membership: "DatabaseMembership" = await model_class.objects.select_related("user").aget(
-            pk=operation.object_id
-        )  # type: ignore
+        membership: "DatabaseMembership" = await self.aget_instance(
+            operation, select_related=("user",)
+        )
 
         # fetch channel in order to get room_id for the group to invite user to
-        channel: "MatrixReplicationChannel" = (
-            await operation.channel_type.model_class()
-            .objects.select_related("homeserver")
-            .aget(pk=operation.channel_id)
-        )  # type: ignore
+        channel: "MatrixReplicationChannel" = await self.aget_channel(operation)
 
         user_matrix_id = membership.user.matrix_id
         if not user_matrix_id:
             raise Exception(f"Failed to find user {membership.user} matrix id")
 
-        try:
-            room_id = channel.metadata[room_id_label]
-        except KeyError:
-            raise Exception(f"Failed to find room id in channel metadata for {room_id_label}")
+        room_id = await self.get_channel_room_id(channel, room_id_label)
 
         logger.info(
-            "Sending an invite to %s invite to %s for channel %s"
-            % (room_id_label, user_matrix_id, channel)
+            "Sending an invite to %s invite to %s for channel %s",
+            room_id_label,
+            user_matrix_id,
+            channel,
         )
         try:
             await self.invite_user(user_matrix_id, channel, room_id)
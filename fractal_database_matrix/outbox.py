@@ -0,0 +1,402 @@
+"""
+Durable outbox for replication pushes.
+
+With ``FRACTAL_REPLICATION_OUTBOX`` enabled, ``push_replication_log`` doesn't kick its
+task to the homeserver itself. It writes the replication event to the local
+``ReplicationOutbox`` table instead (inside the caller's transaction, if there is one),
+so pushing runs at local disk speed whether the homeserver is up or not.
+
+A background drainer sends the pending entries in batches. Entries of a channel are sent
+strictly in ``seq`` order: when one fails, the channel's later entries wait until it has
+been retried (with exponential backoff) and sent. Entries survive crashes and restarts,
+the drainer picks up whatever is left when the next push starts it (or when ``drain`` is
+called). Entries enqueued in a transaction that hasn't committed yet are picked up by the
+next poll.
+
+When a newer version of an object is enqueued while an older one is still waiting to be
+sent, the older version is dropped from its entry (and the entry deleted once it has no
+objects left), so the homeserver and receivers don't get versions they would prune
+anyway. The newer version keeps its own place in the outbox, after anything it may
+depend on that was pushed in between. An older version that another pending object
+refers to is kept, so the referring object never arrives before the object it refers to.
+
+Several processes (pushers and workers) can run a drainer on the same database. A
+drainer only sends the entries of channels it has claimed (see ``claim``); a claim lapses
+after ``CLAIM_TIMEOUT`` if its drainer dies, so another one can take over.
+
+An event can be sent twice if the process dies between sending it and marking it as sent.
+That's harmless: receivers skip objects that are older than their local copy.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+from datetime import timedelta
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from uuid import uuid4
+
+from django.db.models import Q
+from django.utils import timezone
+
+from . import metrics
+from .apply import referenced_values
+from .lag import SEQ_LABEL, next_seq
+from .payloads import fixture_objects
+
+if TYPE_CHECKING:
+    from fractal_database_matrix.models import MatrixReplicationChannel, ReplicationOutbox
+
+logger = logging.getLogger(__name__)
+
+# number of entries fetched (and sent) per batch
+BATCH_SIZE = int(os.environ.get("FRACTAL_REPLICATION_OUTBOX_BATCH_SIZE", 50))
+# seconds between checks for entries written by other processes
+POLL_INTERVAL = float(os.environ.get("FRACTAL_REPLICATION_OUTBOX_POLL_INTERVAL", 5))
+MAX_BACKOFF = 300
+# sent entries are kept this long before being deleted
+RETENTION = timedelta(days=1)
+# how long a channel stays claimed by a drainer without being renewed
+CLAIM_TIMEOUT = timedelta(
+    seconds=float(os.environ.get("FRACTAL_REPLICATION_OUTBOX_CLAIM_TIMEOUT", 120))
+)
+# identifies this process' drainer in channel claims
+DRAINER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+
+# (model, pk) of a serialized object
+_Object = Tuple[str, str]
+# (channel pk, room id, model, pk)
+_ObjectKey = Tuple[str, str, str, str]
+
+
+def _versioned_objects(objects: Iterable[Any]) -> Iterator[Tuple[_Object, int]]:
+    for item in objects:
+        if not isinstance(item, dict):
+            continue
+        version = (item.get("fields") or {}).get("object_version")
+        if version is not None:
+            yield (item.get("model", ""), str(item.get("pk"))), version
+
+
+class PendingObjects:
+    """
+    Index of the versioned objects in the unsent outbox entries enqueued by this process,
+    used to find the entries a newer version of an object supersedes.
+
+    Entries enqueued by another process, or before a restart, aren't indexed. Their
+    objects are sent as they are, and receivers prune them.
+    """
+
+    def __init__(self):
+        # object -> (pk of the entry it was enqueued in, its version)
+        self._objects: Dict[_ObjectKey, Tuple[Any, int]] = {}
+        # entry pk -> the objects indexed for it
+        self._entries: Dict[Any, Set[_ObjectKey]] = {}
+
+    def add(self, entry: "ReplicationOutbox", objects: Iterable[Any]) -> None:
+        keys = set()
+        for (model, pk), version in _versioned_objects(objects):
+            key = (str(entry.channel_id), entry.room_id, model, pk)
+            self._objects[key] = (entry.pk, version)
+            keys.add(key)
+        if keys:
+            self._entries[entry.pk] = keys
+
+    def superseded(
+        self, channel_pk: Any, room_id: str, objects: Iterable[Any]
+    ) -> Dict[Any, Set[_Object]]:
+        """
+        Returns the objects that have an older version waiting to be sent to the room,
+        grouped by the pk of the entry holding them.
+        """
+        superseded: Dict[Any, Set[_Object]] = {}
+        for (model, pk), version in _versioned_objects(objects):
+            pending = self._objects.get((str(channel_pk), room_id, model, pk))
+            if pending is not None and pending[1] < version:
+                superseded.setdefault(pending[0], set()).add((model, pk))
+        return superseded
+
+    def discard(self, entry_pk: Any) -> None:
+        """
+        Forgets the objects of an entry that was sent or deleted.
+        """
+        for key in self._entries.pop(entry_pk, ()):
+            if self._objects.get(key, (None,))[0] == entry_pk:
+                del self._objects[key]
+
+
+PENDING = PendingObjects()
+
+
+async def _unreferenced(
+    entry: "ReplicationOutbox", items: List[Any], objects: Set[_Object]
+) -> Set[_Object]:
+    """
+    Returns the objects that can be dropped from an entry without breaking a reference:
+    those that no object left in the entry, nor any later unsent entry for the room, refers
+    to. Otherwise the referring object would reach receivers before the newer version.
+    """
+    from fractal_database_matrix.models import ReplicationOutbox
+
+    droppable = set(objects)
+    # an object that is kept may itself refer to one of the other droppable objects
+    changed = True
+    while changed:
+        referenced = {
+            str(value)
+            for item in items
+            if isinstance(item, dict) and (item.get("model"), str(item.get("pk"))) not in droppable
+            for value in referenced_values(item.get("fields") or {})
+        }
+        kept = {obj for obj in droppable if obj[1] in referenced}
+        droppable -= kept
+        changed = bool(kept)
+
+    later = ReplicationOutbox.objects.filter(
+        channel_id=entry.channel_id, room_id=entry.room_id, sent=False, seq__gt=entry.seq
+    )
+    for obj in list(droppable):
+        # pks are UUIDs, so a match in the raw payload is a reference
+        if await later.filter(payload__contains=obj[1]).aexists():
+            droppable.discard(obj)
+    return droppable
+
+
+async def _drop_objects(entry_pk: Any, objects: Set[_Object]) -> int:
+    """
+    Removes objects from an unsent entry, deleting the entry if none are left. Objects
+    that something else waiting to be sent refers to are left in place.
+
+    Returns:
+        The number of objects removed.
+    """
+    from fractal_database_matrix.models import ReplicationOutbox
+
+    entry = await ReplicationOutbox.objects.filter(pk=entry_pk, sent=False).afirst()
+    if entry is None:
+        PENDING.discard(entry_pk)
+        return 0
+
+    event = json.loads(entry.payload)
+    items = fixture_objects(event)
+    if items is None:
+        return 0
+    objects = await _unreferenced(entry, items, objects)
+    remaining = [
+        item
+        for item in items
+        if not isinstance(item, dict) or (item.get("model"), str(item.get("pk"))) not in objects
+    ]
+    if not remaining:
+        await ReplicationOutbox.objects.filter(pk=entry_pk, sent=False).adelete()
+        PENDING.discard(entry_pk)
+    elif len(remaining) < len(items):
+        if isinstance(event, dict):
+            event["payload"] = remaining
+        else:
+            event = remaining
+        await ReplicationOutbox.objects.filter(pk=entry_pk, sent=False).aupdate(
+            payload=json.dumps(event)
+        )
+    return len(items) - len(remaining)
+
+
+async def enqueue(
+    channel: "MatrixReplicationChannel",
+    room_id: str,
+    replication_event: str,
+    task_labels: Dict[str, Any],
+    fixture: Any = None,
+) -> "ReplicationOutbox":
+    """
+    Writes a replication event to the outbox and wakes up the drainer. Older versions of
+    the fixture's objects that haven't been sent yet are dropped from the outbox.
+    """
+    from fractal_database_matrix.models import ReplicationOutbox
+
+    objects = fixture_objects(fixture) or []
+    dropped = 0
+    for entry_pk, superseded in PENDING.superseded(channel.pk, room_id, objects).items():
+        dropped += await _drop_objects(entry_pk, superseded)
+    if dropped:
+        logger.debug("Dropped %d superseded object(s) from the outbox of %s", dropped, channel)
+        metrics.OUTBOX_SUPERSEDED.inc(dropped, channel=channel.name)
+
+    entry = await ReplicationOutbox.objects.acreate(
+        channel=channel,
+        room_id=room_id,
+        seq=task_labels.get(SEQ_LABEL) or next_seq(),
+        payload=replication_event,
+        labels=task_labels,
+    )
+    PENDING.add(entry, objects)
+    metrics.OUTBOX_ENQUEUED.inc(channel=channel.name)
+    DRAINER.wake()
+    return entry
+
+
+class OutboxDrainer:
+    """
+    Sends pending outbox entries in the background of the running event loop.
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def wake(self) -> None:
+        """
+        Starts the drainer if it isn't running and tells it there is work to do.
+        """
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        assert self._wakeup is not None
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        assert self._wakeup is not None
+        while True:
+            self._wakeup.clear()
+            try:
+                delay = await drain()
+            except Exception as e:
+                logger.exception("Failed to drain the replication outbox: %s", e)
+                delay = POLL_INTERVAL
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+DRAINER = OutboxDrainer()
+
+
+async def claim(channel_pk: Any) -> bool:
+    """
+    Claims (or renews the claim on) a channel's outbox for this process' drainer.
+
+    Returns:
+        Whether the channel is claimed by this drainer. If it isn't, another drainer is
+        sending its entries.
+    """
+    from fractal_database_matrix.models import MatrixReplicationChannel
+
+    now = timezone.now()
+    claimed = await MatrixReplicationChannel.objects.filter(
+        Q(outbox_claimed_by__isnull=True)
+        | Q(outbox_claimed_by=DRAINER_ID)
+        | Q(outbox_claimed_until__lt=now),
+        pk=channel_pk,
+    ).aupdate(outbox_claimed_by=DRAINER_ID, outbox_claimed_until=now + CLAIM_TIMEOUT)
+    return bool(claimed)
+
+
+async def release(channel_pks: Iterable[Any]) -> None:
+    from fractal_database_matrix.models import MatrixReplicationChannel
+
+    await MatrixReplicationChannel.objects.filter(
+        pk__in=list(channel_pks), outbox_claimed_by=DRAINER_ID
+    ).aupdate(outbox_claimed_by=None, outbox_claimed_until=None)
+
+
+async def _send(entry: "ReplicationOutbox") -> Optional[str]:
+    try:
+        await entry.channel.send_replication_event(entry.payload, entry.room_id, entry.labels)
+    except Exception as e:
+        return str(e) or type(e).__name__
+    return None
+
+
+async def drain(batch_size: int = BATCH_SIZE) -> float:
+    """
+    Sends the pending outbox entries that are due, in batches.
+
+    Returns:
+        The number of seconds until the next entry is due for a retry, or the poll
+        interval if nothing is waiting for a retry.
+    """
+    from fractal_database_matrix.models import ReplicationOutbox
+
+    # channels whose oldest pending entry isn't due (or just failed) hold back the rest
+    # of their entries, as do channels claimed by another drainer
+    blocked: Set[Any] = set()
+    claimed: Set[Any] = set()
+    next_due: Optional[float] = None
+    while True:
+        # claims are renewed once per batch
+        renewed: Set[Any] = set()
+        now = timezone.now()
+        entries: List[ReplicationOutbox] = [
+            entry
+            async for entry in ReplicationOutbox.objects.select_related("channel__homeserver")
+            .filter(sent=False)
+            .exclude(channel_id__in=blocked)
+            .order_by("seq")[:batch_size]
+        ]
+        if not entries:
+            break
+
+        sent = []
+        for entry in entries:
+            if entry.channel_id in blocked:
+                continue
+            if entry.channel_id not in renewed:
+                if not await claim(entry.channel_id):
+                    blocked.add(entry.channel_id)
+                    continue
+                renewed.add(entry.channel_id)
+                claimed.add(entry.channel_id)
+            if entry.next_attempt and entry.next_attempt > now:
+                blocked.add(entry.channel_id)
+                wait = (entry.next_attempt - now).total_seconds()
+                next_due = wait if next_due is None else min(next_due, wait)
+                continue
+
+            error = await _send(entry)
+            if error is None:
+                sent.append(entry.pk)
+                metrics.OUTBOX_SENT.inc(channel=entry.channel.name)
+                continue
+
+            blocked.add(entry.channel_id)
+            backoff = min(2**entry.attempts, MAX_BACKOFF)
+            logger.warning(
+                "Failed to push outbox entry %s to room %s (attempt %d), retrying in %ds: %s",
+                entry.seq,
+                entry.room_id,
+                entry.attempts + 1,
+                backoff,
+                error,
+            )
+            await ReplicationOutbox.objects.filter(pk=entry.pk).aupdate(
+                attempts=entry.attempts + 1,
+                last_error=error,
+                next_attempt=timezone.now() + timedelta(seconds=backoff),
+            )
+            next_due = backoff if next_due is None else min(next_due, backoff)
+
+        if sent:
+            await ReplicationOutbox.objects.filter(pk__in=sent).aupdate(
+                sent=True, date_sent=timezone.now(), last_error=None
+            )
+            for pk in sent:
+                PENDING.discard(pk)
+
+    if claimed:
+        await release(claimed)
+    await ReplicationOutbox.objects.filter(
+        sent=True, date_sent__lt=timezone.now() - RETENTION
+    ).adelete()
+    return next_due if next_due is not None else POLL_INTERVAL
@@ -0,0 +1,49 @@
+import hashlib
+from collections import Counter
+from typing import Any, Optional
+
+
+def fixture_objects(fixture: Any) -> Optional[list]:
+    """
+    Returns the list of serialized objects in a fixture or replication event.
+    """
+    if isinstance(fixture, dict):
+        fixture = fixture.get("payload")
+    return fixture if isinstance(fixture, list) else None
+
+
+class PayloadSummary:
+    """
+    Loggable stand-in for a replication payload.
+
+    Renders the payload's size, object counts per model and a short sha256 instead of
+    the payload itself. Nothing is computed until the summary is actually formatted,
+    so passing one to a disabled log level costs nothing.
+    """
+
+    def __init__(self, serialized: str, fixture: Any = None):
+        self.serialized = serialized
+        self.fixture = fixture
+
+    @property
+    def size(self) -> int:
+        return len(self.serialized.encode())
+
+    @property
+    def sha256(self) -> str:
+        return hashlib.sha256(self.serialized.encode()).hexdigest()[:16]
+
+    def counts(self) -> Counter:
+        objects = fixture_objects(self.fixture) or []
+        return Counter(
+            item.get("model", "unknown") if isinstance(item, dict) else "unknown"
+            for item in objects
+        )
+
+    def __str__(self) -> str:
+        counts = self.counts()
+        models = ", ".join(f"{model}={count}" for model, count in counts.most_common())
+        return (
+            f"{sum(counts.values())} object(s) [{models}] "
+            f"{self.size} bytes sha256:{self.sha256}"
+        )
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from enum import Enum
+from typing import Any, Deque, Dict, Optional
+
+from .endpoints import canonical_url
+
+logger = logging.getLogger(__name__)
+
+
+class ActionClass(str, Enum):
+    """
+    Classes of homeserver requests that Synapse rate limits independently.
+    """
+
+    ROOM_CREATE = "room_create"
+    INVITE = "invite"
+    JOIN = "join"
+    SEND = "send"
+    OTHER = "other"
+
+
+def classify_request(method: str, path: str) -> ActionClass:
+    """
+    Returns the action class of a Matrix client-server API request.
+    """
+    # strip the query string off of the path
+    path = path.split("?", 1)[0]
+    method = method.upper()
+
+    if path.endswith("/createRoom"):
+        return ActionClass.ROOM_CREATE
+    if path.endswith("/invite"):
+        return ActionClass.INVITE
+    if path.endswith("/join") or "/join/" in path:
+        return ActionClass.JOIN
+    if method == "PUT" and "/send/" in path:
+        return ActionClass.SEND
+    return ActionClass.OTHER
+
+
+class TokenBucket:
+    """
+    Token bucket whose rate is learned from the homeserver's 429 responses.
+
+    The bucket starts out unlimited. When the homeserver rate limits a request, the
+    rate that was observed over the last ``WINDOW`` seconds is recorded as the ceiling
+    and the bucket is throttled to just under it (``HEADROOM``). Successful requests then
+    additively increase the rate back towards (but never past) that headroom so
+    throughput settles just below the limit instead of oscillating around it. While
+    running at the headroom the ceiling creeps up slowly so that an underestimated
+    limit recovers.
+    """
+
+    WINDOW = 10.0
+    HEADROOM = 0.9
+    MIN_RATE = 0.1
+
+    def __init__(self, rate: Optional[float] = None, burst: float = 1.0):
+        self.rate = rate
+        self.ceiling: Optional[float] = None
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.sent: Deque[float] = deque()
+
+    def _refill(self, now: float) -> None:
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _trim(self, now: float) -> None:
+        # only the requests of the last window are needed to observe the rate
+        while self.sent and now - self.sent[0] > self.WINDOW:
+            self.sent.popleft()
+
+    def observed_rate(self, now: Optional[float] = None) -> float:
+        now = now or time.monotonic()
+        self._trim(now)
+        return len(self.sent) / self.WINDOW
+
+    def reserve(self) -> float:
+        """
+        Reserves a token, returning how long the caller has to wait before using it.
+        """
+        now = time.monotonic()
+        self._refill(now)
+
+        wait = max(self.blocked_until - now, 0.0)
+        if self.rate is not None:
+            self.tokens -= 1
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens / self.rate)
+
+        self._trim(now)
+        self.sent.append(now + wait)
+        return wait
+
+    async def acquire(self) -> None:
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_limited(self, retry_after: Optional[float] = None) -> None:
+        now = time.monotonic()
+        observed = self.observed_rate(now)
+        self.ceiling = max(min(observed, self.ceiling or observed), self.MIN_RATE)
+        self.rate = max(self.ceiling * self.HEADROOM, self.MIN_RATE)
+        self.burst = 1.0
+        self.tokens = min(self.tokens, 0.0)
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+
+    def on_success(self) -> None:
+        if self.rate is None or self.ceiling is None:
+            return None
+        if self.rate >= self.ceiling * self.HEADROOM:
+            # slowly raise the ceiling in case it was learned while other clients
+            # were sharing the limit
+            self.ceiling *= 1.001
+        # additive increase, capped just under the learned limit
+        self.rate = min(self.rate + self.ceiling * 0.01, self.ceiling * self.HEADROOM)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "rate": self.rate,
+            "ceiling": self.ceiling,
+            "observed_rate": self.observed_rate(),
+        }
+
+
+class RateLimiter:
+    """
+    Schedules requests to a single homeserver with a token bucket per action class.
+    """
+
+    def __init__(self, homeserver_url: str):
+        self.homeserver_url = homeserver_url
+        self.buckets: Dict[ActionClass, TokenBucket] = {}
+
+    def bucket(self, action: ActionClass) -> TokenBucket:
+        try:
+            return self.buckets[action]
+        except KeyError:
+            bucket = self.buckets[action] = TokenBucket()
+            return bucket
+
+    async def acquire(self, action: ActionClass) -> None:
+        if action == ActionClass.OTHER:
+            return None
+        await self.bucket(action).acquire()
+
+    def on_limited(self, action: ActionClass, retry_after: Optional[float] = None) -> None:
+        bucket = self.bucket(action)
+        bucket.on_limited(retry_after)
+        logger.warning(
+            "Rate limited by %s for %s requests, throttling to %.2f/s",
+            self.homeserver_url,
+            action.value,
+            bucket.rate,
+        )
+
+    def on_success(self, action: ActionClass) -> None:
+        if action in self.buckets:
+            self.buckets[action].on_success()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {action.value: bucket.snapshot() for action, bucket in self.buckets.items()}
+
+
+_limiters: Dict[str, RateLimiter] = {}
+
+
+def get_rate_limiter(homeserver_url: str) -> RateLimiter:
+    """
+    Returns the process wide rate limiter for a homeserver. Local and public URLs
+    of the same homeserver share a limiter.
+    """
+    key = canonical_url(homeserver_url)
+    try:
+        return _limiters[key]
+    except KeyError:
+        limiter = _limiters[key] = RateLimiter(key)
+        return limiter
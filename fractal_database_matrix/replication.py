@@ -0,0 +1,209 @@
+"""
+Parallel, resumable replication of a device's databases to a homeserver.
+
+``replicate_databases`` is the parallel mode of ``fractal replicate to``. Every database
+is handled on its own: its origin channel is set and its Matrix channel is created in a
+short transaction, then the replication logs of its local channel are replayed onto the
+Matrix channel in batches, each batch in its own transaction. Databases are replicated
+concurrently by a bounded pool of worker threads.
+
+Progress is written to the user's data directory after every batch, so that a run that
+gets interrupted resumes where it stopped instead of replaying everything again.
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional
+
+from fractal.cli.utils import read_user_data, write_user_data
+
+if TYPE_CHECKING:
+    from fractal_database.models import Database
+
+    from fractal_database_matrix.models import MatrixHomeserver
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_FILE = "replication_progress.yaml"
+
+# number of replication logs replayed per transaction
+REPLAY_BATCH_SIZE = int(os.environ.get("FRACTAL_REPLICATION_REPLAY_BATCH_SIZE", 500))
+
+
+class ReplicationProgress:
+    """
+    Per database progress of replicating to a homeserver, persisted in the user's data
+    directory. Safe to update from worker threads.
+    """
+
+    def __init__(self, homeserver_url: str, filename: str = PROGRESS_FILE):
+        self.homeserver_url = homeserver_url
+        self.filename = filename
+        self._lock = threading.Lock()
+        try:
+            data, _ = read_user_data(filename)
+        except FileNotFoundError:
+            data = {}
+        self._data: Dict[str, Dict[str, Any]] = data or {}
+        self.databases: Dict[str, Dict[str, Any]] = self._data.setdefault(homeserver_url, {})
+
+    def _write(self) -> None:
+        if self.databases:
+            self._data[self.homeserver_url] = self.databases
+        else:
+            self._data.pop(self.homeserver_url, None)
+        write_user_data(self._data, self.filename)
+
+    def replayed(self, database_pk: str) -> int:
+        return self.databases.get(database_pk, {}).get("replayed", 0)
+
+    def done(self, database_pk: str) -> bool:
+        return self.databases.get(database_pk, {}).get("done", False)
+
+    def update(self, database_pk: str, **progress: Any) -> None:
+        with self._lock:
+            self.databases.setdefault(database_pk, {}).update(progress)
+            self._write()
+
+    def clear(self) -> None:
+        """
+        Forgets the progress once every database has been replicated.
+        """
+        with self._lock:
+            self.databases = {}
+            self._write()
+
+
+def replicate_database(
+    database_pk: str,
+    homeserver: "MatrixHomeserver",
+    progress: ReplicationProgress,
+    batch_size: int = REPLAY_BATCH_SIZE,
+) -> Dict[str, Any]:
+    """
+    Replicates a database to the homeserver through the current database's Matrix channel.
+
+    Returns:
+        The database's name, the number of logs replayed and the time it took.
+    """
+    from django.db import transaction
+    from fractal_database.models import (
+        Database,
+        LocalReplicationChannel,
+        ReplicationLog,
+    )
+    from fractal_database_matrix.models import MatrixReplicationChannel
+
+    start = time.perf_counter()
+    database = Database.objects.get(pk=database_pk)
+    origin_channel = MatrixReplicationChannel.objects.get(
+        homeserver=homeserver, database=Database.current_db()
+    )
+
+    matrix_channels = MatrixReplicationChannel.objects.filter(
+        homeserver=homeserver, database=database, source=True, target=True
+    )
+    replayed = progress.replayed(database_pk)
+    if database_pk not in progress.databases and not matrix_channels.exists():
+        # recorded before the channel is created, so that a run interrupted once it is
+        # created still replays the logs when resumed
+        progress.update(database_pk, replayed=replayed)
+
+    with transaction.atomic():
+        database.set_origin_channel(origin_channel)
+        matrix_channel = matrix_channels.first()
+        created = matrix_channel is None
+        if created:
+            matrix_channel = database.create_channel(
+                MatrixReplicationChannel, homeserver=homeserver, source=True, target=True
+            )
+
+    try:
+        local_channel = LocalReplicationChannel.objects.get(database=database)
+    except LocalReplicationChannel.DoesNotExist:
+        local_channel = None
+
+    if not created and database_pk not in progress.databases:
+        # replicated before this run started tracking it, its logs were replayed already
+        local_channel = None
+
+    if local_channel is not None:
+        # same order as replay_replication_logs_from, with a tie breaker so that batches
+        # line up when resuming
+        logs = local_channel.replication_logs.order_by("date_created", "pk")
+        while True:
+            batch = list(logs[replayed : replayed + batch_size])
+            if not batch:
+                break
+            with transaction.atomic():
+                for log in batch:
+                    ReplicationLog.objects.create(
+                        payload=log.payload,
+                        target=matrix_channel,
+                        instance=log.instance,
+                        object_id=log.object_id,
+                        content_type=log.content_type,
+                        instance_version=log.instance_version,
+                    )
+            replayed += len(batch)
+            progress.update(database_pk, replayed=replayed)
+
+    progress.update(database_pk, replayed=replayed, done=True)
+    return {
+        "database": database.name,
+        "replayed": replayed,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def _replicate(
+    database_pk: str, homeserver: "MatrixHomeserver", progress: ReplicationProgress
+) -> Dict[str, Any]:
+    from django.db import connection
+
+    try:
+        return replicate_database(database_pk, homeserver, progress)
+    except Exception as e:
+        logger.exception("Failed to replicate database %s", database_pk)
+        return {"database": database_pk, "error": str(e)}
+    finally:
+        # worker threads don't outlive the pool, don't leak their connections
+        connection.close()
+
+
+def replicate_databases(
+    databases: Iterable["Database"],
+    homeserver: "MatrixHomeserver",
+    workers: int = 4,
+    progress: Optional[ReplicationProgress] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Replicates the databases concurrently, skipping the ones a previous run already
+    finished. SQLite only allows a single writer, so it is always one database at a time.
+
+    Returns:
+        A report per database (see ``replicate_database``), with an ``error`` for the
+        databases that failed.
+    """
+    from django.db import connection
+
+    progress = progress or ReplicationProgress(homeserver.url)
+    pending = [str(database.pk) for database in databases]
+    skipped = [pk for pk in pending if progress.done(pk)]
+    pending = [pk for pk in pending if not progress.done(pk)]
+    if skipped:
+        logger.info("Resuming replication, %d database(s) already replicated", len(skipped))
+
+    if connection.vendor == "sqlite":
+        workers = 1
+    workers = max(min(workers, len(pending)), 1)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fractal-replicate") as pool:
+        reports = list(pool.map(lambda pk: _replicate(pk, homeserver, progress), pending))
+
+    if not any("error" in report for report in reports):
+        progress.clear()
+    return reports
@@ -0,0 +1,27 @@
+import asyncio
+import json
+import logging
+
+from fractal_database_matrix.apply import apply_fixture
+from fractal_database_matrix.broker.instance import broker
+from fractal_database_matrix.payloads import fixture_objects
+
+logger = logging.getLogger(__name__)
+
+
+@broker.task(queue="replication")
+async def replicate_fixture_parallel(fixture: str, *args, **kwargs) -> None:
+    """
+    Replicates a given fixture into the local database, applying its independent
+    partitions concurrently. Devices that opt into parallel apply have their
+    ReplicationQueue route replicate_fixture tasks here.
+
+    Args:
+    - fixture (str): A Django fixture (or replication event) encoded as a string.
+    """
+    objects = fixture_objects(json.loads(fixture))
+    if objects is None:
+        raise Exception("Replication event does not contain a fixture")
+
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, apply_fixture, objects)
@@ -0,0 +1,308 @@
+"""
+Tracing for durable operations and Matrix requests.
+
+Spans follow the OpenTelemetry data model (W3C trace and span ids, ``traceparent``
+propagation). Tracing is disabled by default and ``span()`` returns a no-op context
+manager while it is. Set ``FRACTAL_MATRIX_TRACING`` (setting or environment variable)
+to enable it:
+
+* ``file`` (or ``1``): finished spans are appended as JSON lines to
+  ``FRACTAL_MATRIX_TRACE_FILE`` (``fractal-traces.jsonl`` by default) so that traces can
+  be analyzed without a collector.
+* ``otel``: spans are created with the ``opentelemetry`` API (if installed) and go to
+  whatever exporters the application configured for it.
+
+The trace context is carried into kicked tasks through the ``traceparent`` task label.
+"""
+
+import contextvars
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from taskiq import TaskiqMessage, TaskiqMiddleware, TaskiqResult
+
+try:
+    from opentelemetry import trace as otel_trace
+    from opentelemetry.trace.propagation.tracecontext import (
+        TraceContextTextMapPropagator,
+    )
+except ImportError:  # pragma: no cover
+    otel_trace = None
+    TraceContextTextMapPropagator = None
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT_LABEL = "traceparent"
+DEFAULT_TRACE_FILE = "fractal-traces.jsonl"
+
+_mode: Optional[str] = None
+_exporter: Optional["FileSpanExporter"] = None
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar(
+    "fractal_matrix_current_span", default=None
+)
+
+
+class FileSpanExporter:
+    """
+    Appends finished spans to a file as JSON lines.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span: "Span") -> None:
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(f"{line}\n")
+
+
+def enable(mode: str = "file", trace_file: Optional[str] = None) -> None:
+    global _mode, _exporter
+    if mode == "otel" and otel_trace is None:
+        logger.warning("opentelemetry is not installed, writing traces to a file instead")
+        mode = "file"
+    _mode = mode
+    if mode == "file":
+        _exporter = FileSpanExporter(
+            trace_file or os.environ.get("FRACTAL_MATRIX_TRACE_FILE") or DEFAULT_TRACE_FILE
+        )
+
+
+def disable() -> None:
+    global _mode, _exporter
+    _mode = None
+    _exporter = None
+
+
+def enabled() -> bool:
+    return _mode is not None
+
+
+class Span:
+    """
+    A finished or in progress span. Used as a context manager it becomes the current
+    span while the block runs and is exported when the block exits.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: Optional[str] = None,
+        parent_span_id: Optional[str] = None,
+        attributes: Optional[Dict[str, Any]] = None,
+    ):
+        self.name = name
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = parent_span_id
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.status = "unset"
+        self.start_time = 0
+        self.end_time = 0
+        self._token: Optional[contextvars.Token] = None
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        if value is not None:
+            self.attributes[key] = value
+
+    def start(self) -> "Span":
+        self.start_time = time.time_ns()
+        self._token = _current_span.set(self)
+        return self
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        self.end_time = time.time_ns()
+        if error is not None:
+            self.status = "error"
+            self.attributes["exception.type"] = type(error).__name__
+            self.attributes["exception.message"] = str(error)
+        elif self.status == "unset":
+            self.status = "ok"
+        if self._token is not None:
+            try:
+                _current_span.reset(self._token)
+            except ValueError:
+                # ended in a different context than it was started in
+                _current_span.set(None)
+            self._token = None
+        if _exporter:
+            _exporter.export(self)
+
+    def __enter__(self) -> "Span":
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.end(exc)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "start_time_unix_nano": self.start_time,
+            "end_time_unix_nano": self.end_time,
+            "duration_ms": round((self.end_time - self.start_time) / 1e6, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class _OtelSpan:
+    """
+    Adapts an opentelemetry span to the ``Span`` interface used by callers.
+    """
+
+    def __init__(self, name: str, traceparent: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.attributes = {k: v for k, v in attributes.items() if v is not None}
+        self._context = None
+        if traceparent:
+            self._context = TraceContextTextMapPropagator().extract(  # type: ignore
+                {TRACEPARENT_LABEL: traceparent}
+            )
+        self._manager = None
+        self._span = None
+
+    @property
+    def traceparent(self) -> Optional[str]:
+        carrier: Dict[str, str] = {}
+        TraceContextTextMapPropagator().inject(carrier)  # type: ignore
+        return carrier.get(TRACEPARENT_LABEL)
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        if value is not None and self._span is not None:
+            self._span.set_attribute(key, value)
+
+    def __enter__(self) -> "_OtelSpan":
+        tracer = otel_trace.get_tracer("fractal_database_matrix")  # type: ignore
+        self._manager = tracer.start_as_current_span(
+            self.name, context=self._context, attributes=self.attributes
+        )
+        self._span = self._manager.__enter__()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._manager.__exit__(*exc)  # type: ignore
+
+
+class _NullSpan:
+    traceparent = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        return None
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        return None
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def _parse_traceparent(traceparent: str) -> Optional[tuple[str, str]]:
+    try:
+        _, trace_id, span_id, _ = traceparent.split("-")
+    except (AttributeError, ValueError):
+        return None
+    if len(trace_id) != 32 or len(span_id) != 16:
+        return None
+    return trace_id, span_id
+
+
+def span(name: str, traceparent: Optional[str] = None, **attributes: Any):
+    """
+    Returns a span context manager that is a child of the current span, or of the
+    remote span described by ``traceparent``.
+    """
+    if _mode is None:
+        return _NULL_SPAN
+    if _mode == "otel":
+        return _OtelSpan(name, traceparent, attributes)
+
+    attributes = {k: v for k, v in attributes.items() if v is not None}
+    parent = _current_span.get()
+    if traceparent and (parsed := _parse_traceparent(traceparent)):
+        return Span(name, trace_id=parsed[0], parent_span_id=parsed[1], attributes=attributes)
+    if parent:
+        return Span(
+            name, trace_id=parent.trace_id, parent_span_id=parent.span_id, attributes=attributes
+        )
+    return Span(name, attributes=attributes)
+
+
+def current_traceparent() -> Optional[str]:
+    """
+    Returns the W3C ``traceparent`` of the current span, if there is one.
+    """
+    if _mode is None:
+        return None
+    if _mode == "otel":
+        carrier: Dict[str, str] = {}
+        TraceContextTextMapPropagator().inject(carrier)  # type: ignore
+        return carrier.get(TRACEPARENT_LABEL)
+    current = _current_span.get()
+    return current.traceparent if current else None
+
+
+class TracingMiddleware(TaskiqMiddleware):
+    """
+    Propagates the trace context into kicked tasks through the ``traceparent`` label
+    and runs received tasks inside a span that continues the sender's trace.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._spans: Dict[str, Any] = {}
+
+    def pre_send(self, message: TaskiqMessage) -> TaskiqMessage:
+        traceparent = current_traceparent()
+        if traceparent and TRACEPARENT_LABEL not in message.labels:
+            message.labels[TRACEPARENT_LABEL] = traceparent
+        return message
+
+    def pre_execute(self, message: TaskiqMessage) -> TaskiqMessage:
+        if not enabled():
+            return message
+        task_span = span(
+            f"task {message.task_name}",
+            traceparent=message.labels.get(TRACEPARENT_LABEL),
+            **{"task.name": message.task_name, "task.id": message.task_id},
+            room=message.labels.get("room_id"),
+        )
+        task_span.__enter__()
+        self._spans[message.task_id] = task_span
+        return message
+
+    def post_execute(self, message: TaskiqMessage, result: TaskiqResult) -> None:
+        task_span = self._spans.pop(message.task_id, None)
+        if task_span is None:
+            return None
+        error = result.error if result.is_err else None
+        task_span.__exit__(type(error) if error else None, error, None)
+
+
+def _configured_mode(value: Any) -> Optional[str]:
+    if not value:
+        return None
+    value = str(value).lower()
+    if value in ("0", "false", "no"):
+        return None
+    return "otel" if value == "otel" else "file"
+
+
+if mode := _configured_mode(os.environ.get("FRACTAL_MATRIX_TRACING")):
+    enable(mode)
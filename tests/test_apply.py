@@ -0,0 +1,58 @@
+from fractal_database_matrix.apply import _balance, partition_fixture
+
+
+def obj(model: str, pk: str, **fields) -> dict:
+    return {"model": model, "pk": pk, "fields": fields}
+
+
+def test_partition_fixture_splits_independent_objects():
+    objects = [obj("app.a", "1"), obj("app.b", "2"), obj("app.c", "3")]
+
+    assert partition_fixture(objects) == [[objects[0]], [objects[1]], [objects[2]]]
+
+
+def test_partition_fixture_groups_references_in_order():
+    database = obj("fractal_database.database", "db")
+    device = obj("fractal_database.device", "dev")
+    membership = obj("fractal_database.devicemembership", "m", database="db", device="dev")
+    other = obj("fractal_database.device", "other")
+
+    partitions = partition_fixture([database, device, other, membership])
+
+    assert partitions == [[database, device, membership], [other]]
+
+
+def test_partition_fixture_groups_versions_of_an_object():
+    v1 = obj("app.a", "1", object_version=1)
+    v2 = obj("app.a", "1", object_version=2)
+    other = obj("app.b", "2")
+
+    assert partition_fixture([v1, other, v2]) == [[v1, v2], [other]]
+
+
+def test_partition_fixture_follows_many_to_many_references():
+    tag = obj("app.tag", "t")
+    post = obj("app.post", "p", tags=["t"])
+
+    assert partition_fixture([tag, post]) == [[tag, post]]
+
+
+def test_partition_fixture_ignores_booleans():
+    # True == 1, but a boolean field is never a reference to the object with pk 1
+    a = obj("app.a", 1)
+    b = obj("app.b", 2, enabled=True)
+
+    assert partition_fixture([a, b]) == [[a], [b]]
+
+
+def test_balance_spreads_partitions_over_bins():
+    partitions = [[1] * 5, [2] * 3, [3] * 2, [4] * 1]
+
+    balanced = _balance(partitions, 2)
+
+    assert balanced == [[[1] * 5, [4] * 1], [[2] * 3, [3] * 2]]
+    assert [sum(len(p) for p in bin) for bin in balanced] == [6, 5]
+
+
+def test_balance_leaves_bins_empty_without_partitions():
+    assert _balance([[1]], 3) == [[[1]], [], []]
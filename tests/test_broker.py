@@ -0,0 +1,31 @@
+import json
+from unittest.mock import AsyncMock, patch
+
+import pytest
+from nio import RoomSendResponse
+from taskiq import BrokerMessage
+
+from fractal_database_matrix.broker.broker import FractalMatrixBroker
+from fractal_database_matrix.client import FractalMatrixClient
+
+ROOM_ID = "!devices:localhost"
+
+
+@pytest.mark.asyncio
+async def test_kicks_go_through_the_rate_limited_client():
+    broker = FractalMatrixBroker().with_matrix_config("http://localhost:8008", "token")
+    message = BrokerMessage(
+        task_id="task",
+        task_name="replicate_fixture",
+        message=json.dumps({"task_id": "task"}).encode(),
+        labels={"room_id": ROOM_ID, "queue": "replication_priority"},
+    )
+    response = RoomSendResponse("$event", ROOM_ID)
+
+    with patch.object(FractalMatrixClient, "room_send", AsyncMock(return_value=response)) as send:
+        await broker.kick(message)
+
+    room_id, msgtype, content = send.await_args.args
+    assert room_id == ROOM_ID
+    assert msgtype == broker.replication_priority_queue.task_types.task
+    assert content["body"]["task_id"] == "task"
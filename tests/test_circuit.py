@@ -0,0 +1,181 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+import pytest
+from fractal.matrix import FractalAsyncClient
+
+from fractal_database_matrix import circuit
+from fractal_database_matrix.circuit import (
+    Backoff,
+    CircuitBreaker,
+    CircuitState,
+    call_with_retry,
+)
+from fractal_database_matrix.client import FractalMatrixClient
+from fractal_database_matrix.exceptions import CircuitOpenError
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(circuit.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def breaker(clock) -> CircuitBreaker:
+    return CircuitBreaker("http://localhost:8008", failure_threshold=3, reset_timeout=10)
+
+
+def test_opens_after_consecutive_failures(breaker):
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == CircuitState.CLOSED
+
+    breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+
+def test_success_resets_failure_count(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_half_open_lets_a_single_trial_through(breaker, clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 10
+
+    assert breaker.state == CircuitState.HALF_OPEN
+    breaker.before_request()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+
+def test_successful_trial_closes_the_circuit(breaker, clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 10
+    breaker.before_request()
+
+    breaker.record_success()
+
+    assert breaker.state == CircuitState.CLOSED
+    breaker.before_request()
+
+
+def test_failed_trial_reopens_the_circuit(breaker, clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 10
+    breaker.before_request()
+
+    breaker.record_failure()
+
+    assert breaker.state == CircuitState.OPEN
+    assert breaker.retry_in() == 10
+
+
+def test_retry_after_keeps_the_circuit_open_longer(breaker, clock):
+    for _ in range(2):
+        breaker.record_failure()
+    breaker.record_failure(retry_after=25)
+
+    clock.now += 10
+    assert breaker.state == CircuitState.OPEN
+    clock.now += 15
+    assert breaker.state == CircuitState.HALF_OPEN
+
+
+def test_failures_in_flight_when_opened_are_ignored(breaker, clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 5
+    breaker.record_failure()
+
+    assert breaker.retry_in() == 5
+
+
+@pytest.mark.asyncio
+async def test_call_with_retry_retries_then_succeeds(breaker):
+    func = AsyncMock(side_effect=[Exception("boom"), "ok"])
+
+    result = await call_with_retry(func, breaker, backoff=Backoff(base=0))
+
+    assert result == "ok"
+    assert func.await_count == 2
+    assert breaker.failures == 0
+
+
+@pytest.mark.asyncio
+async def test_call_with_retry_does_not_retry_open_circuit(breaker):
+    func = AsyncMock(side_effect=CircuitOpenError(breaker.homeserver_url, 10))
+
+    with pytest.raises(CircuitOpenError):
+        await call_with_retry(func, breaker, backoff=Backoff(base=0))
+
+    assert func.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_call_with_retry_without_guard_leaves_the_breaker_alone(breaker):
+    func = AsyncMock(side_effect=[Exception("boom"), Exception("boom"), "ok"])
+
+    await call_with_retry(func, breaker, backoff=Backoff(base=0), guard=False)
+
+    assert breaker.failures == 0
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_released_trial_lets_the_next_request_through(breaker, clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 10
+    assert breaker.before_request() is True
+
+    breaker.release_trial()
+
+    assert breaker.state == CircuitState.HALF_OPEN
+    assert breaker.before_request() is True
+
+
+@pytest.mark.asyncio
+async def test_cancelled_trial_request_doesnt_keep_the_circuit_open(breaker, clock, monkeypatch):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 10
+    monkeypatch.setattr(FractalAsyncClient, "send", AsyncMock(side_effect=asyncio.CancelledError))
+    client = FractalMatrixClient("http://localhost:8008", "token", circuit_breaker=breaker)
+
+    with pytest.raises(asyncio.CancelledError):
+        await client.send("GET", "/_matrix/client/v3/sync")
+
+    assert breaker.trial_in_flight is False
+    assert breaker.before_request() is True
+
+
+@pytest.mark.asyncio
+async def test_call_with_retry_releases_a_cancelled_trial(breaker, clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 10
+    func = AsyncMock(side_effect=asyncio.CancelledError)
+
+    with pytest.raises(asyncio.CancelledError):
+        await call_with_retry(func, breaker, backoff=Backoff(base=0))
+
+    assert breaker.before_request() is True
@@ -0,0 +1,164 @@
+from types import SimpleNamespace
+
+import pytest
+
+from fractal_database_matrix.context import (
+    CHANNEL_PREFETCH_RELATED,
+    CHANNEL_SELECT_RELATED,
+    OperationContext,
+    current_context,
+    operation_context,
+)
+
+
+class FakeQuerySet:
+    def __init__(self, model, pks):
+        self.model = model
+        self.pks = pks
+        self.select_related_ = ()
+        self.prefetch_related_ = ()
+
+    def select_related(self, *fields):
+        self.select_related_ = fields
+        return self
+
+    def prefetch_related(self, *lookups):
+        self.prefetch_related_ = lookups
+        return self
+
+    async def __aiter__(self):
+        self.model.queries.append((set(self.pks), self.select_related_, self.prefetch_related_))
+        for pk in sorted(self.pks):
+            if pk in self.model.rows:
+                yield self.model(pk)
+
+
+class FakeManager:
+    def __init__(self, model):
+        self.model = model
+
+    def filter(self, pk__in):
+        return FakeQuerySet(self.model, pk__in)
+
+
+def fake_model(name: str, *pks: str) -> type:
+    class DoesNotExist(Exception):
+        pass
+
+    def __init__(self, pk):
+        self.pk = pk
+        self.metadata = {}
+
+    model = type(name, (), {"__init__": __init__, "DoesNotExist": DoesNotExist})
+    model.rows = set(pks)
+    model.queries = []
+    model.objects = FakeManager(model)
+    return model
+
+
+def operation(channel_model, channel_id, instance_model, object_id):
+    return SimpleNamespace(
+        channel_type=SimpleNamespace(model_class=lambda: channel_model),
+        channel_id=channel_id,
+        content_type=SimpleNamespace(model_class=lambda: instance_model),
+        object_id=object_id,
+    )
+
+
+@pytest.fixture
+def models():
+    return fake_model("Channel", "c1", "c2"), fake_model("Instance", "i1", "i2", "i3")
+
+
+@pytest.mark.asyncio
+async def test_preload_loads_a_plan_in_a_query_per_model(models):
+    channel_model, instance_model = models
+    operations = [
+        operation(channel_model, "c1", instance_model, "i1"),
+        operation(channel_model, "c1", instance_model, "i2"),
+        operation(channel_model, "c2", instance_model, "i3"),
+    ]
+    context = OperationContext()
+
+    await context.preload(operations)
+    for op in operations:
+        await context.aget_channel(op)
+        await context.aget_instance(op)
+
+    assert channel_model.queries == [
+        ({"c1", "c2"}, CHANNEL_SELECT_RELATED, CHANNEL_PREFETCH_RELATED)
+    ]
+    assert instance_model.queries == [({"i1", "i2", "i3"}, (), ())]
+    assert context.misses == 0
+    assert context.hits == 6
+
+
+@pytest.mark.asyncio
+async def test_channels_are_loaded_once_without_preloading(models):
+    channel_model, instance_model = models
+    op = operation(channel_model, "c1", instance_model, "i1")
+    context = OperationContext()
+
+    first = await context.aget_channel(op)
+    second = await context.aget_channel(op)
+
+    assert first is second
+    assert channel_model.queries == [({"c1"}, CHANNEL_SELECT_RELATED, CHANNEL_PREFETCH_RELATED)]
+    assert (context.hits, context.misses) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_preload_skips_objects_already_loaded(models):
+    channel_model, instance_model = models
+    context = OperationContext()
+
+    await context.preload([operation(channel_model, "c1", instance_model, "i1")])
+    await context.preload(
+        [
+            operation(channel_model, "c1", instance_model, "i1"),
+            operation(channel_model, "c2", instance_model, "i1"),
+        ]
+    )
+
+    assert [pks for pks, *_ in channel_model.queries] == [{"c1"}, {"c2"}]
+    assert [pks for pks, *_ in instance_model.queries] == [{"i1"}]
+
+
+@pytest.mark.asyncio
+async def test_missing_objects_raise_does_not_exist(models):
+    channel_model, instance_model = models
+    context = OperationContext()
+
+    with pytest.raises(channel_model.DoesNotExist):
+        await context.aget_channel(operation(channel_model, "c3", instance_model, "i1"))
+
+
+@pytest.mark.asyncio
+async def test_metadata_is_mirrored_onto_every_cached_copy(models):
+    channel_model, instance_model = models
+    op = operation(channel_model, "c1", instance_model, "i1")
+    context = OperationContext()
+    plain = await context.aget_instance(op)
+    related = await context.aget_instance(op, select_related=("database",))
+    other = await context.aget_instance(operation(channel_model, "c1", instance_model, "i2"))
+
+    context.mirror_metadata(op, {"room_id": "!room:localhost"})
+
+    assert plain.metadata == related.metadata == {"room_id": "!room:localhost"}
+    assert other.metadata == {}
+
+
+@pytest.mark.asyncio
+async def test_nested_contexts_share_the_outermost_one(models):
+    channel_model, instance_model = models
+    outer_operations = [operation(channel_model, "c1", instance_model, "i1")]
+    inner_operations = [operation(channel_model, "c2", instance_model, "i2")]
+
+    async with operation_context(outer_operations) as outer:
+        assert current_context() is outer
+        async with operation_context(inner_operations) as inner:
+            assert inner is outer
+        await outer.aget_channel(inner_operations[0])
+
+    assert outer.misses == 0
+    assert current_context() is not outer
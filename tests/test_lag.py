@@ -0,0 +1,136 @@
+import json
+
+import pytest
+from taskiq import InMemoryBroker
+from taskiq.message import BrokerMessage
+
+from fractal_database_matrix import lag
+from fractal_database_matrix.lag import (
+    RECEIVED_TS_LABEL,
+    LagTracker,
+    int_label,
+    merge_status,
+    origin_labels,
+)
+
+ROOM_ID = "!devices:localhost"
+
+
+class CapturingBroker(InMemoryBroker):
+    def __init__(self):
+        super().__init__()
+        self.kicked = []
+
+    async def kick(self, message: BrokerMessage) -> None:
+        self.kicked.append(message)
+
+
+@pytest.fixture
+def broker() -> CapturingBroker:
+    broker = CapturingBroker()
+
+    @broker.task(task_name="replicate_fixture")
+    async def replicate_fixture(fixture: str) -> None:
+        pass
+
+    broker.replicate_fixture = replicate_fixture
+    return broker
+
+
+async def kick_with_origin_labels(broker: CapturingBroker) -> dict:
+    await broker.replicate_fixture.kicker().with_labels(**origin_labels("device")).kiq("[]")
+    return json.loads(broker.kicked[-1].message)
+
+
+@pytest.mark.asyncio
+async def test_labels_survive_a_real_kick(broker):
+    task = await kick_with_origin_labels(broker)
+    labels = task["labels"]
+    tracker = LagTracker(path=None)
+
+    # taskiq sends every label as a string
+    assert isinstance(labels["origin_ts"], str)
+
+    tracker.received(task["task_id"], ROOM_ID, labels)
+    message = broker.formatter.loads(json.dumps({**task, "labels": labels}).encode())
+    tracker.applied(message.task_id, message.labels)
+
+    [stream] = tracker.status()["streams"]
+    assert stream["applied"] == 1
+    assert stream["last_seq"] == int(labels["seq"])
+    assert stream["last_origin_ts"] == int(labels["origin_ts"])
+    assert stream["backlog"] == 0
+
+
+@pytest.mark.asyncio
+async def test_pending_tasks_count_towards_lag(broker, monkeypatch):
+    task = await kick_with_origin_labels(broker)
+    origin_ts = int(task["labels"]["origin_ts"])
+    tracker = LagTracker(path=None)
+
+    tracker.received(task["task_id"], ROOM_ID, task["labels"])
+    monkeypatch.setattr(lag, "now_ms", lambda: origin_ts + 2500)
+
+    [stream] = tracker.status()["streams"]
+    assert stream["backlog"] == 1
+    assert stream["lag"] == 2.5
+
+
+@pytest.mark.parametrize("origin_ts", [None, "", "not a timestamp"])
+def test_tasks_without_a_valid_origin_ts_are_skipped(origin_ts):
+    tracker = LagTracker(path=None)
+    labels = {"seq": "1", "origin_device": "device"}
+    if origin_ts is not None:
+        labels["origin_ts"] = origin_ts
+
+    tracker.received("task", ROOM_ID, labels)
+    tracker.applied("task", labels)
+
+    assert RECEIVED_TS_LABEL not in labels
+    assert tracker.status()["streams"] == []
+
+
+def test_invalid_seq_is_ignored():
+    tracker = LagTracker(path=None)
+    labels = {"origin_ts": "1000", "seq": "invalid", "origin_device": "device"}
+
+    tracker.received("task", ROOM_ID, labels)
+    tracker.applied("task", labels)
+
+    [stream] = tracker.status()["streams"]
+    assert stream["applied"] == 1
+    assert stream["last_seq"] == 0
+
+
+def test_int_label():
+    assert int_label({"seq": "42"}, "seq") == 42
+    assert int_label({"seq": 42}, "seq") == 42
+    assert int_label({}, "seq") is None
+    assert int_label({"seq": None}, "seq") is None
+    assert int_label({"seq": "4.2"}, "seq") is None
+
+
+def test_status_files_are_written_per_process(tmp_path):
+    path = str(tmp_path / "replication_status.json")
+    tracker = LagTracker(path=path)
+    tracker.received("task", ROOM_ID, {"origin_ts": "1000", "origin_device": "device"})
+    tracker.write(force=True)
+
+    status = lag.read_status(path)
+
+    assert status is not None
+    assert status["streams"][0]["backlog"] == 1
+    assert (tmp_path / f"replication_status.{lag.os.getpid()}.json").exists()
+
+
+def test_merge_status_adds_up_backlogs_and_keeps_the_highest_lag():
+    stream = {"room": ROOM_ID, "origin_device": "device"}
+    statuses = [
+        {"updated": 1, "streams": [{**stream, "backlog": 1, "applied": 2, "lag": 1.0}]},
+        {"updated": 2, "streams": [{**stream, "backlog": 3, "applied": 4, "lag": 0.5}]},
+    ]
+
+    merged = merge_status(statuses)
+
+    assert merged["updated"] == 2
+    assert merged["streams"] == [{**stream, "backlog": 4, "applied": 6, "lag": 1.0}]
@@ -0,0 +1,100 @@
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+from fractal_database.models import DurableOperation, ReplicationChannel
+
+from fractal_database_matrix import models
+from fractal_database_matrix.context import current_context, operation_context
+from fractal_database_matrix.models import MatrixReplicationChannel
+from fractal_database_matrix.operations import MatrixOperation, plan_operations
+
+
+class FakeOperation(MatrixOperation):
+    def __init__(self):
+        self.checked = []
+        self.ran = []
+
+    async def is_satisfied(self, operation) -> bool:
+        self.checked.append(operation.pk)
+        return operation.metadata.get("satisfied", False)
+
+    async def run(self, operation):
+        self.ran.append(operation.pk)
+        return {}
+
+
+def durable_operation(pk: str, module: str = "fake", **metadata):
+    return SimpleNamespace(
+        pk=pk,
+        module=module,
+        metadata=metadata,
+        content_type=SimpleNamespace(model_class=lambda: None),
+        object_id=pk,
+    )
+
+
+@pytest.fixture
+def handlers(monkeypatch):
+    handlers = {"fake": FakeOperation(), "other": object()}
+    monkeypatch.setattr(DurableOperation, "get_operation", staticmethod(handlers.__getitem__))
+    return handlers
+
+
+@pytest.mark.asyncio
+async def test_plan_skips_satisfied_operations_before_they_run(handlers):
+    operations = [
+        durable_operation("1", satisfied=True),
+        durable_operation("2"),
+        durable_operation("3", satisfied=True),
+        durable_operation("4", module="other"),
+    ]
+
+    async with operation_context():
+        skipped = await plan_operations(operations)
+        for operation in operations[:3]:
+            await handlers["fake"].run(operation)
+        context = current_context()
+
+    assert skipped == 2
+    assert context.satisfied == {"1", "3"}
+    assert context.skipped == 2
+    # satisfied operations aren't checked again when they run
+    assert handlers["fake"].checked == ["1", "2", "3", "2"]
+    assert handlers["fake"].ran == ["2"]
+
+
+@pytest.mark.asyncio
+async def test_plan_of_nothing_skips_nothing(handlers):
+    assert await plan_operations([]) == 0
+
+
+@pytest.mark.asyncio
+async def test_replicate_plans_the_pending_operations_first(monkeypatch):
+    operations = [durable_operation("1")]
+    calls = []
+
+    async def plan(planned):
+        calls.append(("plan", planned, current_context()))
+        return 0
+
+    async def replicate(self, *args, **kwargs):
+        calls.append(("replicate", None, current_context()))
+
+    preload = AsyncMock()
+    monkeypatch.setattr(
+        MatrixReplicationChannel, "apending_operations", AsyncMock(return_value=operations)
+    )
+    monkeypatch.setattr(models, "plan_operations", plan)
+    monkeypatch.setattr(ReplicationChannel, "replicate", replicate)
+    monkeypatch.setattr("fractal_database_matrix.context.OperationContext.preload", preload)
+
+    await MatrixReplicationChannel().replicate()
+
+    preload.assert_awaited_once_with(operations)
+    assert [(name, planned) for name, planned, _ in calls] == [
+        ("plan", operations),
+        ("replicate", None),
+    ]
+    # both run in the same context
+    assert calls[0][2] is calls[1][2]
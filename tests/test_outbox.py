@@ -0,0 +1,182 @@
+import json
+import uuid
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+from django.utils import timezone
+
+from fractal_database_matrix import outbox
+from fractal_database_matrix.models import MatrixReplicationChannel, ReplicationOutbox
+from fractal_database_matrix.outbox import PendingObjects, drain, enqueue
+
+ROOM_ID = "!devices:localhost"
+
+
+def obj(model: str, pk: str, version: int, **fields) -> dict:
+    return {"model": model, "pk": pk, "fields": {"object_version": version, **fields}}
+
+
+def event(objects: list) -> str:
+    return json.dumps({"payload": objects})
+
+
+def payload_objects(entry: ReplicationOutbox) -> list:
+    return [
+        (item["pk"], item["fields"]["object_version"])
+        for item in json.loads(entry.payload)["payload"]
+    ]
+
+
+def test_pending_objects_finds_older_versions():
+    pending = PendingObjects()
+    entry = SimpleNamespace(pk=1, channel_id="channel", room_id=ROOM_ID)
+    pending.add(entry, [obj("app.a", "a", 1), obj("app.b", "b", 1)])
+
+    superseded = pending.superseded("channel", ROOM_ID, [obj("app.a", "a", 2)])
+
+    assert superseded == {1: {("app.a", "a")}}
+    assert pending.superseded("channel", ROOM_ID, [obj("app.a", "a", 1)]) == {}
+    assert pending.superseded("channel", "!other:localhost", [obj("app.a", "a", 2)]) == {}
+
+
+def test_pending_objects_forgets_discarded_entries():
+    pending = PendingObjects()
+    entry = SimpleNamespace(pk=1, channel_id="channel", room_id=ROOM_ID)
+    pending.add(entry, [obj("app.a", "a", 1)])
+
+    pending.discard(1)
+
+    assert pending.superseded("channel", ROOM_ID, [obj("app.a", "a", 2)]) == {}
+
+
+@pytest.fixture
+def matrix_channel(test_database):
+    channel = MatrixReplicationChannel.objects.filter(database=test_database).first()
+    assert channel is not None
+    return channel
+
+
+@pytest.fixture(autouse=True)
+def pending(monkeypatch):
+    # don't let the background drainer race the tests
+    monkeypatch.setattr(outbox.DRAINER, "wake", lambda: None)
+    pending = PendingObjects()
+    monkeypatch.setattr(outbox, "PENDING", pending)
+    return pending
+
+
+async def push(channel, objects: list, seq: int) -> ReplicationOutbox:
+    return await enqueue(channel, ROOM_ID, event(objects), {"seq": seq}, {"payload": objects})
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_enqueue_drops_superseded_versions(matrix_channel):
+    a = str(uuid.uuid4())
+    await push(matrix_channel, [obj("app.a", a, 1)], seq=1)
+    latest = await push(matrix_channel, [obj("app.a", a, 2)], seq=2)
+
+    entries = [entry async for entry in ReplicationOutbox.objects.order_by("seq")]
+
+    assert [entry.pk for entry in entries] == [latest.pk]
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_enqueue_keeps_superseded_versions_referenced_in_their_entry(matrix_channel):
+    a, b, c = (str(uuid.uuid4()) for _ in range(3))
+    first = await push(
+        matrix_channel,
+        [obj("app.a", a, 1), obj("app.b", b, 1, a=a), obj("app.c", c, 1)],
+        seq=1,
+    )
+    await push(matrix_channel, [obj("app.a", a, 2), obj("app.c", c, 2)], seq=2)
+
+    await first.arefresh_from_db()
+
+    # c isn't referenced by anything, a is still needed by b
+    assert payload_objects(first) == [(a, 1), (b, 1)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_enqueue_keeps_superseded_versions_referenced_by_later_entries(matrix_channel):
+    a, b = str(uuid.uuid4()), str(uuid.uuid4())
+    first = await push(matrix_channel, [obj("app.a", a, 1)], seq=1)
+    await push(matrix_channel, [obj("app.b", b, 1, a=a)], seq=2)
+    await push(matrix_channel, [obj("app.a", a, 2)], seq=3)
+
+    await first.arefresh_from_db()
+
+    assert payload_objects(first) == [(a, 1)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_drain_sends_entries_in_seq_order(monkeypatch, matrix_channel):
+    for seq in (3, 1, 2):
+        await push(matrix_channel, [obj("app.a", str(uuid.uuid4()), 1)], seq=seq)
+    sent = []
+
+    async def send(entry):
+        sent.append(entry.seq)
+
+    monkeypatch.setattr(outbox, "_send", send)
+
+    await drain()
+
+    assert sent == [1, 2, 3]
+    assert not await ReplicationOutbox.objects.filter(sent=False).aexists()
+    await matrix_channel.arefresh_from_db()
+    assert matrix_channel.outbox_claimed_by is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_drain_holds_back_a_channel_after_a_failure(monkeypatch, matrix_channel):
+    for seq in (1, 2, 3):
+        await push(matrix_channel, [obj("app.a", str(uuid.uuid4()), 1)], seq=seq)
+
+    async def send(entry):
+        return "boom" if entry.seq == 2 else None
+
+    monkeypatch.setattr(outbox, "_send", send)
+
+    delay = await drain()
+
+    entries = [entry async for entry in ReplicationOutbox.objects.order_by("seq")]
+    assert [entry.sent for entry in entries] == [True, False, False]
+    assert entries[1].attempts == 1
+    assert entries[1].last_error == "boom"
+    assert entries[1].next_attempt is not None
+    assert delay == 1
+
+    # the failed entry isn't due yet, so the channel stays blocked
+    await drain()
+    assert not await ReplicationOutbox.objects.filter(seq=3, sent=True).aexists()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_drain_skips_channels_claimed_by_another_drainer(monkeypatch, matrix_channel):
+    await push(matrix_channel, [obj("app.a", str(uuid.uuid4()), 1)], seq=1)
+    await MatrixReplicationChannel.objects.filter(pk=matrix_channel.pk).aupdate(
+        outbox_claimed_by="other-drainer",
+        outbox_claimed_until=timezone.now() + timedelta(minutes=1),
+    )
+    send = AsyncMock(return_value=None)
+    monkeypatch.setattr(outbox, "_send", send)
+
+    await drain()
+
+    send.assert_not_awaited()
+
+    # the claim lapses if the other drainer stops renewing it
+    await MatrixReplicationChannel.objects.filter(pk=matrix_channel.pk).aupdate(
+        outbox_claimed_until=timezone.now() - timedelta(seconds=1)
+    )
+    await drain()
+
+    send.assert_awaited_once()
@@ -0,0 +1,166 @@
+import pytest
+
+from fractal_database_matrix.broker import queue
+from fractal_database_matrix.broker.queue import (
+    PRIORITY_MAX_OBJECTS,
+    PRIORITY_REPLICATION_QUEUE,
+    REPLICATION_QUEUE,
+    InFlightObjects,
+    LaneScheduler,
+    replication_lane,
+    replication_shard,
+)
+
+
+def obj(model: str, pk: str, **fields) -> dict:
+    return {"model": model, "pk": pk, "fields": fields}
+
+
+def test_control_models_go_through_the_priority_lane():
+    objects = [
+        obj("fractal_database.devicemembership", "m1"),
+        obj("fractal_database_matrix.matrixcredentials", "c1"),
+    ]
+
+    assert replication_lane(objects) == PRIORITY_REPLICATION_QUEUE
+
+
+def test_mixed_fixtures_go_through_the_bulk_lane():
+    objects = [obj("fractal_database.devicemembership", "m1"), obj("app.post", "p1")]
+
+    assert replication_lane(objects) == REPLICATION_QUEUE
+
+
+def test_large_and_empty_fixtures_go_through_the_bulk_lane():
+    objects = [
+        obj("fractal_database.devicemembership", str(i)) for i in range(PRIORITY_MAX_OBJECTS + 1)
+    ]
+
+    assert replication_lane(objects) == REPLICATION_QUEUE
+    assert replication_lane([]) == REPLICATION_QUEUE
+
+
+def test_unsharded_channels_use_shard_zero():
+    assert replication_shard([obj("app.post", "p1")], 1) == 0
+
+
+def test_versions_of_an_object_go_to_the_same_shard():
+    shards = {
+        replication_shard([obj("app.post", "p1", object_version=version)], 8)
+        for version in range(10)
+    }
+
+    assert len(shards) == 1
+
+
+def test_objects_are_spread_over_shards():
+    shards = {replication_shard([obj("app.post", str(pk))], 4) for pk in range(100)}
+
+    assert shards == {0, 1, 2, 3}
+
+
+def test_mixed_fixtures_go_to_shard_zero():
+    objects = [obj("app.post", str(pk)) for pk in range(100)]
+
+    assert replication_shard(objects, 4) == 0
+
+
+def test_model_name_case_doesnt_change_the_shard():
+    assert replication_shard([obj("App.Post", "p1")], 8) == replication_shard(
+        [obj("app.post", "p1")], 8
+    )
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(queue.time, "monotonic", clock)
+    return clock
+
+
+def test_in_flight_objects_are_found_by_reference(clock):
+    in_flight = InFlightObjects(ttl=60)
+    in_flight.add("channel", [obj("fractal_database.device", "dev")], shard=2)
+    membership = obj("fractal_database.devicemembership", "m", device="dev")
+
+    assert in_flight.shards("channel", [membership]) == {2}
+    assert in_flight.shards("other channel", [membership]) == set()
+
+
+def test_newer_versions_follow_the_shard_of_an_older_version_in_flight(clock):
+    in_flight = InFlightObjects(ttl=60)
+    older = obj("app.post", "p2", object_version=1)
+    shard = replication_shard([older], 4)
+    assert shard != 0
+    in_flight.add("channel", [older], shard=shard)
+
+    # mixed fixtures go to shard 0 unless one of their objects is still in flight
+    newer = [obj("app.post", "p2", object_version=2), obj("app.post", "p3")]
+    assert replication_shard(newer, 4) == 0
+    assert in_flight.shards("channel", newer) == {shard}
+
+
+def test_control_changes_to_objects_in_flight_are_held_on_the_bulk_lane(clock):
+    in_flight = InFlightObjects(ttl=60)
+    # an older version of the membership was pushed with bulk data
+    in_flight.add("channel", [obj("fractal_database.devicemembership", "m", object_version=1)])
+    newer = [obj("fractal_database.devicemembership", "m", object_version=2)]
+
+    assert replication_lane(newer) == PRIORITY_REPLICATION_QUEUE
+    assert in_flight.shards("channel", newer) == {0}
+
+
+def test_in_flight_objects_expire(clock):
+    in_flight = InFlightObjects(ttl=60)
+    in_flight.add("channel", [obj("fractal_database.device", "dev")])
+    membership = obj("fractal_database.devicemembership", "m", device="dev")
+
+    clock.now += 59
+    assert in_flight.shards("channel", [membership]) == {0}
+    clock.now += 1
+    assert in_flight.shards("channel", [membership]) == set()
+
+
+def test_pushing_an_object_again_renews_it(clock):
+    in_flight = InFlightObjects(ttl=60)
+    device = obj("fractal_database.device", "dev")
+    in_flight.add("channel", [device], shard=1)
+    clock.now += 30
+    in_flight.add("channel", [device], shard=3)
+    clock.now += 40
+
+    membership = obj("fractal_database.devicemembership", "m", device="dev")
+    assert in_flight.shards("channel", [membership]) == {3}
+
+
+def test_priority_tasks_read_later_overtake_held_bulk_tasks():
+    lanes = LaneScheduler(budget=8, max_held=100)
+
+    assert lanes.schedule([], ["b1", "b2"], []) == []
+    assert lanes.schedule(["p1"], ["b3"], ["device"]) == ["device", "p1"]
+    assert lanes.flush() == ["b1", "b2", "b3"]
+    assert lanes.flush() == []
+
+
+def test_bulk_tasks_get_a_turn_after_the_priority_budget():
+    lanes = LaneScheduler(budget=2, max_held=100)
+    lanes.schedule([], ["b1", "b2"], [])
+
+    tasks = lanes.schedule(["p1", "p2", "p3", "p4", "p5"], [], [])
+
+    assert tasks == ["p1", "p2", "b1", "p3", "p4", "b2", "p5"]
+
+
+def test_bulk_tasks_beyond_the_hold_are_handed_out():
+    lanes = LaneScheduler(budget=8, max_held=2)
+
+    assert lanes.schedule([], ["b1", "b2", "b3"], []) == ["b1"]
+    assert lanes.flush() == ["b2", "b3"]
@@ -0,0 +1,116 @@
+import pytest
+
+from fractal_database_matrix import ratelimit
+from fractal_database_matrix.ratelimit import (
+    ActionClass,
+    RateLimiter,
+    TokenBucket,
+    classify_request,
+)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock)
+    return clock
+
+
+def test_bucket_is_unlimited_until_rate_limited(clock):
+    bucket = TokenBucket()
+
+    assert [bucket.reserve() for _ in range(100)] == [0.0] * 100
+    assert bucket.rate is None
+
+
+def test_rate_limit_throttles_to_headroom_of_observed_rate(clock):
+    bucket = TokenBucket()
+    for _ in range(20):
+        bucket.reserve()
+
+    bucket.on_limited()
+
+    # 20 requests in the last 10 second window
+    assert bucket.ceiling == pytest.approx(2.0)
+    assert bucket.rate == pytest.approx(2.0 * TokenBucket.HEADROOM)
+    assert bucket.reserve() == pytest.approx(1 / bucket.rate)
+
+
+def test_retry_after_blocks_the_bucket(clock):
+    bucket = TokenBucket()
+    bucket.reserve()
+
+    bucket.on_limited(retry_after=5)
+
+    assert bucket.reserve() >= 5
+
+
+def test_tokens_refill_over_time(clock):
+    bucket = TokenBucket(rate=2.0)
+    bucket.reserve()
+
+    assert bucket.reserve() == pytest.approx(0.5)
+    clock.now += 10
+    assert bucket.reserve() == 0.0
+
+
+def test_only_the_requests_of_the_last_window_are_kept(clock):
+    bucket = TokenBucket()
+    for _ in range(1000):
+        bucket.reserve()
+        clock.now += 1
+
+    assert len(bucket.sent) <= TokenBucket.WINDOW + 1
+
+
+def test_success_increases_rate_up_to_headroom(clock):
+    bucket = TokenBucket()
+    for _ in range(20):
+        bucket.reserve()
+    bucket.on_limited()
+
+    for _ in range(100):
+        bucket.on_success()
+
+    assert bucket.rate <= bucket.ceiling * TokenBucket.HEADROOM
+    assert bucket.rate == pytest.approx(bucket.ceiling * TokenBucket.HEADROOM)
+
+
+def test_rate_never_drops_below_minimum(clock):
+    bucket = TokenBucket()
+
+    bucket.on_limited()
+
+    assert bucket.rate == TokenBucket.MIN_RATE
+
+
+def test_rate_limiter_keeps_a_bucket_per_action(clock):
+    limiter = RateLimiter("http://localhost:8008")
+    limiter.bucket(ActionClass.SEND).reserve()
+
+    limiter.on_limited(ActionClass.SEND)
+
+    assert limiter.bucket(ActionClass.SEND).rate is not None
+    assert limiter.bucket(ActionClass.JOIN).rate is None
+
+
+@pytest.mark.parametrize(
+    "method, path, action",
+    [
+        ("POST", "/_matrix/client/v3/createRoom", ActionClass.ROOM_CREATE),
+        ("PUT", "/_matrix/client/v3/rooms/!r:localhost/send/m.room.message/1", ActionClass.SEND),
+        ("POST", "/_matrix/client/v3/rooms/!r:localhost/invite", ActionClass.INVITE),
+        ("POST", "/_matrix/client/v3/join/!r:localhost?access_token=x", ActionClass.JOIN),
+        ("GET", "/_matrix/client/v3/sync", ActionClass.OTHER),
+    ],
+)
+def test_classify_request(method, path, action):
+    assert classify_request(method, path) == action
@@ -0,0 +1,79 @@
+import pytest
+from taskiq.result import TaskiqResult
+from taskiq_matrix import matrix_result_backend
+
+from fractal_database_matrix import metrics
+from fractal_database_matrix.broker.results import (
+    NO_RESULT_LABEL,
+    FractalMatrixResultBackend,
+    result_size,
+    wants_result,
+)
+
+ROOM_ID = "!devices:localhost"
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    sent = []
+
+    async def send_message(client, room_id, message, msgtype):
+        sent.append(message)
+
+    monkeypatch.setattr(matrix_result_backend, "send_message", send_message)
+    return sent
+
+
+@pytest.fixture
+def backend(sent):
+    return FractalMatrixResultBackend("http://localhost:8008", "token", result_ex_time=3600)
+
+
+@pytest.fixture(autouse=True)
+def enabled_metrics():
+    metrics.enable()
+    metrics.REGISTRY.reset()
+    yield
+    metrics.REGISTRY.reset()
+    metrics.disable()
+
+
+def result(**labels) -> TaskiqResult:
+    return TaskiqResult(
+        is_err=False,
+        return_value=None,
+        execution_time=0.1,
+        labels={"room_id": ROOM_ID, **labels},
+    )
+
+
+def counted(counter: metrics.Counter) -> float:
+    return sum(value for *_, value in counter.samples())
+
+
+def test_wants_result():
+    assert wants_result({})
+    assert wants_result(None)
+    assert not wants_result({NO_RESULT_LABEL: True})
+    assert not wants_result({NO_RESULT_LABEL: "True"})
+
+
+@pytest.mark.asyncio
+async def test_sent_results_count_the_size_of_their_event(backend, sent):
+    await backend.set_result("task", result())
+
+    [message] = sent
+    assert counted(metrics.RESULTS_SENT) == 1
+    assert counted(metrics.RESULT_BYTES_SENT) == len(message["value"])
+
+
+@pytest.mark.asyncio
+async def test_results_of_tasks_kicked_without_one_are_not_sent(backend, sent):
+    skipped = result(**{NO_RESULT_LABEL: "True"})
+
+    await backend.set_result("task", skipped)
+
+    assert sent == []
+    assert counted(metrics.RESULTS_SKIPPED) == 1
+    assert counted(metrics.RESULT_BYTES_SKIPPED) == result_size(skipped)
+    assert counted(metrics.RESULT_BYTES_SKIPPED) > 0
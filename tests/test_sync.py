@@ -0,0 +1,190 @@
+import json
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from taskiq_matrix.matrix_queue import TaskTypes
+
+from fractal_database_matrix.broker import sync
+from fractal_database_matrix.broker.sync import SyncEngine
+
+ROOM_ID = "!replication:localhost"
+OTHER_ROOM_ID = "!other:localhost"
+USER_ID = "@device:localhost"
+
+
+class FakeQueue:
+    def __init__(self, name: str = "replication", room_id: str = ROOM_ID):
+        self.name = name
+        self.room_id = room_id
+        self.task_types = TaskTypes(name)
+        self.client = SimpleNamespace(user_id=USER_ID, next_batch=None)
+        self.checkpoint = SimpleNamespace(
+            since_token=None, put_checkpoint_state=AsyncMock(return_value=None)
+        )
+
+    def filter_acked_tasks(self, tasks, exclude_self=False):
+        return tasks
+
+
+def task_event(task_id: str, queue: str = "replication", sender: str = "@other:localhost"):
+    return {
+        "sender": sender,
+        "content": {
+            "msgtype": f"taskiq.{queue}.task",
+            "body": {"task_id": task_id, "task": json.dumps({"args": []}), "queue": queue},
+        },
+    }
+
+
+def ack_event(task_id: str, queue: str = "replication"):
+    return {
+        "sender": "@other:localhost",
+        "content": {
+            "msgtype": f"taskiq.{queue}.task.ack.{task_id}",
+            "body": {"task_id": task_id, "task": "{}", "queue": queue},
+        },
+    }
+
+
+def sync_response(events: list, next_batch: str = "s2", limited: bool = False):
+    body = {
+        "next_batch": next_batch,
+        "rooms": {"join": {ROOM_ID: {"timeline": {"events": events, "limited": limited}}}},
+    }
+    return SimpleNamespace(
+        read=AsyncMock(return_value=json.dumps(body).encode()), release=MagicMock()
+    )
+
+
+def make_engine(**kwargs) -> SyncEngine:
+    client = MagicMock(user_id=USER_ID)
+    return SyncEngine(client, {"replication_queue": FakeQueue()}, **kwargs)
+
+
+async def collect(results) -> list:
+    # empty batches only mark where the engine waits for acks
+    return [batch async for batch in results if batch]
+
+
+def test_route_passes_room_id():
+    engine = make_engine()
+    with patch.object(sync, "Task") as task_class:
+        routed = list(engine._route(ROOM_ID, task_event("t1")))
+
+    assert [name for name, _, _ in routed] == ["replication_queue"]
+    assert task_class.call_args.kwargs["room_id"] == ROOM_ID
+
+
+def test_route_skips_other_rooms_and_own_tasks():
+    engine = make_engine(exclude_self=["replication_queue"])
+
+    assert list(engine._route(OTHER_ROOM_ID, task_event("t1"))) == []
+    assert list(engine._route(ROOM_ID, task_event("t1", sender=USER_ID))) == []
+    assert list(engine._route(ROOM_ID, task_event("t1", queue="mutex"))) == []
+
+
+@pytest.mark.asyncio
+async def test_sync_advances_checkpoint_once_tasks_are_acked():
+    engine = make_engine()
+    queue = engine.queues["replication_queue"]
+    engine._request = AsyncMock(return_value=sync_response([task_event("t1"), ack_event("t1")]))
+
+    with patch.object(sync, "ijson", None):
+        results = await collect(engine.sync(["replication_queue"], "s1", timeout=0))
+
+    assert results == []
+    assert queue.checkpoint.since_token == "s2"
+
+
+@pytest.mark.asyncio
+async def test_sync_keeps_checkpoint_with_unacked_tasks():
+    engine = make_engine()
+    queue = engine.queues["replication_queue"]
+    queue.checkpoint.since_token = "s1"
+    engine._request = AsyncMock(return_value=sync_response([task_event("t1")]))
+
+    with patch.object(sync, "ijson", None):
+        results = await collect(engine.sync(["replication_queue"], "s1", timeout=0))
+
+    assert [[task.id for task in batch["replication_queue"]] for batch in results] == [["t1"]]
+    assert queue.checkpoint.since_token == "s1"
+
+
+@pytest.mark.asyncio
+async def test_sync_marks_limited_rooms_as_behind():
+    engine = make_engine()
+    queue = engine.queues["replication_queue"]
+    queue.checkpoint.since_token = "s1"
+    engine._request = AsyncMock(return_value=sync_response([task_event("t1")], limited=True))
+
+    with patch.object(sync, "ijson", None):
+        results = await collect(engine.sync(["replication_queue"], "s1", timeout=0))
+
+    assert results == []
+    assert engine._behind == {"replication_queue"}
+    assert queue.checkpoint.since_token == "s1"
+
+
+@pytest.mark.asyncio
+async def test_catch_up_pages_from_the_checkpoint():
+    engine = make_engine(page_size=1)
+    queue = engine.queues["replication_queue"]
+    engine._position = AsyncMock(return_value="position")
+    pages = [
+        SimpleNamespace(chunk=[SimpleNamespace(source=task_event("t1"))], end="p1"),
+        SimpleNamespace(chunk=[SimpleNamespace(source=ack_event("t1"))], end="p2"),
+        SimpleNamespace(chunk=[], end="p2"),
+    ]
+    engine.client.room_messages = AsyncMock(side_effect=pages)
+
+    results = await collect(engine.catch_up(["replication_queue"], "s1"))
+
+    assert [[task.id for task in batch["replication_queue"]] for batch in results] == [["t1"]]
+    starts = [call.kwargs["start"] for call in engine.client.room_messages.call_args_list]
+    assert starts == ["s1", "p1", "p2"]
+    assert all(
+        call.kwargs["end"] == "position" for call in engine.client.room_messages.call_args_list
+    )
+    queue.checkpoint.put_checkpoint_state.assert_awaited_once_with("position")
+    assert engine._cursors == {}
+
+
+@pytest.mark.asyncio
+async def test_catch_up_keeps_checkpoint_with_unacked_tasks():
+    engine = make_engine()
+    queue = engine.queues["replication_queue"]
+    engine._position = AsyncMock(return_value="position")
+    engine.client.room_messages = AsyncMock(
+        side_effect=[
+            SimpleNamespace(chunk=[SimpleNamespace(source=task_event("t1"))], end="p1"),
+            SimpleNamespace(chunk=[], end="p1"),
+        ]
+    )
+
+    results = await collect(engine.catch_up(["replication_queue"], "s1"))
+
+    assert [[task.id for task in batch["replication_queue"]] for batch in results] == [["t1"]]
+    queue.checkpoint.put_checkpoint_state.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_catch_up_yields_an_empty_batch_before_waiting_for_acks():
+    engine = make_engine()
+    engine._position = AsyncMock(return_value="position")
+    engine.client.room_messages = AsyncMock(
+        side_effect=[
+            SimpleNamespace(chunk=[SimpleNamespace(source=task_event("t1"))], end="p1"),
+            SimpleNamespace(chunk=[], end="p1"),
+        ]
+    )
+    results = []
+
+    async def wait_for_acks(names):
+        results.append("wait")
+
+    engine._wait_for_acks = wait_for_acks
+    async for batch in engine.catch_up(["replication_queue"], "s1"):
+        results.append(batch)
+
+    assert results[1:] == [{}, "wait", {}, "wait"]